@@ -0,0 +1,147 @@
+"""Benchmarks of the offline processing of the MicroMAP readers against the implementations they replaced.
+
+    counters -> micromap_frames.CounterUnfolder vs the per-sample loop of the old MicroMAPReader._get_unfold_counter
+    filters  -> micromap_filters.SosFilter (all channels at once, float64 and float32) vs mne called once per channel (only if mne is
+                installed, it is no longer a dependency of the readers)
+    resample -> MicroMAPReader.resample with method = 'poly' (data in memory, streamed from the file, written to a new recording) vs
+                method = 'fft' (scipy.signal.resample over the whole array, the previous implementation). Each case runs in a new
+                process (Linux) to measure its peak RSS; the interpreter and the imports alone take about 135 MB.
+
+The data is synthetic (random codes, an old style headerless recording for resample). The timings depend on the machine; the results
+of the default run on the development machine (1 core) were:
+
+    counters, 10M folded 16 bits counters:
+        previous loop   5.54 s
+        CounterUnfolder 0.12 s (47x)
+    filters, 10 minutes at 2 kHz, notch [60, 120] then 1-300 Hz band pass (zero-phase):
+        16 channels: mne per channel 2.16 s, SosFilter float64 0.90 s, float32 0.79 s
+        32 channels: mne per channel 3.78 s, SosFilter float64 2.04 s, float32 1.70 s
+    resample, 16 channels, 30 kHz, 2 minutes -> 1 kHz (time, peak RSS):
+        fft (previous)              2.01 s, 1247 MB
+        poly, data already loaded   1.60 s,  421 MB
+        poly, streamed from file    1.59 s,  397 MB
+        poly, written to new file   1.57 s,  382 MB
+
+Ex:
+    python benchmarks/benchmark_processing.py                               # All the benchmarks
+    python benchmarks/benchmark_processing.py filters --channels 16 32
+"""
+import argparse
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import time
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'micromap', 'interface'))
+import micromap_filters
+import micromap_frames
+import micromap_utils
+
+RESAMPLE_CASES = {'fft': "fft (previous)", 'poly_memory': "poly, data already loaded", 'poly_stream': "poly, streamed from file",
+                  'poly_file': "poly, written to new file"}
+
+def loop_unfold(counter_series, max_value):
+    """Previous MicroMAPReader._get_unfold_counter (per-sample Python loop), kept here as the reference."""
+    counter_series = numpy.asarray(counter_series)
+    unfolded = [counter_series[0]]
+    rollover = 0
+    for i in range(1, len(counter_series)):
+        if counter_series[i] < counter_series[i - 1]:
+            rollover += 1
+        unfolded.append(counter_series[i] + rollover * (max_value + 1))
+    return numpy.array(unfolded)
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+def benchmark_counters(samples):
+    max_value = 2**16 - 1
+    folded = numpy.arange(samples, dtype = numpy.int64) % (max_value + 1)
+    previous, previous_time = timed(loop_unfold, folded, max_value)
+    unfolded, unfolded_time = timed(micromap_frames.CounterUnfolder(max_value).unfold, folded)
+    assert numpy.array_equal(previous, unfolded)
+    print(f"counters, {samples / 1e6:g}M folded 16 bits counters:")
+    print(f"    previous loop   {previous_time:.2f} s")
+    print(f"    CounterUnfolder {unfolded_time:.2f} s ({previous_time / unfolded_time:.0f}x)")
+
+def benchmark_filters(channel_counts, minutes, sampling_freq = 2000):
+    try:
+        import mne
+    except ImportError:
+        mne = None
+
+    def mne_filters(data):
+        for a in range(len(data)):
+            data[a] = mne.filter.notch_filter(data[a], sampling_freq, numpy.array([60, 120]), verbose = 'WARNING')
+            data[a] = mne.filter.filter_data(data[a], sampling_freq, 1, 300, method = 'iir', verbose = 'WARNING')
+
+    def sos_filters(data):
+        micromap_filters.SosFilter(micromap_filters.notch_sos([60, 120], sampling_freq)).apply(data)
+        micromap_filters.SosFilter(micromap_filters.bandpass_sos(1, 300, sampling_freq)).apply(data)
+
+    rng = numpy.random.default_rng(0)
+    print(f"filters, {minutes:g} minutes at {sampling_freq / 1000:g} kHz, notch [60, 120] then 1-300 Hz band pass (zero-phase):")
+    for channels in channel_counts:
+        data = rng.standard_normal((channels, int(minutes * 60 * sampling_freq)))
+        results = []
+        if mne is not None:
+            results.append(f"mne per channel {timed(mne_filters, data.copy())[1]:.2f} s")
+        results.append(f"SosFilter float64 {timed(sos_filters, data.copy())[1]:.2f} s")
+        results.append(f"float32 {timed(sos_filters, data.astype(numpy.float32))[1]:.2f} s")
+        print(f"    {channels} channels: " + ", ".join(results) + ("" if mne is not None else " (mne not installed)"))
+
+def write_recording(folder, channels, seconds, sampling_freq):
+    """Old style recording (headerless .mmap + _metadata.pkl) of random codes, without lost packets."""
+    frames = numpy.zeros(int(seconds * sampling_freq), dtype = micromap_frames.rhd_frame_dtype(channels))
+    frames['counter'] = numpy.arange(frames.size) % 2**16
+    frames['samples'] = numpy.random.default_rng(0).integers(-3000, 3000, (frames.size, channels), dtype = numpy.int16)
+    frames.tofile(os.path.join(folder, "recording.mmap"))
+    with open(os.path.join(folder, "recording_metadata.pkl"), 'wb') as f:
+        pickle.dump({"Number of Channels": channels, "Channels": list(range(channels)), "Sampling Frequency": sampling_freq}, f)
+
+def resample_case(case, folder, new_rate):
+    """Runs one resampling case (in its own process) and prints its time and peak RSS."""
+    start = time.perf_counter()
+    reader = micromap_utils.MicroMAPReader(folder, preload = case in ('fft', 'poly_memory'))
+    if case == 'fft':
+        reader.resample(new_rate)
+    elif case == 'poly_file':
+        reader.resample(new_rate, method = 'poly', output = os.path.join(folder, "resampled"))
+    else:
+        reader.resample(new_rate, method = 'poly')
+    with open("/proc/self/status") as f:                                   # VmHWM (Linux): unlike ru_maxrss it does not keep the peak of the parent
+        peak = next(int(line.split()[1]) for line in f if line.startswith("VmHWM")) / 1024
+    print(f"    {RESAMPLE_CASES[case]:<27} {time.perf_counter() - start:.2f} s, {peak:4.0f} MB")
+
+def benchmark_resample(channels, minutes, sampling_freq = 30000, new_rate = 1000):
+    print(f"resample, {channels} channels, {sampling_freq / 1000:g} kHz, {minutes:g} minutes -> {new_rate / 1000:g} kHz (time, peak RSS):")
+    with tempfile.TemporaryDirectory() as folder:
+        write_recording(folder, channels, minutes * 60, sampling_freq)
+        for case in RESAMPLE_CASES:
+            subprocess.run([sys.executable, os.path.abspath(__file__), 'resample_case', case, folder, str(new_rate)], check = True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Benchmarks of the MicroMAP offline processing.")
+    parser.add_argument('benchmarks', nargs = '*', default = ['counters', 'filters', 'resample'])
+    parser.add_argument('--samples', type = int, default = 10_000_000, help = "Counters unfolded (counters).")
+    parser.add_argument('--channels', type = int, nargs = '+', default = [16, 32], help = "Channel counts (filters; the first one for resample).")
+    parser.add_argument('--minutes', type = float, default = None, help = "Duration (default: 10 for filters, 2 for resample).")
+    args = parser.parse_args()
+
+    if args.benchmarks and args.benchmarks[0] == 'resample_case':                # Child process of benchmark_resample
+        resample_case(args.benchmarks[1], args.benchmarks[2], int(args.benchmarks[3]))
+        sys.exit()
+    for name in args.benchmarks:
+        if name == 'counters':
+            benchmark_counters(args.samples)
+        elif name == 'filters':
+            benchmark_filters(args.channels, args.minutes or 10)
+        elif name == 'resample':
+            benchmark_resample(args.channels[0], args.minutes or 2)
+        else:
+            parser.error(f"Unknown benchmark {name!r}. Use counters, filters or resample.")
@@ -29,6 +29,8 @@ import matplotlib
 import serial
 import time
 import os
+import micromap_frames
+import micromap_format
 matplotlib.use('Qt5Agg')
 from numpy import where, array
 
@@ -107,8 +109,7 @@ class acquisition:
             slider_index (index int number): Interface slider index.
             
         '''
-        frequencies = [1, 100, 500, 1000, 2000, 5000, 10000, 20000, 30000]                       # Possible values ​​of sampling frequency
-        self.sampling_frequency = frequencies[slider_index]                        # Sets the attribute with the correspondent frequency
+        self.sampling_frequency = micromap_frames.SAMPLING_FREQUENCIES[slider_index]                        # Sets the attribute with the correspondent frequency
             
     def set_highpass_by_index(self, slider_index):
         '''Set highpass by index
@@ -119,9 +120,7 @@ class acquisition:
             slider_index (index int number): Interface slider index.
             
         '''
-        frequencies = [0.1, 0.25, 0.3, 0.5, 0.75, 1, 1.5, 2, 2.5, 3, 5, 7.5,
-                       10, 15, 20, 25, 30, 50, 75, 100, 150, 200, 250, 300, 500]    # Possible values ​​of cutoff frequency
-        self.highpass = frequencies[slider_index]                                  # Sets the attribute with the correspondent frequency
+        self.highpass = micromap_frames.HIGHPASS_FREQUENCIES[slider_index]                                  # Sets the attribute with the correspondent frequency
         
     def set_lowpass_by_index(self, slider_index):
         '''Set lowpass by index
@@ -132,9 +131,7 @@ class acquisition:
             slider_index (index int number): Interface slider index.
             
         '''
-        frequencies = [100, 150, 200, 250, 300, 500, 750, 1000, 1500,
-                       2000, 2500, 3000, 5000, 7500, 10000, 15000, 20000]           # Possible values ​​of cutoff frequency 
-        self.lowpass = frequencies[slider_index]                                   # Sets the attribute with the correspondent frequency
+        self.lowpass = micromap_frames.LOWPASS_FREQUENCIES[slider_index]                                   # Sets the attribute with the correspondent frequency
                 
     def set_channels(self, bool_list):
         '''Set channels
@@ -185,6 +182,35 @@ class acquisition:
         
         return self._resume        
 
+    def recording_header(self, index_period = 0):
+        '''Recording header
+        
+        This public function creates the header written at the start of the recording file 
+        (see micromap_format), with the chip, sampling frequency, channels, scaling and frame layout
+        
+        Args:
+            index_period (int): Number of frames of each saved block (one index entry per block).
+            
+        '''
+        if self.chip != "ADS1298":                                                                  # If the chip is an RHD (16 bits counter + int16 samples)
+            counter_type, sample_format, status_bytes = 'n', 'i2', 0
+            scale = micromap_frames.INTAN_SCALE
+        else:                                                                                       # If the chip is an ADS1298 (status word + 24 bits samples)
+            counter_type, sample_format, status_bytes = None, 'i3', micromap_frames.ADS_HEADER_BYTES
+            scale = micromap_frames.ADS_SCALE
+            
+        return micromap_format.RecordingHeader(chip = self.chip, 
+                                               sampling_freq = self.sampling_frequency, 
+                                               channels = self.channels, 
+                                               scale = scale, 
+                                               counter_type = counter_type, 
+                                               sample_format = sample_format, 
+                                               status_bytes = status_bytes, 
+                                               highpass = self.highpass, 
+                                               lowpass = self.lowpass, 
+                                               method = self.method, 
+                                               index_period = index_period)
+
 class usb_singleton():
     '''Usb singleton
     
@@ -231,6 +257,27 @@ class usb_singleton():
         connection_ok = self.port.read(4)                                       # Reads the 4bytes answer message
         return connection_ok                                                    # Returns the answer message
     
+    def read_stream_into(self, buffer, size, timeout):
+        '''Read stream into
+        
+        This function reads up to size bytes of the acquisition stream (or
+        everything already received, if more) into a preallocated buffer
+        (the writable view of a ByteRingBuffer) and returns how many were
+        written (at most the length of the buffer). The thread sleeps in the
+        operating system until the bytes arrive or until the timeout, instead
+        of polling in_waiting, so an idle or slow stream costs no CPU
+        
+        Args:
+            buffer: Writable buffer (bytearray or memoryview).
+            size: Number of bytes wanted.
+            timeout: Longest wait in seconds (latency of the data).
+
+        '''
+        if self.port.timeout != timeout:
+            self.port.timeout = timeout                                         # Reconfigures the port only when the timeout changes
+        count = min(len(buffer), max(size, self.port.in_waiting))
+        return self.port.readinto(buffer[:count])                               # Returns the number of bytes received (0 after a timeout without data)
+
     def clear_buffer(self):
         '''Clear buffer
         
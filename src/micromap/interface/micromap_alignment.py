@@ -0,0 +1,266 @@
+"""Alignment of two recordings of the same signals (e.g. a MicroMAP and an Open Ephys recording of the EKG validation).
+
+The alignment is the time in the second recording of each time of the first one, t_b = offset + ratio * t_a: the offset is the lag
+at the start and the ratio is the mismatch between the clocks of the two acquisition systems (1.0 for the same clock). It is estimated
+in three steps, none of them over the full resolution of the whole recordings:
+
+    envelope    -> one streaming pass over each recording: high pass, rectified mean of the channels, averaged in blocks down to
+                   `rate` Hz (a few hundred samples per second, even for hours of data)
+    coarse lag  -> FFT cross-correlation of the two envelopes
+    refinement  -> the lag is measured again in windows spread along the recordings (cross-correlation of the envelopes around the
+                   coarse lag, then of the full resolution samples of all channels around that), and the offset and the ratio are the
+                   weighted linear fit of the lags over time
+
+The recordings can be MicroMAP readers (read with iter_chunks and get_segment, they do not need to be loaded) or (channels, samples)
+arrays with their sampling frequency.
+
+Ex:
+    alignment = micromap_alignment.align(micromap_reader, open_ephys_data, sampling_freq_b = 30000)
+    open_ephys_time = alignment.to_b(micromap_time)
+"""
+import numpy
+from scipy.signal import correlate, correlation_lags, fftconvolve, resample_poly
+import micromap_filters
+import micromap_pipeline
+
+def _sampling_freq(source, sampling_freq):
+    if sampling_freq is None:
+        if not hasattr(source, 'sampling_freq'):
+            raise ValueError("The sampling frequency is needed for arrays.")
+        return source.sampling_freq
+    return sampling_freq
+
+def _chunks(source, channels, seconds, sampling_freq):
+    """(channels, samples) blocks of a reader or of an array."""
+    if hasattr(source, 'iter_chunks'):
+        for _, block in micromap_pipeline.reader_chunks(source, seconds, channels):
+            yield block
+        return
+    data = numpy.atleast_2d(source)
+    rows = slice(None) if channels is None else numpy.asarray(channels) - 1
+    step = max(1, int(round(seconds * sampling_freq)))
+    for start in range(0, data.shape[1], step):
+        yield numpy.asarray(data[rows, start:start + step], dtype = numpy.float64)
+
+def _segment(source, sampling_freq, first, last, channels):
+    """Samples first to last (clipped to the recording) of a reader or of an array, as float64 (channels, samples)."""
+    first = max(first, 0)
+    if hasattr(source, 'get_segment'):
+        return source.get_segment(first / sampling_freq, last / sampling_freq, channels, dtype = numpy.float64)
+    data = numpy.atleast_2d(source)
+    rows = slice(None) if channels is None else numpy.asarray(channels) - 1
+    return numpy.asarray(data[rows, first:max(last, first)], dtype = numpy.float64)
+
+def _parabolic(values, index):
+    """Sub-sample position of the peak at index (parabola through the peak and its neighbours)."""
+    if index <= 0 or index >= len(values) - 1:
+        return float(index)
+    left, center, right = values[index - 1], values[index], values[index + 1]
+    curvature = left - 2 * center + right
+    return index + (0.5 * (left - right) / curvature if curvature < 0 else 0.0)
+
+def envelope(source, sampling_freq = None, rate = 200, channels = None, highpass = 1.0, seconds = 10):
+    '''Envelope
+
+    Decimated envelope of a recording, in one pass: high pass (to remove the offset of the electrodes), absolute value averaged over
+    the channels and over blocks of sampling_freq / rate samples.
+
+    Args:
+        source: MicroMAP reader or (channels, samples) array.
+        sampling_freq (number): Sampling frequency in Hz (only for arrays).
+        rate (number): Approximate rate of the envelope in Hz.
+        channels (number list): Channels (index from 1 to N). None uses all channels.
+        highpass (number): High pass cutoff in Hz (None does not filter).
+        seconds (number): Duration of the chunks.
+
+    Returns:
+        envelope (1D array) and its exact rate in Hz (sampling_freq divided by the integer block size).
+    '''
+    sampling_freq = _sampling_freq(source, sampling_freq)
+    factor = max(1, int(round(sampling_freq / rate)))
+    stage = None if highpass is None else micromap_filters.HighpassFilter(highpass, sampling_freq, steady_start = True)
+    blocks, pending = [], numpy.empty(0)
+    for block in _chunks(source, channels, seconds, sampling_freq):
+        if stage is not None:
+            block = stage.process(block)
+        rectified = numpy.concatenate((pending, numpy.abs(block).mean(axis = 0)))
+        complete = (rectified.size // factor) * factor
+        blocks.append(rectified[:complete].reshape(-1, factor).mean(axis = 1))
+        pending = rectified[complete:]
+    return (numpy.concatenate(blocks) if blocks else numpy.empty(0)), sampling_freq / factor
+
+def cross_lag(a, b, rate, max_lag = None):
+    '''Cross lag
+
+    Lag of b relative to a (b[n + lag * rate] matches a[n]) from the peak of their FFT cross-correlation.
+
+    Args:
+        a, b (1D arrays): Signals with the same rate.
+        rate (number): Rate of the signals in Hz.
+        max_lag (number): Largest lag searched, in seconds (None searches all the lags).
+
+    Returns:
+        lag (seconds, with sub-sample resolution) and the normalized correlation at the peak.
+    '''
+    a = a - a.mean()
+    b = b - b.mean()
+    correlation = correlate(b, a, mode = 'full', method = 'fft')
+    lags = correlation_lags(b.size, a.size, mode = 'full')
+    if max_lag is not None:
+        allowed = numpy.abs(lags) <= max_lag * rate
+        correlation, lags = correlation[allowed], lags[allowed]
+    peak = int(numpy.argmax(correlation))
+    position = _parabolic(correlation, peak)
+    norm = numpy.sqrt((a**2).sum() * (b**2).sum())
+    return (lags[0] + position) / rate, float(correlation[peak] / norm) if norm > 0 else 0.0
+
+class Alignment:
+    '''Alignment
+
+    Linear time mapping between two recordings, t_b = offset + ratio * t_a.
+
+    Attributes:
+        offset (number): Time in b of the start of a, in seconds.
+        ratio (number): Clock rate ratio (seconds of b per second of a).
+        correlation (number): Correlation of the envelopes at the coarse lag.
+        times, lags, correlations (arrays): Center of each refinement window in a (seconds), the lag measured there (t_b - t_a) and its
+            correlation. The windows below min_correlation are not used by the fit.
+
+    '''
+    def __init__(self, offset, ratio, correlation, times, lags, correlations):
+        self.offset = offset
+        self.ratio = ratio
+        self.correlation = correlation
+        self.times = times
+        self.lags = lags
+        self.correlations = correlations
+
+    def to_b(self, t_a):
+        """Times of a (seconds) in the time line of b."""
+        return self.offset + self.ratio * numpy.asarray(t_a)
+
+    def to_a(self, t_b):
+        """Times of b (seconds) in the time line of a."""
+        return (numpy.asarray(t_b) - self.offset) / self.ratio
+
+    @property
+    def drift_ppm(self):
+        """Clock mismatch in parts per million."""
+        return (self.ratio - 1.0) * 1e6
+
+    def __repr__(self):
+        return f"Alignment(offset = {self.offset:.6f} s, ratio = {self.ratio:.8f} ({self.drift_ppm:+.1f} ppm), correlation = {self.correlation:.3f})"
+
+def _fit(times, lags, weights):
+    """Weighted linear fit lag = offset + (ratio - 1) * t. Returns (offset, ratio)."""
+    if times.size == 0:
+        raise ValueError("No window could be aligned (correlation below min_correlation).")
+    if times.size == 1 or numpy.ptp(times) == 0:
+        return float(numpy.average(lags, weights = weights)), 1.0
+    slope, offset = numpy.polyfit(times, lags, 1, w = numpy.sqrt(weights))
+    return float(offset), 1.0 + float(slope)
+
+def _valid_peak(segment_a, segment_b):
+    """Position of (channels, samples) segment_a inside the longer segment_b (sub-sample, from the cross-correlation summed over the
+    channels) and the normalized correlation there."""
+    segment_a = segment_a - segment_a.mean(axis = 1, keepdims = True)
+    segment_b = segment_b - segment_b.mean(axis = 1, keepdims = True)
+    correlation = fftconvolve(segment_b, segment_a[:, ::-1], mode = 'valid', axes = 1).sum(axis = 0)
+    peak = int(numpy.argmax(correlation))
+    matched = segment_b[:, peak:peak + segment_a.shape[1]]
+    norm = numpy.sqrt((segment_a**2).sum() * (matched**2).sum())
+    return _parabolic(correlation, peak), float(correlation[peak] / norm) if norm > 0 else 0.0
+
+def _refine(a, b, sampling_freq_a, sampling_freq_b, channels_a, channels_b, center, lag, window, search):
+    """Lag (t_b - t_a) at center seconds of a, searched within lag +- search seconds on the full resolution samples of all channels."""
+    first_a = int(round((center - window / 2) * sampling_freq_a))
+    last_a = first_a + int(round(window * sampling_freq_a))
+    first_b = int(round((center + lag - window / 2 - search) * sampling_freq_b))
+    last_b = int(round((center + lag + window / 2 + search) * sampling_freq_b))
+    if first_a < 0 or first_b < 0:
+        return None
+    segment_a = _segment(a, sampling_freq_a, first_a, last_a, channels_a)
+    segment_b = _segment(b, sampling_freq_b, first_b, last_b, channels_b)
+    if segment_a.shape[0] != segment_b.shape[0]:
+        raise ValueError("The recordings must have the same number of channels (see channels_a and channels_b).")
+    if sampling_freq_b != sampling_freq_a:                                  # b on the sample rate of a
+        up, down = micromap_filters.rate_ratio(sampling_freq_a, sampling_freq_b, exact = False)   # A rounded ratio only adds to the drift fit
+        segment_b = resample_poly(segment_b, up, down, axis = 1)
+    if segment_a.shape[1] < last_a - first_a or segment_b.shape[1] <= segment_a.shape[1]:
+        return None                                                         # Window beyond the end of one of the recordings
+
+    position, score = _valid_peak(segment_a, segment_b)
+    return first_b / sampling_freq_b + position / sampling_freq_a - first_a / sampling_freq_a, score
+
+def align(a, b, sampling_freq_a = None, sampling_freq_b = None, channels_a = None, channels_b = None, rate = 200, max_lag = None,
+          windows = 8, window_seconds = 10, refine_seconds = 2, search = 1.0, min_correlation = 0.3, seconds = 10):
+    '''Align
+
+    Estimates the lag and the clock rate ratio between two recordings of the same signals.
+
+    Args:
+        a, b: MicroMAP readers or (channels, samples) arrays.
+        sampling_freq_a, sampling_freq_b (number): Sampling frequencies in Hz (only for arrays).
+        channels_a, channels_b (number list): Channels used from each recording (index from 1 to N), in matching order.
+        rate (number): Rate of the envelopes in Hz (resolution of the coarse lag).
+        max_lag (number): Largest coarse lag searched, in seconds (None searches all the lags).
+        windows (int): Number of refinement windows spread over the overlap of the recordings.
+        window_seconds (number): Duration of the envelope windows.
+        refine_seconds (number): Duration of the full resolution windows (0 only refines on the envelopes).
+        search (number): Lag range searched around the coarse lag in each window, in seconds (must cover the clock drift).
+        min_correlation (number): Windows with a lower correlation are not used by the fit (the coarse fit is kept when no full
+            resolution window reaches it).
+        seconds (number): Duration of the chunks read for the envelopes.
+
+    Returns:
+        Alignment.
+    '''
+    sampling_freq_a = _sampling_freq(a, sampling_freq_a)
+    sampling_freq_b = _sampling_freq(b, sampling_freq_b)
+    envelope_a, rate_a = envelope(a, sampling_freq_a, rate, channels_a, seconds = seconds)
+    envelope_b, rate_b = envelope(b, sampling_freq_b, rate, channels_b, seconds = seconds)
+    if rate_b != rate_a:                                                    # Envelope of b on the rate of a
+        envelope_b = numpy.interp(numpy.arange(int(envelope_b.size * rate_a / rate_b)) / rate_a, numpy.arange(envelope_b.size) / rate_b, envelope_b)
+
+    lag, correlation = cross_lag(envelope_a, envelope_b, rate_a, max_lag)
+
+    # Windows spread over the part of a that is also in b
+    start = max(0.0, -lag)
+    stop = min(envelope_a.size / rate_a, envelope_b.size / rate_a - lag)
+    window_seconds = min(window_seconds, stop - start)
+    centers = numpy.linspace(start + window_seconds / 2, stop - window_seconds / 2, max(1, int(windows)))
+    width = int(round(window_seconds * rate_a))
+    reach = int(round(search * rate_a))
+
+    times, lags, scores = [], [], []
+    for center in centers:
+        first_a = int(round(center * rate_a)) - width // 2
+        first_b = int(round((center + lag) * rate_a)) - width // 2 - reach
+        window_a = envelope_a[max(first_a, 0):first_a + width]
+        window_b = envelope_b[max(first_b, 0):first_b + width + 2 * reach]
+        if first_a < 0 or first_b < 0 or window_a.size < width or window_b.size <= width:
+            continue
+        position, score = _valid_peak(window_a[None], window_b[None])
+        times.append(center)
+        lags.append((first_b + position - first_a) / rate_a)
+        scores.append(score)
+    times, lags, scores = numpy.asarray(times), numpy.asarray(lags), numpy.asarray(scores)
+
+    used = scores >= min_correlation
+    offset, ratio = _fit(times[used], lags[used], scores[used])
+
+    if refine_seconds > 0:
+        refined = []
+        for center in times:
+            result = _refine(a, b, sampling_freq_a, sampling_freq_b, channels_a, channels_b, center, offset + (ratio - 1) * center,
+                             refine_seconds, 2.0 / rate_a)
+            if result is not None:
+                refined.append((center,) + result)
+        if refined:
+            refined_times, refined_lags, refined_scores = (numpy.asarray(values) for values in zip(*refined))
+            used = refined_scores >= min_correlation
+            if used.any():                                                  # Else keeps the coarse fit (refinement too noisy)
+                times, lags, scores = refined_times, refined_lags, refined_scores
+                offset, ratio = _fit(times[used], lags[used], scores[used])
+
+    return Alignment(offset, ratio, correlation, times, lags, scores)
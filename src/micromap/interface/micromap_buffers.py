@@ -0,0 +1,153 @@
+"""Preallocated byte buffers for the acquisition threads.
+
+The receiver threads read the serial stream straight into a fixed ring (ByteRingBuffer) and take whole packets out of it as memoryviews,
+so the cost of framing does not depend on how many bytes are waiting (slicing a growing bytearray copies all the bytes after the packet).
+The capacity is a multiple of the packet size and the packets are always taken from the start of a slot, so a packet never wraps around
+the end of the ring and can be returned without copying it.
+
+Each packet is then copied once into a buffer of a BufferPool and the same buffer is handed to the save thread and to the plot thread.
+The buffer is reference counted: every consumer releases it when done and the last release returns it to the pool, so a running
+acquisition reuses the same few buffers instead of allocating two new objects per packet.
+
+This module only uses the standard library, so it can run on the Raspberry Pi next to the acquisition threads.
+"""
+import threading
+
+class ByteRingBuffer:
+    '''Byte ring buffer
+
+    Fixed capacity ring of bytes cut in packets of packet_size bytes.
+
+    Args:
+        packet_size (int): Bytes of a packet.
+        packets (int): Capacity in packets (at least 2).
+
+    Ex:
+        ring = ByteRingBuffer(bytes_to_read)
+        received = usb.read_stream_into(ring.writable(), bytes_to_read, timeout)
+        ring.commit(received)
+        for packet in ring.packets():                                       # memoryviews, valid until the next write
+            save(packet)
+    '''
+    def __init__(self, packet_size, packets = 16):
+        if packet_size < 1 or packets < 2:
+            raise ValueError("The packet size must be positive and the ring must hold at least 2 packets.")
+        self.packet_size = int(packet_size)
+        self.capacity = self.packet_size * int(packets)
+        self.data = bytearray(self.capacity)
+        self.view = memoryview(self.data)
+        self.clear()
+
+    def clear(self):
+        self.start = 0                                                      # Start of the first stored byte (always at the start of a packet)
+        self.size = 0                                                       # Bytes stored
+
+    def __len__(self):
+        return self.size
+
+    def free(self):
+        """Returns the number of bytes that can still be written."""
+        return self.capacity - self.size
+
+    def writable(self):
+        """Returns a memoryview of the free bytes that follow the stored ones without wrapping (empty if the ring is full)."""
+        end = (self.start + self.size) % self.capacity
+        if self.size == self.capacity:
+            return self.view[end:end]
+        if end >= self.start:
+            return self.view[end:]
+        return self.view[end:self.start]
+
+    def commit(self, count):
+        """Marks as stored count bytes written at the start of the last writable() view."""
+        if count > self.free():
+            raise ValueError("Writing more bytes than the free space of the ring.")
+        self.size += count
+
+    def packets(self):
+        """Yields the complete packets as memoryviews and removes them from the ring. The views point into the ring and are only valid
+        until the next write."""
+        while self.size >= self.packet_size:
+            packet = self.view[self.start:self.start + self.packet_size]
+            self.start = (self.start + self.packet_size) % self.capacity
+            self.size -= self.packet_size
+            yield packet
+
+    def remainder(self):
+        """Returns the bytes of the incomplete packet left after packets() (a memoryview, it never wraps) and empties the ring."""
+        rest = self.view[self.start:self.start + self.size]
+        self.clear()
+        return rest
+
+class PooledBuffer:
+    '''Pooled buffer
+
+    Fixed size buffer of a BufferPool, shared by several consumers (see BufferPool.acquire). The valid bytes are in view.
+
+    '''
+    __slots__ = ('pool', 'data', 'view', 'refs')
+
+    def __init__(self, pool, size):
+        self.pool = pool
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)[:0]                                 # Valid bytes (set by acquire)
+        self.refs = 0
+
+    def __len__(self):
+        return len(self.view)
+
+    def release(self):
+        """Releases the buffer (once per consumer). The last release returns it to the pool; it must not be used afterwards."""
+        self.pool._release(self)
+
+class BufferPool:
+    '''Buffer pool
+
+    Preallocated buffers of buffer_size bytes, handed to one or more consumers and returned to the pool when all of them released them.
+    When every buffer is in use a new one is allocated (the receiver must never wait for the consumers); the pool keeps at most `buffers`
+    free buffers, so the extra ones are dropped once the consumers catch up.
+
+    Args:
+        buffer_size (int): Bytes of each buffer (the largest data copied into a buffer).
+        buffers (int): Buffers allocated at the start.
+
+    Ex:
+        pool = BufferPool(bytes_to_read)
+        buffer = pool.acquire(packet, consumers = 2)
+        save_queue.put(buffer)                                              # The saver calls buffer.release() after writing buffer.view
+        raw_data_ready.emit(buffer)                                         # The plotter calls buffer.release() after decoding it
+    '''
+    def __init__(self, buffer_size, buffers = 64):
+        self.buffer_size = int(buffer_size)
+        self.buffers = int(buffers)
+        self.lock = threading.Lock()
+        self.free = [PooledBuffer(self, self.buffer_size) for _ in range(self.buffers)]
+        self.allocated = self.buffers                                       # Buffers created since the start (more than `buffers` if it grew)
+
+    def acquire(self, data, consumers = 1):
+        """Copies data (at most buffer_size bytes) into a free buffer and returns it with one reference per consumer."""
+        if len(data) > self.buffer_size:
+            raise ValueError("The data is larger than the buffers of the pool.")
+        with self.lock:
+            if self.free:
+                buffer = self.free.pop()
+            else:
+                buffer = PooledBuffer(self, self.buffer_size)
+                self.allocated += 1
+            buffer.refs = consumers
+        buffer.data[:len(data)] = data
+        buffer.view = memoryview(buffer.data)[:len(data)]
+        return buffer
+
+    def _release(self, buffer):
+        with self.lock:
+            if buffer.refs <= 0:
+                raise ValueError("The buffer was released more times than it was acquired.")
+            buffer.refs -= 1
+            if buffer.refs == 0 and len(self.free) < self.buffers:
+                self.free.append(buffer)
+
+    def available(self):
+        """Returns the number of free buffers."""
+        with self.lock:
+            return len(self.free)
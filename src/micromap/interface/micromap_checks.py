@@ -0,0 +1,310 @@
+"""Acceptance checks of MicroMAP recordings, run chunk by chunk over the raw frames of the file.
+
+Arduino test: the test firmware sends, for every channel, the number of the channel with a sign that alternates at each frame
+(+n, -n, +n, ...). The check is vectorized over all the channels of a chunk of frames and keeps only the last frame between chunks, so it
+works for any number of channels and any file size. A frame breaks the pattern of a channel when its value is not +-code or when it does
+not invert the value of the previous frame (an odd number of lost frames repeats the sign; an even number can not be seen here, see the
+packet counter).
+
+Packet counter: every discontinuity of the counter (gaps, duplicated frames and backward jumps) is found in one vectorized pass over the
+raw counters, with the position and the length of each one and the loss per minute, and the report can be written as JSON.
+"""
+import json
+import numpy
+
+def arduino_test_codes(num_channels, sample_format = 'i2'):
+    """Codes of the Arduino test signal of each channel, as decoded by the readers. The firmware sends the channel number (0 to N - 1)
+    big-endian: the RHD frames ('i2', little-endian) see it byte swapped and the ADS frames ('i3', big-endian) see it as sent."""
+    channels = numpy.arange(num_channels)
+    if sample_format == 'i3':
+        return channels.astype(numpy.int32)
+    return channels.astype('>i2').view('<i2').astype(numpy.int32)
+
+class ArduinoTestReport:
+    '''Arduino test report
+
+    Result of the Arduino test of a recording. True (bool) if no frame breaks the pattern.
+
+    Attributes:
+        num_frames (int): Frames checked.
+        codes (array): Expected code of each channel.
+        counts (array): Frames that break the pattern in each channel.
+        frames, channels (arrays): Frame index and channel (1 to N) of each break, in file order (up to max_breaks of them).
+        truncated (bool): True if there were more breaks than max_breaks.
+
+    '''
+    def __init__(self, num_frames, codes, counts, frames, channels, truncated):
+        self.num_frames = num_frames
+        self.codes = codes
+        self.counts = counts
+        self.frames = frames
+        self.channels = channels
+        self.truncated = truncated
+
+    @property
+    def passed(self):
+        return not self.counts.any()
+
+    @property
+    def matched(self):
+        """Fraction of the frames of each channel that follow the pattern."""
+        return 1.0 - self.counts / max(self.num_frames, 1)
+
+    def breaks(self, channel):
+        """Frame indexes where the pattern of a channel (1 to N) breaks."""
+        return self.frames[self.channels == channel]
+
+    def to_dict(self):
+        return {'passed': self.passed, 'num_frames': int(self.num_frames), 'counts': self.counts.tolist(),
+                'first_breaks': {int(channel): self.breaks(channel)[:10].tolist() for channel in numpy.unique(self.channels)},
+                'truncated': self.truncated}
+
+    def __bool__(self):
+        return self.passed
+
+    def __str__(self):
+        if self.passed:
+            return f"Arduino test passed ({self.num_frames} frames, {self.counts.size} channels)"
+        failed = numpy.flatnonzero(self.counts) + 1
+        return (f"Arduino test failed: {int(self.counts.sum())} breaks in channels {', '.join(str(c) for c in failed)} "
+                f"(first at frame {int(self.frames[0])})")
+
+class ArduinoTestChecker:
+    '''Arduino test checker
+
+    Checks consecutive chunks of raw frames against the Arduino test pattern.
+
+    Args:
+        codes (array): Expected code of each channel (see arduino_test_codes).
+        max_breaks (int): Breaks whose frame index is kept (all of them are counted).
+
+    '''
+    def __init__(self, codes, max_breaks = 100000):
+        self.codes = numpy.asarray(codes, dtype = numpy.int32)
+        self.max_breaks = max_breaks
+        self.reset()
+
+    def reset(self):
+        self.previous = None                                                # Last frame of the previous chunk
+        self.num_frames = 0
+        self.counts = numpy.zeros(self.codes.size, dtype = numpy.int64)
+        self.frames = []
+        self.channels = []
+        self.kept = 0
+
+    def process(self, samples):
+        '''Process
+
+        Checks the next frames.
+
+        Args:
+            samples: (frames, channels) raw codes of the next frames (as in the file).
+
+        Returns:
+            Frame indexes and channels (1 to N) of the breaks in these frames.
+        '''
+        values = numpy.asarray(samples).astype(numpy.int32)
+        if values.shape[0] == 0:
+            return numpy.empty(0, dtype = numpy.int64), numpy.empty(0, dtype = numpy.int64)
+
+        valid = (values == self.codes) | (values == -self.codes)
+        broken = ~valid
+        broken[1:] |= valid[1:] & valid[:-1] & (values[1:] != -values[:-1])  # Sign repeated (a wrong code is only one break)
+        if self.previous is not None:
+            broken[0] |= valid[0] & (numpy.abs(self.previous) == self.codes) & (values[0] != -self.previous)
+
+        frames, channels = numpy.nonzero(broken)
+        frames = frames + self.num_frames
+        channels = channels + 1
+        self.counts += broken.sum(axis = 0)
+        if self.kept < self.max_breaks:
+            self.frames.append(frames[:self.max_breaks - self.kept])
+            self.channels.append(channels[:self.max_breaks - self.kept])
+            self.kept += self.frames[-1].size
+
+        self.previous = values[-1]
+        self.num_frames += values.shape[0]
+        return frames, channels
+
+    def report(self):
+        """Returns the ArduinoTestReport of the frames checked so far."""
+        frames = numpy.concatenate(self.frames) if self.frames else numpy.empty(0, dtype = numpy.int64)
+        channels = numpy.concatenate(self.channels) if self.channels else numpy.empty(0, dtype = numpy.int64)
+        return ArduinoTestReport(self.num_frames, self.codes, self.counts.copy(), frames, channels, bool(self.counts.sum() > self.kept))
+
+# Kinds of counter discontinuities (PacketCounterReport.events['kind'])
+GAP, DUPLICATE, BACKWARD = 0, 1, 2
+EVENT_KINDS = ('gap', 'duplicate', 'backward')
+EVENT_DTYPE = numpy.dtype([('frame', '<i8'), ('kind', 'u1'), ('length', '<i8'), ('time', '<f8')])
+
+class PacketCounterReport:
+    '''Packet counter report
+
+    Result of the packet counter check of a recording. True (bool) if the counter never skips, repeats or goes back.
+
+    Attributes:
+        num_frames (int): Frames checked.
+        sampling_freq (number): Sampling frequency in Hz.
+        events (EVENT_DTYPE array): Every discontinuity (up to max_events of them), in file order: index of the frame after it, kind
+            (GAP, DUPLICATE or BACKWARD), length (lost packets for a gap, packets back for a backward jump) and time in seconds on the
+            gap filled time line.
+        counts (dict): Number of discontinuities of each kind.
+        lost (int): Packets lost in the gaps.
+        loss_per_minute (array): Packets lost in each minute of the recording (gap filled time line).
+        truncated (bool): True if there were more discontinuities than max_events.
+
+    '''
+    def __init__(self, num_frames, sampling_freq, events, counts, lost, loss_per_minute, longest, truncated):
+        self.num_frames = num_frames
+        self.sampling_freq = sampling_freq
+        self.events = events
+        self.counts = counts
+        self.lost = lost
+        self.loss_per_minute = loss_per_minute
+        self.longest = longest                                              # (length, frame) of the longest gap
+        self.truncated = truncated
+
+    @property
+    def passed(self):
+        return not any(self.counts.values())
+
+    @property
+    def loss_rate(self):
+        """Lost packets / expected packets."""
+        return self.lost / max(self.num_frames + self.lost, 1)
+
+    def kind(self, name):
+        """Events of one kind ('gap', 'duplicate' or 'backward')."""
+        return self.events[self.events['kind'] == EVENT_KINDS.index(name)]
+
+    def to_dict(self):
+        return {'passed': self.passed, 'num_frames': int(self.num_frames), 'sampling_freq': float(self.sampling_freq),
+                'lost': int(self.lost), 'loss_rate': float(self.loss_rate), 'counts': {name: int(count) for name, count in self.counts.items()},
+                'longest_gap': {'length': int(self.longest[0]), 'frame': int(self.longest[1])},
+                'loss_per_minute': self.loss_per_minute.tolist(), 'truncated': self.truncated,
+                'events': [{'frame': int(event['frame']), 'kind': EVENT_KINDS[event['kind']], 'length': int(event['length']),
+                            'time': float(event['time'])} for event in self.events]}
+
+    def to_json(self, path):
+        """Writes the report (to_dict) as JSON."""
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent = 2)
+
+    def __bool__(self):
+        return self.passed
+
+    def __str__(self):
+        if self.passed:
+            return f"Packet counter test passed ({self.num_frames} frames)"
+        return (f"Packet counter test failed: {self.counts['gap']} gaps ({self.lost} packets lost, {100 * self.loss_rate:.4f} %, longest "
+                f"{self.longest[0]} at frame {self.longest[1]}), {self.counts['duplicate']} duplicates, {self.counts['backward']} backward jumps")
+
+class PacketCounterChecker:
+    '''Packet counter checker
+
+    Finds every discontinuity of the packet counter in consecutive chunks of raw (folded) counters. The step between two counters is
+    taken modulo the counter range (serial number arithmetic), so the rollovers are not discontinuities:
+
+        step == increment                    -> normal
+        step == 0                            -> duplicate
+        increment < step < half of the range -> gap of round(step / increment) - 1 lost packets
+        step >= half of the range            -> backward jump (a gap longer than half of the range is also seen as one). The next
+                                                frame is compared with the frame before the jump, so a late frame is a single event
+
+    Args:
+        sampling_freq (number): Sampling frequency in Hz.
+        max_value (int): Largest counter value (2^16 - 1 for 'n', 2^32 - 1 for 'us').
+        increment (number): Counter step between consecutive frames (1 for 'n', 1e6 / sampling_freq microseconds for 'us'). For the
+            timestamps, steps within half an increment of it are normal.
+        max_events (int): Discontinuities kept in the report (all of them are counted).
+
+    '''
+    def __init__(self, sampling_freq, max_value = 2**16 - 1, increment = 1, max_events = 1000000):
+        self.sampling_freq = sampling_freq
+        self.modulus = int(max_value) + 1
+        self.increment = increment
+        self.max_events = max_events
+        self.reset()
+
+    def reset(self):
+        self.last_values = None                                             # Last two counters of the previous chunk
+        self.last_backward = False                                          # The last frame of the previous chunk was a backward jump
+        self.num_frames = 0
+        self.lost = 0
+        self.counts = {name: 0 for name in EVENT_KINDS}
+        self.longest = (0, -1)
+        self.loss_per_minute = numpy.zeros(0, dtype = numpy.int64)
+        self.events = []
+        self.kept = 0
+
+    def process(self, counters):
+        '''Process
+
+        Checks the next counters.
+
+        Args:
+            counters: raw counters of the next frames (as in the file).
+
+        Returns:
+            EVENT_DTYPE array of the discontinuities in these frames.
+        '''
+        counters = numpy.asarray(counters).astype(numpy.int64)
+        if counters.size == 0:
+            return numpy.empty(0, dtype = EVENT_DTYPE)
+
+        if self.last_values is None:
+            self.last_values = numpy.array([counters[0] - 2 * self.increment, counters[0] - self.increment], dtype = numpy.int64)
+        extended = numpy.concatenate((self.last_values, counters))
+        steps = (counters - extended[1:-1]) % self.modulus
+
+        # A frame after a backward jump is compared with the frame before the jump (a single late frame is only one event)
+        after_backward = numpy.empty(counters.size, dtype = bool)
+        after_backward[0] = self.last_backward
+        after_backward[1:] = steps[:-1] >= self.modulus // 2
+        resumed = (counters - extended[:-2]) % self.modulus
+        steps = numpy.where(after_backward & (resumed < self.modulus // 2), resumed, steps)
+
+        backward = steps >= self.modulus // 2
+        duplicate = steps == 0
+        packets = numpy.rint(steps / self.increment).astype(numpy.int64)
+        gap = ~backward & ~duplicate & (packets > 1)
+        lengths = numpy.where(backward, numpy.rint((self.modulus - steps) / self.increment).astype(numpy.int64), packets - 1)
+
+        frames = numpy.flatnonzero(gap | duplicate | backward)
+        lost_before = numpy.cumsum(numpy.where(gap, lengths, 0)) - numpy.where(gap, lengths, 0) + self.lost    # Lost up to each frame
+        events = numpy.empty(frames.size, dtype = EVENT_DTYPE)
+        events['frame'] = frames + self.num_frames
+        events['kind'] = numpy.where(gap[frames], GAP, numpy.where(duplicate[frames], DUPLICATE, BACKWARD))
+        events['length'] = numpy.where(duplicate[frames], 0, lengths[frames])
+        events['time'] = (events['frame'] + lost_before[frames]) / self.sampling_freq
+
+        # Lost packets per minute of the gap filled time line
+        gap_events = events[events['kind'] == GAP]
+        if gap_events.size:
+            minutes = (gap_events['time'] // 60).astype(numpy.int64)
+            if minutes[-1] >= self.loss_per_minute.size:
+                self.loss_per_minute = numpy.pad(self.loss_per_minute, (0, minutes[-1] + 1 - self.loss_per_minute.size))
+            numpy.add.at(self.loss_per_minute, minutes, gap_events['length'])
+            longest = int(numpy.argmax(gap_events['length']))
+            if gap_events['length'][longest] > self.longest[0]:
+                self.longest = (int(gap_events['length'][longest]), int(gap_events['frame'][longest]))
+
+        for kind, name in enumerate(EVENT_KINDS):
+            self.counts[name] += int((events['kind'] == kind).sum())
+        self.lost += int(gap_events['length'].sum())
+        if self.kept < self.max_events:
+            self.events.append(events[:self.max_events - self.kept])
+            self.kept += self.events[-1].size
+
+        self.last_values = extended[-2:].copy()
+        self.last_backward = bool(backward[-1])
+        self.num_frames += counters.size
+        return events
+
+    def report(self):
+        """Returns the PacketCounterReport of the counters checked so far."""
+        duration_minutes = int((self.num_frames + self.lost) / self.sampling_freq // 60) + 1
+        loss_per_minute = numpy.pad(self.loss_per_minute, (0, max(duration_minutes - self.loss_per_minute.size, 0)))
+        events = numpy.concatenate(self.events) if self.events else numpy.empty(0, dtype = EVENT_DTYPE)
+        return PacketCounterReport(self.num_frames, self.sampling_freq, events, dict(self.counts), self.lost, loss_per_minute,
+                                   self.longest, sum(self.counts.values()) > self.kept)
@@ -0,0 +1,373 @@
+"""Filtering engine for the MicroMAP readers.
+
+The filters are designed once as second order sections (SOS) and applied to all channels at once along the samples axis of a
+(channels, samples) array, in place and in chunks, so the only temporary memory is one chunk per call.
+
+Zero-phase filtering gives the same result as scipy.signal.sosfiltfilt (odd extension at both edges, initial conditions from
+sosfilt_zi): the forward pass goes through the chunks from the start carrying the filter state, and the backward pass goes through
+them from the end. Causal filtering is a single forward pass starting from rest.
+
+The streaming filters (HighpassFilter, LowpassFilter, BandpassFilter and NotchFilter) keep the filter state between calls, so a
+recording can be filtered chunk by chunk (offline or live in the plot threads) with the same result as filtering it in one call.
+StreamingResampler does the same for scipy.signal.resample_poly.
+"""
+import math
+import numpy
+from fractions import Fraction
+from scipy import signal
+import micromap_frames
+
+DEFAULT_CHUNK = 2**17                                                       # Samples per chunk (per channel)
+
+SAMPLING_FREQUENCIES = micromap_frames.SAMPLING_FREQUENCIES                 # Values of the acquisition settings (defined with the frame layouts,
+HIGHPASS_FREQUENCIES = micromap_frames.HIGHPASS_FREQUENCIES                 # so the interface does not need scipy to read them)
+LOWPASS_FREQUENCIES = micromap_frames.LOWPASS_FREQUENCIES
+
+def notch_sos(frequencies, sampling_freq, quality = 30):
+    """Returns the SOS of a cascade of IIR notch filters, one for each frequency (e.g. [60, 120, 180] for the line and its harmonics).
+    The -3 dB width of each notch is frequency / quality."""
+    frequencies = numpy.atleast_1d(frequencies)
+    if frequencies.size == 0:
+        raise ValueError("At least one notch frequency must be given.")
+    sections = []
+    for frequency in frequencies:
+        if not 0 < frequency < sampling_freq / 2:
+            raise ValueError(f"Notch frequency {frequency} Hz must be between 0 and the Nyquist frequency ({sampling_freq / 2} Hz).")
+        b, a = signal.iirnotch(frequency, quality, fs = sampling_freq)
+        sections.append(signal.tf2sos(b, a))
+    return numpy.concatenate(sections)
+
+def bandpass_sos(low, high, sampling_freq, order = 4):
+    """Returns the SOS of a Butterworth filter. low = None gives a low pass filter at high and high = None a high pass filter at low."""
+    if low is None and high is None:
+        raise ValueError("At least one of the cutoff frequencies must be given.")
+    if low is None:
+        return signal.butter(order, high, btype = 'lowpass', fs = sampling_freq, output = 'sos')
+    if high is None:
+        return signal.butter(order, low, btype = 'highpass', fs = sampling_freq, output = 'sos')
+    if not 0 < low < high < sampling_freq / 2:
+        raise ValueError(f"Invalid band {low}-{high} Hz (must be inside 0-{sampling_freq / 2} Hz).")
+    return signal.butter(order, [low, high], btype = 'bandpass', fs = sampling_freq, output = 'sos')
+
+def ringing_samples(sos, threshold = 1e-3, max_samples = 100000):
+    """Returns the length of the impulse response of the filter, up to the last sample above threshold * peak. It is used as the edge
+    padding of the zero-phase filtering, long enough for the low cutoff filters (the scipy default is only a few samples)."""
+    impulse = numpy.zeros(max_samples)
+    impulse[0] = 1
+    response = numpy.abs(signal.sosfilt(sos, impulse))
+    return int(numpy.flatnonzero(response > threshold * response.max())[-1]) + 1
+
+class SosFilter:
+    '''SOS filter
+
+    Applies a filter to (channels, samples) arrays in place, in chunks. Float32 data is filtered in float32 (the coefficients are cast
+    to the data type), float64 in float64.
+
+    Args:
+        sos (array): Second order sections (from notch_sos, bandpass_sos or scipy.signal).
+        zero_phase (bool): Forward and backward filtering (sosfiltfilt) or a single causal pass (sosfilt).
+        padlen (int): Samples of odd extension at each edge (zero-phase only). None uses the ringing length of the filter.
+
+    '''
+    def __init__(self, sos, zero_phase = True, padlen = None):
+        self.sos = numpy.atleast_2d(numpy.asarray(sos, dtype = numpy.float64))
+        self.zero_phase = zero_phase
+        self.padlen = ringing_samples(self.sos) if padlen is None and zero_phase else (padlen or 0)
+        self.zi = signal.sosfilt_zi(self.sos)                               # Steady state for a unit step, (sections, 2)
+
+    def _coefficients(self, dtype):
+        return self.sos.astype(dtype, copy = False), self.zi.astype(dtype, copy = False)
+
+    def apply(self, data, chunk_size = DEFAULT_CHUNK):
+        """Filters data (channels, samples) in place along axis 1 and returns it. data must be a float array (it can be a writable memmap)."""
+        if data.dtype not in (numpy.float32, numpy.float64):
+            raise TypeError(f"Only float32 and float64 data can be filtered in place, got {data.dtype}.")
+        squeeze = data.ndim == 1
+        if squeeze:
+            data = data[numpy.newaxis]
+
+        num_samples = data.shape[1]
+        if num_samples == 0:
+            return data[0] if squeeze else data
+        sos, zi = self._coefficients(data.dtype)
+        bounds = [(start, min(start + chunk_size, num_samples)) for start in range(0, num_samples, chunk_size)]
+
+        if not self.zero_phase:
+            state = numpy.zeros((sos.shape[0], data.shape[0], 2), dtype = data.dtype)
+            for start, stop in bounds:
+                data[:, start:stop], state = signal.sosfilt(sos, data[:, start:stop], axis = 1, zi = state)
+            return data[0] if squeeze else data
+
+        padlen = min(self.padlen, num_samples - 1)
+        first = data[:, :1].copy()
+        last = data[:, -1:].copy()
+        left = 2 * first - data[:, padlen:0:-1]                             # Odd extensions (as scipy.signal.odd_ext)
+        right = 2 * last - data[:, -2:-padlen - 2:-1]
+
+        # Forward pass: left extension, data (in place) and right extension
+        start_value = left[:, :1] if padlen > 0 else first
+        state = zi[:, numpy.newaxis, :] * start_value[numpy.newaxis]
+        if padlen > 0:
+            _, state = signal.sosfilt(sos, left, axis = 1, zi = state)
+        for start, stop in bounds:
+            data[:, start:stop], state = signal.sosfilt(sos, data[:, start:stop], axis = 1, zi = state)
+        if padlen > 0:
+            right, _ = signal.sosfilt(sos, right, axis = 1, zi = state)
+
+        # Backward pass: from the end of the right extension to the start of the data (the left extension is not needed)
+        end_value = right[:, -1:] if padlen > 0 else data[:, -1:]
+        state = zi[:, numpy.newaxis, :] * end_value[numpy.newaxis]
+        if padlen > 0:
+            _, state = signal.sosfilt(sos, right[:, ::-1], axis = 1, zi = state)
+        for start, stop in reversed(bounds):
+            filtered, state = signal.sosfilt(sos, data[:, start:stop][:, ::-1], axis = 1, zi = state)
+            data[:, start:stop] = filtered[:, ::-1]
+        return data[0] if squeeze else data
+
+class StreamingFilter:
+    '''Streaming filter
+
+    Causal SOS filter that keeps its state (zi) between calls. Filtering the chunks of a signal one after the other gives the same
+    result as scipy.signal.sosfilt over the whole signal, with O(chunk) memory and no artifacts at the chunk boundaries.
+
+    Args:
+        sos (array): Second order sections.
+        steady_start (bool): Starts the state in steady state for the first sample of the first chunk (as sosfilt_zi), instead of at
+            rest. Avoids the step response to the DC offset at the start of a live plot.
+
+    '''
+    def __init__(self, sos, steady_start = False):
+        self.sos = numpy.atleast_2d(numpy.asarray(sos, dtype = numpy.float64))
+        self.steady_start = steady_start
+        self.reset()
+
+    def reset(self):
+        self.state = None                                                   # (sections, channels, 2), created with the first chunk
+
+    def process(self, chunk):
+        """Filters a (channels, samples) chunk (or a 1D chunk of a single channel) and returns the filtered samples. Float32 chunks are
+        filtered in float32, anything else in float64."""
+        chunk = numpy.asarray(chunk)
+        dtype = numpy.float32 if chunk.dtype == numpy.float32 else numpy.float64
+        squeeze = chunk.ndim == 1
+        data = chunk.reshape(1, -1) if squeeze else chunk
+        data = data.astype(dtype, copy = False)
+
+        if self.state is None:
+            self.state = numpy.zeros((self.sos.shape[0], data.shape[0], 2))
+            if self.steady_start and data.shape[1] > 0:
+                self.state = signal.sosfilt_zi(self.sos)[:, numpy.newaxis, :] * data[numpy.newaxis, :, :1]
+        elif self.state.shape[1] != data.shape[0]:
+            raise ValueError(f"The filter was started with {self.state.shape[1]} channels, got {data.shape[0]}.")
+        if data.shape[1] == 0:
+            return chunk.astype(dtype, copy = False)
+
+        filtered, state = signal.sosfilt(self.sos.astype(dtype, copy = False), data, axis = 1, zi = self.state.astype(dtype, copy = False))
+        self.state = state
+        return filtered[0] if squeeze else filtered
+
+    @classmethod
+    def cascade(cls, *filters, steady_start = False):
+        """Returns a single streaming filter with the sections of all the given filters (e.g. a notch followed by a band pass)."""
+        return cls(numpy.concatenate([streaming.sos for streaming in filters]), steady_start)
+
+class HighpassFilter(StreamingFilter):
+    '''High pass filter
+
+    Streaming Butterworth high pass filter.
+
+    Args:
+        cutoff (number): Cutoff frequency in Hz (see HIGHPASS_FREQUENCIES for the values of the acquisition settings).
+        sampling_freq (number): Sampling frequency in Hz.
+        order (int): Filter order.
+
+    '''
+    def __init__(self, cutoff, sampling_freq, order = 4, steady_start = False):
+        super().__init__(bandpass_sos(cutoff, None, sampling_freq, order), steady_start)
+
+    @classmethod
+    def from_index(cls, slider_index, sampling_freq, **kwargs):
+        """Filter with the cutoff of the interface slider index (as acquisition.set_highpass_by_index)."""
+        return cls(HIGHPASS_FREQUENCIES[slider_index], sampling_freq, **kwargs)
+
+class LowpassFilter(StreamingFilter):
+    '''Low pass filter
+
+    Streaming Butterworth low pass filter.
+
+    Args:
+        cutoff (number): Cutoff frequency in Hz (see LOWPASS_FREQUENCIES for the values of the acquisition settings).
+        sampling_freq (number): Sampling frequency in Hz.
+        order (int): Filter order.
+
+    '''
+    def __init__(self, cutoff, sampling_freq, order = 4, steady_start = False):
+        super().__init__(bandpass_sos(None, cutoff, sampling_freq, order), steady_start)
+
+    @classmethod
+    def from_index(cls, slider_index, sampling_freq, **kwargs):
+        """Filter with the cutoff of the interface slider index (as acquisition.set_lowpass_by_index)."""
+        return cls(LOWPASS_FREQUENCIES[slider_index], sampling_freq, **kwargs)
+
+class BandpassFilter(StreamingFilter):
+    '''Band pass filter
+
+    Streaming Butterworth band pass filter. A low pass cutoff at or above the Nyquist frequency (e.g. the 20 kHz setting of the chip
+    at a low sampling rate) gives a high pass filter only. A high pass cutoff at or above the Nyquist frequency raises a ValueError
+    (see applies).
+
+    Args:
+        low, high (number): Cutoff frequencies in Hz.
+        sampling_freq (number): Sampling frequency in Hz.
+        order (int): Filter order.
+
+    '''
+    def __init__(self, low, high, sampling_freq, order = 4, steady_start = False):
+        if not self.applies(low, high, sampling_freq):
+            raise ValueError(f"No cutoff frequency of {low}-{high} Hz is below the Nyquist frequency ({sampling_freq / 2} Hz).")
+        if high is not None and high >= sampling_freq / 2:
+            high = None
+        super().__init__(bandpass_sos(low, high, sampling_freq, order), steady_start)
+
+    @staticmethod
+    def applies(low, high, sampling_freq):
+        """Returns True if the filter can be built: the high pass cutoff (if any) is below the Nyquist frequency, and some cutoff is."""
+        if low is not None:
+            return low < sampling_freq / 2
+        return high is not None and high < sampling_freq / 2
+
+    @classmethod
+    def from_settings(cls, options, **kwargs):
+        """Filter with the high pass and low pass cutoffs and the sampling frequency of the acquisition settings (acquisition object)."""
+        return cls(options.highpass, options.lowpass, options.sampling_frequency, **kwargs)
+
+class NotchFilter(StreamingFilter):
+    '''Notch filter
+
+    Streaming IIR notch filter of the line frequency and its harmonics.
+
+    Args:
+        frequency (number): Line frequency in Hz (50 or 60).
+        sampling_freq (number): Sampling frequency in Hz.
+        harmonics (int): Number of frequencies removed (1 = only the line frequency, 3 = frequency, 2 * frequency and 3 * frequency).
+            Harmonics above the Nyquist frequency are skipped (a ValueError is raised if none is left, see applies).
+        quality (number): Quality factor of each notch (width = frequency / quality).
+
+    '''
+    def __init__(self, frequency, sampling_freq, harmonics = 1, quality = 30, steady_start = False):
+        frequencies = frequency * numpy.arange(1, harmonics + 1)
+        self.frequencies = frequencies[frequencies < sampling_freq / 2]
+        if self.frequencies.size == 0:
+            raise ValueError(f"The notch frequency {frequency} Hz is not below the Nyquist frequency ({sampling_freq / 2} Hz).")
+        super().__init__(notch_sos(self.frequencies, sampling_freq, quality), steady_start)
+
+    @staticmethod
+    def applies(frequency, sampling_freq):
+        """Returns True if the line frequency is below the Nyquist frequency (the filter removes at least one frequency)."""
+        return 0 < frequency < sampling_freq / 2
+
+def rate_ratio(new_rate, sampling_freq, max_denominator = 1000, exact = True):
+    """Returns (up, down) of the resampling from sampling_freq to new_rate (reduced fraction, e.g. 30000 -> 1000 gives (1, 30)). With
+    exact = True a ValueError is raised when the fraction does not give new_rate (sampling_freq * up / down != new_rate), instead of
+    resampling to a slightly different rate."""
+    ratio = Fraction(new_rate).limit_denominator(max_denominator) / Fraction(sampling_freq).limit_denominator(max_denominator)
+    ratio = ratio.limit_denominator(max_denominator)
+    if exact and not math.isclose(sampling_freq * ratio.numerator / ratio.denominator, new_rate, rel_tol = 1e-9):
+        raise ValueError(f"{sampling_freq} Hz -> {new_rate} Hz cannot be resampled exactly with up and down factors up to "
+                         f"{max_denominator} (the nearest rate is {sampling_freq * ratio.numerator / ratio.denominator} Hz).")
+    return ratio.numerator, ratio.denominator
+
+class StreamingResampler:
+    '''Streaming resampler
+
+    Rational polyphase resampling (up / down) of (channels, samples) chunks with the same output as scipy.signal.resample_poly over the
+    whole signal (same Kaiser windowed FIR filter and zero padding at the edges). The input samples still needed by the filter are kept
+    between calls, so the memory is O(chunk + filter length) and all channels are resampled in one upfirdn call per chunk.
+
+    Args:
+        up, down (int): Resampling factors (new rate = rate * up / down). They are reduced by their greatest common divisor.
+        window: FIR window (as resample_poly).
+
+    Ex: 30 kHz -> 1 kHz with up = 1 and down = 30; process() each chunk and flush() at the end.
+
+    '''
+    def __init__(self, up, down, window = ('kaiser', 5.0)):
+        divisor = math.gcd(int(up), int(down))
+        self.up = int(up) // divisor
+        self.down = int(down) // divisor
+        if self.up == self.down:                                            # Same rate: the output is a copy of the input
+            half_len, taps = 0, numpy.ones(1)
+        else:
+            half_len = 10 * max(self.up, self.down)
+            taps = signal.firwin(2 * half_len + 1, 1 / max(self.up, self.down), window = window) * self.up
+        pre_pad = self.down - half_len % self.down
+        self.h = numpy.concatenate((numpy.zeros(pre_pad), taps))            # Output samples at the center of the filter (as resample_poly)
+
+        # The stream starts with zero_pad zeros (a multiple of down, longer than the filter), so the first window never starts before the
+        # start of the buffer and the output phase of upfirdn is always aligned with the output samples.
+        self.zero_pad = self.down * (len(self.h) // (self.up * self.down) + 1)
+        self.delay = (half_len + pre_pad) // self.down + self.zero_pad * self.up // self.down   # Output samples removed at the start
+        self.reset()
+
+    def reset(self):
+        self.buffer = None                                                  # Input samples still needed by the filter
+        self.buffer_start = 0                                               # Index of the first sample of the buffer (with the zero pad)
+        self.samples_in = 0                                                 # Input samples received
+        self.samples_out = 0                                                # Output samples returned
+
+    def _append(self, chunk):
+        if self.buffer is None:
+            self.buffer = numpy.zeros((chunk.shape[0], self.zero_pad), dtype = chunk.dtype)
+        self.buffer = numpy.concatenate((self.buffer, chunk), axis = 1)
+
+    def _output(self, end):
+        """Returns the output samples from samples_out to end (all the input samples they depend on are in the buffer)."""
+        if end <= self.samples_out:
+            return numpy.empty((self.buffer.shape[0], 0), dtype = self.buffer.dtype)
+
+        first = ((self.samples_out + self.delay) * self.down - len(self.h) + 1) // self.up
+        first = (first // self.down) * self.down                           # Window starts at a multiple of down (aligned output phase)
+        last = ((end - 1 + self.delay) * self.down) // self.up + 1
+        window = self.buffer[:, first - self.buffer_start:last - self.buffer_start]
+        h = self.h.astype(window.dtype) if window.dtype == numpy.float32 else self.h
+        filtered = signal.upfirdn(h, window, self.up, self.down, axis = 1)
+
+        shift = first * self.up // self.down
+        output = filtered[:, self.samples_out + self.delay - shift:end + self.delay - shift]
+        self.samples_out = end
+
+        keep = ((end + self.delay) * self.down - len(self.h) + 1) // self.up  # Drops the samples no longer needed
+        keep = (keep // self.down) * self.down
+        if keep > self.buffer_start:
+            self.buffer = self.buffer[:, keep - self.buffer_start:]
+            self.buffer_start = keep
+        return output
+
+    def process(self, chunk):
+        """Resamples a (channels, samples) chunk and returns the output samples that are already complete. Float32 chunks are resampled in
+        float32, anything else in float64."""
+        chunk = numpy.asarray(chunk)
+        chunk = chunk.astype(numpy.float32 if chunk.dtype == numpy.float32 else numpy.float64, copy = False)
+        self._append(chunk)
+        self.samples_in += chunk.shape[1]
+        available = self.zero_pad + self.samples_in
+        return self._output(max(self.samples_out, (available * self.up - 1) // self.down - self.delay + 1))
+
+    def flush(self):
+        """Returns the last output samples (the input is zero padded after the end, as resample_poly) and resets the resampler."""
+        if self.buffer is None:
+            return None
+        total = self.samples_in * self.up
+        total = total // self.down + bool(total % self.down)                # Output length of resample_poly
+        self._append(numpy.zeros((self.buffer.shape[0], len(self.h) // self.up + self.down + 1), dtype = self.buffer.dtype))
+        output = self._output(total)
+        self.reset()
+        return output
+
+def resample_array(data, up, down, chunk_size = DEFAULT_CHUNK):
+    """Resamples a whole (channels, samples) array with a StreamingResampler, chunk by chunk (same output as scipy.signal.resample_poly
+    with bounded temporary memory). Module level so it can be sent to the worker processes of micromap_parallel."""
+    resampler = StreamingResampler(up, down)
+    blocks = [resampler.process(data[:, start:start + chunk_size]) for start in range(0, data.shape[1], chunk_size)]
+    blocks.append(resampler.flush())
+    return numpy.concatenate([block for block in blocks if block is not None], axis = 1)
@@ -0,0 +1,283 @@
+"""MicroMAP recording container.
+
+A recording is a single self-describing file:
+
+    [header]    fixed size (HEADER_SIZE bytes): chip, sampling rate, channel list, scaling and frame layout
+    [data]      frames exactly as they come from the microcontroller, written block by block during the acquisition
+    [index]     one entry per data block: byte offset of the block, first (folded) counter and host timestamp
+    [trailer]   fixed size: position and number of entries of the index
+
+The index and the trailer are written when the recording is closed. If the acquisition is interrupted before that, the data is still
+readable (the frames go up to the end of the file) and only the seek index is missing.
+
+Files without the header (the old headerless .mmap + _metadata.pkl recordings) are detected with is_recording_file.
+"""
+import os
+import struct
+import time
+import numpy
+
+MAGIC = b'MICROMAP'
+FORMAT_VERSION = 1
+HEADER_SIZE = 512
+MAX_CHANNELS = 32
+
+INDEX_MAGIC = b'MMAPINDX'
+INDEX_DTYPE = numpy.dtype([('offset', '<u8'), ('counter', '<u8'), ('timestamp', '<f8')])
+
+# magic, version, header size, chip, method, sampling frequency, high pass, low pass, scale, counter type, sample format, status bytes,
+# number of channels, frame size, index period, start time, channels
+_HEADER_STRUCT = struct.Struct('<8sHH16s16sddddB2sBBHId32s')
+_TRAILER_STRUCT = struct.Struct('<8sQQ')
+
+_COUNTER_TYPES = {0: None, 1: 'n', 2: 'us'}
+_COUNTER_CODES = {value: key for key, value in _COUNTER_TYPES.items()}
+_SAMPLE_BYTES = {'i2': 2, 'i3': 3, 'f4': 4}
+
+def is_recording_file(path):
+    """Returns True if the file starts with the MicroMAP container header."""
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+class RecordingHeader:
+    '''Recording header
+
+    Describes a recording and the layout of its frames.
+
+    Args:
+        chip (string): ADC chip ("RHD2132", "RHD2216" or "ADS1298").
+        sampling_freq (number): Sampling frequency in Hz.
+        channels (number list): Recorded channels (1 to 32).
+        scale (float): µV per bit of the samples.
+        counter_type (string): 'n' (16 bits packet counter), 'us' (32 bits timestamp) or None (no counter).
+        sample_format (string): 'i2' (little endian int16), 'i3' (big endian 24 bits) or 'f4' (little endian float32).
+        status_bytes (int): Bytes of status word after the counter (3 for the ADS1298).
+        highpass, lowpass (number): Filter cutoff frequencies configured in the chip.
+        method (string): Acquisition method.
+        index_period (int): Number of frames between index entries (informative, usually the receiver packet size).
+        start_time (float): Host time (seconds since epoch) of the start of the recording.
+
+    '''
+    def __init__(self, chip, sampling_freq, channels, scale, counter_type = 'n', sample_format = 'i2', status_bytes = 0,
+                 highpass = 0, lowpass = 0, method = "ARDUINO", index_period = 0, start_time = None):
+        if counter_type not in _COUNTER_CODES:
+            raise ValueError("Invalid counter type. Use 'n', 'us' or None.")
+        if sample_format not in _SAMPLE_BYTES:
+            raise ValueError("Invalid sample format. Use 'i2', 'i3' or 'f4'.")
+        if len(channels) == 0 or len(channels) > MAX_CHANNELS:
+            raise ValueError(f"The number of channels must be between 1 and {MAX_CHANNELS}.")
+
+        self.version = FORMAT_VERSION
+        self.chip = chip
+        self.method = method
+        self.sampling_freq = sampling_freq
+        self.highpass = highpass
+        self.lowpass = lowpass
+        self.scale = scale
+        self.counter_type = counter_type
+        self.sample_format = sample_format
+        self.status_bytes = status_bytes
+        self.channels = [int(channel) for channel in channels]
+        self.num_channels = len(self.channels)
+        self.index_period = index_period
+        self.start_time = time.time() if start_time is None else start_time
+
+    @property
+    def counter_bytes(self):
+        return {None: 0, 'n': 2, 'us': 4}[self.counter_type]
+
+    @property
+    def frame_size(self):
+        return self.counter_bytes + self.status_bytes + _SAMPLE_BYTES[self.sample_format] * self.num_channels
+
+    def frame_dtype(self):
+        """Returns the structured dtype of one frame. 24 bits samples are kept as raw bytes ('samples' with shape (channels, 3))."""
+        fields = []
+        if self.counter_type == 'n':
+            fields.append(('counter', '>u2'))
+        elif self.counter_type == 'us':
+            fields += [('counter_high', '<u2'), ('counter_low', '<u2')]
+        if self.status_bytes > 0:
+            fields.append(('status', 'u1', (self.status_bytes,)))
+        if self.sample_format == 'i3':
+            fields.append(('samples', 'u1', (self.num_channels, 3)))
+        else:
+            fields.append(('samples', '<' + self.sample_format, (self.num_channels,)))
+        return numpy.dtype(fields)
+
+    def to_dict(self):
+        """Returns the header as a dictionary with the keys of the old _metadata.pkl file (acquisition.resume_options)."""
+        return {"Method": self.method,
+                "Chip": self.chip,
+                "Sampling Frequency": self.sampling_freq,
+                "High Pass Filter": self.highpass,
+                "Low Pass Filter": self.lowpass,
+                "Number of Channels": self.num_channels,
+                "Channels": self.channels,
+                "Scale": self.scale,
+                "Counter Type": self.counter_type,
+                "Sample Format": self.sample_format,
+                "Start Time": self.start_time}
+
+    @classmethod
+    def from_metadata(cls, metadata, sampling_freq, channels, scale = 1.0, counter_type = 'n', sample_format = 'f4', index_period = 0):
+        """Returns a header for data derived from a recording (resampled, filtered...), keeping the chip, method and filter settings of
+        its metadata (the dictionary of to_dict or of the old _metadata.pkl file)."""
+        return cls(metadata.get("Chip", "RHD2132"), sampling_freq, channels, scale, counter_type, sample_format,
+                   highpass = metadata.get("High Pass Filter", 0), lowpass = metadata.get("Low Pass Filter", 0),
+                   method = metadata.get("Method", "ARDUINO"), index_period = index_period, start_time = metadata.get("Start Time"))
+
+    def pack(self):
+        channels = bytes(self.channels) + bytes(MAX_CHANNELS - self.num_channels)
+        header = _HEADER_STRUCT.pack(MAGIC, self.version, HEADER_SIZE, self.chip.encode()[:16], self.method.encode()[:16],
+                                     self.sampling_freq, self.highpass, self.lowpass, self.scale, _COUNTER_CODES[self.counter_type],
+                                     self.sample_format.encode(), self.status_bytes, self.num_channels, self.frame_size,
+                                     self.index_period, self.start_time, channels)
+        return header + bytes(HEADER_SIZE - len(header))
+
+    @classmethod
+    def unpack(cls, buffer):
+        (magic, version, header_size, chip, method, sampling_freq, highpass, lowpass, scale, counter_code, sample_format, status_bytes,
+         num_channels, frame_size, index_period, start_time, channels) = _HEADER_STRUCT.unpack_from(buffer)
+
+        if magic != MAGIC:
+            raise ValueError("Not a MicroMAP recording (invalid header).")
+        if version > FORMAT_VERSION:
+            raise ValueError(f"Recording format version {version} is not supported (up to {FORMAT_VERSION}).")
+
+        if sampling_freq.is_integer():
+            sampling_freq = int(sampling_freq)                              # Integer rates are kept as int (as in the acquisition settings)
+
+        header = cls(chip.rstrip(b'\x00').decode(), sampling_freq, list(channels[:num_channels]), scale, _COUNTER_TYPES[counter_code],
+                     sample_format.decode(), status_bytes, highpass, lowpass, method.rstrip(b'\x00').decode(), index_period, start_time)
+        header.version = version
+        if header.frame_size != frame_size:
+            raise ValueError("Corrupted header: frame size does not match the frame layout.")
+        return header
+
+class RecordingWriter:
+    '''Recording writer
+
+    Writes a recording container: the header when it is opened, the data blocks as they arrive (each block gets an index entry) and the
+    index and the trailer when it is closed.
+
+    Args:
+        path (string): File to write.
+        header (RecordingHeader): Description of the recording.
+
+    '''
+    def __init__(self, path, header):
+        self.path = path
+        self.header = header
+        self.file = open(path, 'wb')
+        self.file.write(header.pack())
+        self.position = HEADER_SIZE                                         # Byte offset of the next block
+        self.frames_written = 0
+        self.index = []
+
+    def _first_counter(self, block):
+        if self.header.counter_type == 'n':
+            return int.from_bytes(block[0:2], byteorder = 'big')
+        elif self.header.counter_type == 'us':
+            return (int.from_bytes(block[0:2], byteorder = 'little') << 16) | int.from_bytes(block[2:4], byteorder = 'little')
+        return self.frames_written                                          # No counter: frame number
+
+    def write_block(self, block, timestamp = None):
+        '''Write block
+
+        Appends a block of whole frames (bytes-like) and adds its index entry.
+
+        Args:
+            block: Frames to write.
+            timestamp (float): Host time of the block (default: now).
+
+        '''
+        if len(block) == 0:
+            return
+        self.index.append((self.position, self._first_counter(block), time.time() if timestamp is None else timestamp))
+        self.file.write(block)
+        self.position += len(block)
+        self.frames_written += len(block) // self.header.frame_size
+
+    def write_samples(self, samples, timestamp = None):
+        '''Write samples
+
+        Builds the frames of a (channels, samples) array and writes them as a block. The packet counter ('n') is sequential from the
+        first frame of the file, so the data has no gaps; 'us' timestamps are not generated.
+
+        Args:
+            samples: (channels, samples) array, converted to the sample format of the header ('i2' or 'f4').
+            timestamp (float): Host time of the block (default: now).
+
+        '''
+        if self.header.counter_type == 'us' or self.header.sample_format == 'i3':
+            raise ValueError("write_samples only builds frames with the 'n' counter (or no counter) and 'i2' or 'f4' samples.")
+        frames = numpy.empty(samples.shape[1], dtype = self.header.frame_dtype())
+        if self.header.counter_type == 'n':
+            frames['counter'] = (self.frames_written + numpy.arange(samples.shape[1])) % 2**16
+        frames['samples'] = samples.T
+        self.write_block(frames.tobytes(), timestamp)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        '''Close
+
+        Writes the index and the trailer and closes the file.
+        '''
+        if self.file.closed:
+            return
+        index = numpy.array(self.index, dtype = INDEX_DTYPE)
+        self.file.write(index.tobytes())
+        self.file.write(_TRAILER_STRUCT.pack(INDEX_MAGIC, self.position, len(index)))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class RecordingFile:
+    '''Recording file
+
+    Parses a recording container without reading the data: the fixed header at the start, the trailer at the end and the index (when the
+    recording was closed properly). Opening is O(1) whatever the file size.
+
+    Attributes:
+        header (RecordingHeader): Description of the recording.
+        data_offset (int): Byte offset of the first frame.
+        num_frames (int): Number of complete frames.
+        index: Structured array (offset, counter, timestamp), one entry per data block, or None if the index is missing.
+
+    '''
+    def __init__(self, path):
+        self.path = path
+        file_size = os.path.getsize(path)
+
+        with open(path, 'rb') as f:
+            self.header = RecordingHeader.unpack(f.read(HEADER_SIZE))
+            self.data_offset = HEADER_SIZE
+            data_end = file_size
+            self.index = None
+
+            if file_size >= HEADER_SIZE + _TRAILER_STRUCT.size:
+                f.seek(file_size - _TRAILER_STRUCT.size)
+                magic, index_offset, entries = _TRAILER_STRUCT.unpack(f.read(_TRAILER_STRUCT.size))
+                if magic == INDEX_MAGIC and index_offset + entries * INDEX_DTYPE.itemsize + _TRAILER_STRUCT.size == file_size:
+                    data_end = index_offset
+                    f.seek(index_offset)
+                    self.index = numpy.frombuffer(f.read(entries * INDEX_DTYPE.itemsize), dtype = INDEX_DTYPE)
+
+        self.num_frames = (data_end - self.data_offset) // self.header.frame_size
+
+    def memmap(self):
+        """Returns the frames as a read-only structured numpy.memmap (see RecordingHeader.frame_dtype)."""
+        return numpy.memmap(self.path, dtype = self.header.frame_dtype(), mode = 'r', offset = self.data_offset, shape = (self.num_frames,))
+
+    def block_frames(self):
+        """Returns the index of the first frame of each data block (from the byte offsets of the index)."""
+        if self.index is None:
+            return None
+        return (self.index['offset'].astype(numpy.int64) - self.data_offset) // self.header.frame_size
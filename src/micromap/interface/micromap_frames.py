@@ -0,0 +1,313 @@
+"""Frame layouts and decoding helpers shared by the MicroMAP readers and the acquisition threads.
+
+This module only depends on numpy, so it can be imported by the interface running on the Raspberry Pi without
+pulling the analysis stack used by the readers.
+"""
+import numpy
+
+INTAN_SCALE = 0.195                                                         # Intan RHD scaling (µV per bit)
+ADS_HEADER_BYTES = 3                                                        # ADS1298 status word (24 bits) at the start of every frame
+ADS_SCALE = 4 / (12 * ((2 ** 23) - 1)) * 1e6                                # ADS1298 scaling (µV per bit, Vref = 4 V and PGA gain = 12)
+ADS_STATUS_PREFIX = 0xC                                                     # The ADS1298 status word starts with 1100 (top nibble of its first byte)
+ADS_TEST_STATUS = 0xAA                                                      # Status bytes sent by the firmware in data test mode (0xAAAAAA)
+
+SAMPLING_FREQUENCIES = [1, 100, 500, 1000, 2000, 5000, 10000, 20000, 30000]                 # Possible values of sampling frequency (Hz)
+HIGHPASS_FREQUENCIES = [0.1, 0.25, 0.3, 0.5, 0.75, 1, 1.5, 2, 2.5, 3, 5, 7.5,
+                        10, 15, 20, 25, 30, 50, 75, 100, 150, 200, 250, 300, 500]          # Possible values of high pass cutoff frequency (Hz)
+LOWPASS_FREQUENCIES = [100, 150, 200, 250, 300, 500, 750, 1000, 1500,
+                       2000, 2500, 3000, 5000, 7500, 10000, 15000, 20000]                   # Possible values of low pass cutoff frequency (Hz)
+
+def rhd_frame_dtype(num_channels, counter_type = 'n'):
+    """Returns the structured dtype of one RHD frame as it is written in the .mmap file.
+
+    'n'  -> big endian uint16 packet counter + num_channels little endian int16 samples
+    'us' -> 4 bytes timestamp (two little endian uint16 words, high word first) + num_channels little endian int16 samples
+    """
+    if counter_type == 'n':
+        return numpy.dtype([('counter', '>u2'), ('samples', '<i2', (num_channels,))])
+    elif counter_type == 'us':
+        return numpy.dtype([('counter_high', '<u2'), ('counter_low', '<u2'), ('samples', '<i2', (num_channels,))])
+    else:
+        raise ValueError("Invalid counter type. Use 'us' for unsigned or 'n' for normal.")
+
+def rhd_frame_counters(frames, counter_type = 'n'):
+    """Returns the packet counters of a structured array of RHD frames (a view for 'n', the combined 32 bits timestamp for 'us')."""
+    if counter_type == 'n':
+        return frames['counter']
+    high = frames['counter_high'].astype(numpy.uint64)
+    low = frames['counter_low'].astype(numpy.uint64)
+    return (high << numpy.uint64(16)) | low
+
+class CounterUnfolder:
+    """Unfolds the packet counters. The counter resets to 0 after reaching max_value, so every time a value is smaller than the previous one a
+    rollover is counted and the real incremental value is counter + rollovers * (max_value + 1). The rollovers are found with a diff/cumsum over
+    the whole chunk, and the last value and the rollover count are carried between calls, so a long recording can be unfolded in a stream.
+
+    Ex: (if the counter is 0-255) [0, 1, 2, ..., 254, 255, 0, 1, 2, ...] -> [0, 1, 2, ..., 254, 255, 256, 257, ...]
+
+    Use max_value = 2^16 - 1 for the 16 bits packet counter ('n') and 2^32 - 1 for the microseconds timestamp ('us').
+    """
+    def __init__(self, max_value = 2**16 - 1):
+        self.max_value = int(max_value)
+        self.reset()
+
+    def reset(self):
+        self.last_value = None                                              # Last folded value of the previous chunk
+        self.rollovers = 0                                                  # Rollovers counted up to the end of the previous chunk
+
+    def unfold(self, counter_chunk):
+        counter_chunk = numpy.asarray(counter_chunk).astype(numpy.int64, copy = False)
+        if counter_chunk.size == 0:
+            return numpy.empty(0, dtype = numpy.int64)
+
+        list_max = counter_chunk.max()
+        list_min = counter_chunk.min()
+        if list_max > self.max_value or list_min < 0:
+            raise ValueError(f"Counter values out of bounds (0 to {self.max_value}), got {list_min} to {list_max}.")
+
+        wraps = numpy.empty(counter_chunk.size, dtype = numpy.int64)
+        wraps[0] = self.last_value is not None and counter_chunk[0] < self.last_value
+        numpy.less(counter_chunk[1:], counter_chunk[:-1], out = wraps[1:])
+        rollovers = numpy.cumsum(wraps, out = wraps)
+        rollovers += self.rollovers
+
+        self.last_value = int(counter_chunk[-1])
+        self.rollovers = int(rollovers[-1])
+
+        rollovers *= self.max_value + 1
+        rollovers += counter_chunk
+        return rollovers
+
+def fill_gaps(data, counters, fill_method = 'last'):
+    """Fills the samples lost between received packets. If the difference between two consecutive unfolded counters is greater than 1, the
+    packets in between were lost and the samples after them would be shifted in time. The output length is computed from the counters, the
+    output is allocated once, the received samples are scattered into place and the gaps are filled in bulk with:
+
+        'last'   -> the last received value
+        'nan'    -> NaN (the output is promoted to float)
+        'linear' -> linear interpolation between the samples around the gap (rounded for integer data)
+
+    Repeated or backwards counters are kept as they are (no gap). When nothing was lost, data is returned without a copy.
+
+    Args:
+        data: (channels, samples) array of received samples.
+        counters: unfolded packet counter of each received sample.
+        fill_method: 'last', 'nan' or 'linear'.
+
+    Returns:
+        filled_data, filled_counters and the gap table, an (n_gaps, 2) int64 array of (start, length) in output samples.
+    """
+    if fill_method not in ('last', 'nan', 'linear'):
+        raise ValueError("Invalid fill method. Use 'last', 'nan' or 'linear'.")
+
+    counters = numpy.asarray(counters).astype(numpy.int64, copy = False)
+    steps = numpy.diff(counters)                                            # Counter increment between consecutive samples
+    steps -= 1                                                              # Samples lost between consecutive samples
+    numpy.maximum(steps, 0, out = steps)
+
+    gap_index = numpy.flatnonzero(steps)
+    if gap_index.size == 0:
+        return data, counters, numpy.empty((0, 2), dtype = numpy.int64)
+
+    positions = numpy.zeros(counters.size, dtype = numpy.int64)             # Output position of each received sample
+    numpy.cumsum(steps + 1, out = positions[1:])
+    total = int(positions[-1]) + 1
+    gaps = numpy.column_stack((positions[gap_index] + 1, steps[gap_index]))
+
+    repeats = steps + 1
+    source = numpy.repeat(numpy.arange(counters.size - 1), repeats)         # Last received sample before each output sample
+    source = numpy.append(source, counters.size - 1)
+    offset = numpy.arange(total, dtype = numpy.int64)
+    offset -= positions[source]                                             # Distance to the last received sample (0 for received samples)
+    filled_counters = counters[source] + offset
+
+    if fill_method == 'last':
+        filled_data = numpy.empty((data.shape[0], total), dtype = data.dtype)
+        numpy.take(data, source, axis = 1, out = filled_data)
+        return filled_data, filled_counters, gaps
+
+    dtype = data.dtype if fill_method == 'linear' else numpy.result_type(data.dtype, numpy.float32)
+    filled_data = numpy.empty((data.shape[0], total), dtype = dtype)
+    filled_data[:, positions] = data
+
+    missing = numpy.flatnonzero(offset)
+    if fill_method == 'nan':
+        filled_data[:, missing] = numpy.nan
+    else:
+        left = source[missing]
+        weight = offset[missing] / (positions[left + 1] - positions[left])
+        start = data[:, left].astype(numpy.float64)                         # float64: the difference of two int16 codes can overflow
+        interpolated = data[:, left + 1] - start
+        interpolated *= weight
+        interpolated += start
+        if numpy.issubdtype(dtype, numpy.integer):
+            numpy.rint(interpolated, out = interpolated)
+        filled_data[:, missing] = interpolated
+
+    return filled_data, filled_counters, gaps
+
+def ads_frame_size(num_channels, header_bytes = ADS_HEADER_BYTES):
+    """Returns the size in bytes of one ADS1298 frame (status word + 3 bytes per channel)."""
+    return header_bytes + 3 * num_channels
+
+def decode_int24(buffer, num_channels, header_bytes = ADS_HEADER_BYTES):
+    """Decodes the 24 bits big endian two's complement samples of whole ADS1298 frames, without a Python loop per value.
+
+    The 3 bytes of each sample are copied (reversed) into the upper bytes of a little endian int32 and an arithmetic shift right by 8 bits
+    does the sign extension. Bytes after the last complete frame are ignored.
+
+    Args:
+        buffer: bytes-like object or uint8 array (e.g. a numpy.memmap of the file) holding whole frames.
+        num_channels: number of channels in each frame.
+        header_bytes: bytes at the start of each frame that are not samples (status word).
+
+    Returns:
+        (frames, channels) int32 array.
+    """
+    if isinstance(buffer, numpy.ndarray):
+        raw = buffer.reshape(-1).view(numpy.uint8)
+    else:
+        raw = numpy.frombuffer(buffer, dtype = numpy.uint8)
+
+    frame_size = ads_frame_size(num_channels, header_bytes)
+    num_frames = raw.size // frame_size
+    samples = raw[:num_frames * frame_size].reshape(num_frames, frame_size)[:, header_bytes:].reshape(num_frames, num_channels, 3)
+
+    words = numpy.zeros((num_frames, num_channels, 4), dtype = numpy.uint8)
+    words[..., 1:] = samples[..., ::-1]                                     # [0, LSB, MID, MSB] -> MSB << 24 | MID << 16 | LSB << 8
+    values = words.view('<i4')[..., 0]
+    values >>= 8                                                            # Arithmetic shift (sign extension)
+    return values
+
+class Int24StreamDecoder:
+    """Streaming version of decode_int24. It accepts byte chunks of any size (as they come from the USB port) and carries the bytes of an
+    incomplete frame to the next call, so the frames are always decoded aligned.
+    """
+    def __init__(self, num_channels, header_bytes = ADS_HEADER_BYTES):
+        self.num_channels = num_channels
+        self.header_bytes = header_bytes
+        self.frame_size = ads_frame_size(num_channels, header_bytes)
+        self.remainder = bytearray()                                        # Bytes of the last incomplete frame
+
+    def reset(self):
+        self.remainder = bytearray()
+
+    def decode(self, chunk):
+        """Returns the (frames, channels) int32 samples of all complete frames received so far."""
+        if len(self.remainder) > 0:
+            self.remainder += chunk
+            data = self.remainder
+        else:
+            data = chunk
+
+        complete = (len(data) // self.frame_size) * self.frame_size
+        values = decode_int24(memoryview(data)[:complete], self.num_channels, self.header_bytes)
+        self.remainder = bytearray(memoryview(data)[complete:])
+        return values
+
+def ads_valid_status(first, second, third):
+    """Returns True where three status bytes (uint8 arrays) are a valid ADS1298 status word: 1100 in the top nibble of the first byte, or
+    the 0xAAAAAA word of the firmware test mode."""
+    test = (first == ADS_TEST_STATUS) & (second == ADS_TEST_STATUS) & (third == ADS_TEST_STATUS)
+    return ((first >> 4) == ADS_STATUS_PREFIX) | test
+
+class AdsFrameValidator:
+    """Checks the status word of every ADS1298 frame of the acquisition stream and keeps the frames aligned. The ADS frames have no counter,
+    so a lost or extra byte shifts every frame after it: the status words of all the frames of a chunk are checked at once (strided view)
+    and, at the first invalid one, the stream is scanned for the next position where at least `confirm` consecutive frames have a valid
+    status word (all the positions of a frame are tested at once and the one with the longest run is taken). The bytes in between are
+    discarded and counted as dropped frames, rounded up to whole frames. Frames lost whole (a multiple of the frame size) can not be seen
+    without a counter, and a frame that lost bytes at its end is only detected by the next one.
+
+    Ex:
+        validator = AdsFrameValidator(8)
+        frames = validator.process(packet)                                  # Whole valid frames (the packet itself when nothing is wrong)
+        validator.dropped, validator.misalignments
+    """
+    def __init__(self, num_channels, header_bytes = ADS_HEADER_BYTES, confirm = 4, search_frames = 64, max_events = 100000):
+        if header_bytes < 3:
+            raise ValueError("The ADS1298 frames need the 3 bytes of the status word.")
+        self.frame_size = ads_frame_size(num_channels, header_bytes)
+        self.confirm = max(1, int(confirm))
+        self.search_frames = max(self.confirm, int(search_frames))
+        self.max_pending = (self.search_frames + 1) * self.frame_size        # Most bytes kept between calls (the output can be this much longer than the input)
+        self.max_events = max_events
+        self.reset()
+
+    def reset(self):
+        self.pending = bytearray()                                          # Bytes of an incomplete frame or of a search that needs more data
+        self.synced = False                                                 # The stream starts with a search (usually found at the first byte)
+        self.skipped = 0                                                    # Bytes discarded since the stream lost the alignment
+        self.frames = 0                                                     # Valid frames returned
+        self.dropped = 0                                                    # Frames discarded (rounded up from the discarded bytes)
+        self.misalignments = 0
+        self.events = []                                                    # (index of the first frame after the resync, frames dropped)
+
+    def _search(self, raw, start):
+        """Returns the position from start where the longest run of valid status words begins (at least confirm frames, compared over
+        search_frames frames, so a data byte that looks like a status word for a few frames is not taken), or the position where the search
+        must continue with more data."""
+        valid = ads_valid_status(raw[start:raw.size - 2], raw[start + 1:raw.size - 1], raw[start + 2:])
+        candidates = numpy.flatnonzero(valid)
+        offset = 0
+        while True:
+            following = candidates[numpy.searchsorted(candidates, offset):]
+            if following.size == 0:                                         # Nothing looks like a status word: waits after the last bytes
+                return None, start + valid.size
+            offset = int(following[0])
+            if (valid.size - offset) // self.frame_size < self.search_frames:
+                return None, start + offset                                 # Decides with search_frames frames (same result for any chunk size)
+            grid = valid[offset:offset + self.search_frames * self.frame_size].reshape(self.search_frames, self.frame_size)  # One column per phase
+            runs = numpy.where(grid.all(axis = 0), self.search_frames, grid.argmin(axis = 0))                 # Valid frames in a row from each position
+            best = int(numpy.argmax(runs))
+            if runs[best] >= self.confirm:
+                return start + offset + best, None
+            offset += self.frame_size                                       # No frame can start in these bytes
+
+    def process(self, chunk):
+        """Returns the whole valid frames of the received bytes (a view of chunk when it only holds whole valid frames, else a new bytes)."""
+        if len(self.pending) > 0:
+            self.pending += chunk
+            data = self.pending
+        else:
+            data = chunk
+        raw = numpy.frombuffer(data, dtype = numpy.uint8)
+        segments = []                                                       # (start, end) of the runs of valid frames
+        position = 0
+
+        while True:
+            if self.synced:
+                count = (raw.size - position) // self.frame_size
+                headers = raw[position:position + count * self.frame_size].reshape(count, self.frame_size)
+                invalid = numpy.flatnonzero(~ads_valid_status(headers[:, 0], headers[:, 1], headers[:, 2]))
+                good = count if invalid.size == 0 else int(invalid[0])
+                if good > 0:
+                    segments.append((position, position + good * self.frame_size))
+                    self.frames += good
+                    position += good * self.frame_size
+                if invalid.size == 0:
+                    break
+                self.synced = False                                         # Invalid status word: searches from the next byte
+                self.misalignments += 1
+                self.skipped += 1
+                position += 1
+
+            found, resume = self._search(raw, position)
+            if found is None:
+                self.skipped += resume - position
+                position = resume
+                break
+            self.skipped += found - position
+            if self.skipped > 0:
+                dropped = -(-self.skipped // self.frame_size)
+                self.dropped += dropped
+                if len(self.events) < self.max_events:
+                    self.events.append((self.frames, dropped))
+            self.skipped = 0
+            self.synced = True
+            position = found
+
+        self.pending = bytearray(memoryview(data)[position:])
+        if len(segments) == 1 and segments[0] == (0, len(data)) and data is chunk:
+            return chunk
+        return b''.join(memoryview(data)[start:end] for start, end in segments)
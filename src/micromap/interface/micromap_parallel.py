@@ -0,0 +1,114 @@
+"""Channel-parallel execution for the MicroMAP readers.
+
+The channels of a recording are independent for filtering, resampling and the test signal checks, so the (channels, samples) arrays are
+split in contiguous groups of rows and each group is processed by one worker:
+
+    'thread'  -> thread pool over views of the same array. For the SciPy/NumPy kernels that release the GIL (sosfilt, upfirdn, ufuncs),
+                 which covers the filters and the resampler.
+    'process' -> process pool. The array is copied once to a multiprocessing.shared_memory block and the workers attach to it by name,
+                 so the samples are not pickled. For Python level work that holds the GIL. The function must be picklable (a module level
+                 function or a method of a picklable object, e.g. SosFilter.apply).
+
+Each worker goes through its group in time blocks (the filters and the resampler work in chunks), so the memory per worker stays bounded.
+"""
+import os
+import numpy
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+BACKENDS = ('thread', 'process')
+
+def channel_groups(num_channels, workers):
+    """Splits num_channels rows in up to workers contiguous groups of (almost) the same size. Returns a list of slices."""
+    groups = max(1, min(int(workers), num_channels))
+    bounds = numpy.linspace(0, num_channels, groups + 1).round().astype(int)
+    return [slice(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+def _shared_call(function, name, shape, dtype, rows, in_place):
+    """Runs function on rows of an array in a shared memory block (inside a worker process)."""
+    block = shared_memory.SharedMemory(name = name)
+    data = numpy.ndarray(shape, dtype = dtype, buffer = block.buf)
+    try:
+        result = function(data[rows])
+        if in_place:
+            return None
+        return numpy.array(result, copy = True)                            # Detached from the shared block before it is closed
+    finally:
+        del data
+        block.close()
+
+class ChannelExecutor:
+    '''Channel executor
+
+    Runs a function over groups of channels (rows) of a (channels, samples) array, in parallel.
+
+    Args:
+        workers (int): Number of workers. None uses all the cores (os.cpu_count()), 1 runs in the calling thread (no pool).
+        backend (string): 'thread' or 'process'.
+
+    Ex:
+        with ChannelExecutor(8) as executor:
+            executor.apply(micromap_filters.SosFilter(sos).apply, data)
+
+    '''
+    def __init__(self, workers = None, backend = 'thread'):
+        if backend not in BACKENDS:
+            raise ValueError("Invalid backend. Use 'thread' or 'process'.")
+        self.workers = os.cpu_count() if workers is None else max(1, int(workers))
+        self.backend = backend
+        self.pool = None
+        if self.workers > 1:
+            self.pool = ThreadPoolExecutor(self.workers) if backend == 'thread' else ProcessPoolExecutor(self.workers)
+
+    def _run(self, function, data, in_place):
+        groups = channel_groups(data.shape[0], self.workers)
+        functions = function if isinstance(function, (list, tuple)) else [function] * len(groups)
+        if len(functions) != len(groups):
+            raise ValueError(f"Got {len(functions)} functions for {len(groups)} channel groups.")
+
+        if self.pool is None or len(groups) == 1:
+            return [task(data[rows]) for task, rows in zip(functions, groups)]
+
+        if self.backend == 'thread':
+            return list(self.pool.map(lambda task, rows: task(data[rows]), functions, groups))
+
+        block = shared_memory.SharedMemory(create = True, size = max(1, data.nbytes))
+        shared = numpy.ndarray(data.shape, dtype = data.dtype, buffer = block.buf)
+        try:
+            shared[...] = data
+            futures = [self.pool.submit(_shared_call, task, block.name, data.shape, data.dtype, rows, in_place)
+                       for task, rows in zip(functions, groups)]
+            results = [future.result() for future in futures]
+            if in_place:
+                data[...] = shared
+            return results
+        finally:
+            del shared
+            block.close()
+            block.unlink()
+
+    def apply(self, function, data):
+        """Calls function(rows) for each group of rows of data, which is changed in place (e.g. SosFilter.apply). function can also be a
+        list with one function per group (see groups). With the 'process' backend the functions are copied to the workers, so any state
+        they change is lost. Returns data."""
+        self._run(function, data, in_place = True)
+        return data
+
+    def map(self, function, data):
+        """Calls function(rows) for each group of rows of data and returns the results stacked along the channels (axis 0)."""
+        return numpy.concatenate(self._run(function, data, in_place = False), axis = 0)
+
+    def groups(self, num_channels):
+        """Returns the channel groups (slices) used for num_channels channels."""
+        return channel_groups(num_channels, self.workers)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
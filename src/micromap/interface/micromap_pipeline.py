@@ -0,0 +1,139 @@
+"""Lazy processing pipeline for the MicroMAP readers.
+
+The steps (notch, band pass, resample...) are only recorded when they are called. When the result is requested, the recording is read
+once with iter_chunks and every chunk goes through all the steps before the next one is read, so the data is traversed a single time
+and the memory is bounded by the chunk size (plus the output, if it is kept in memory).
+
+The filters are the causal streaming filters of micromap_filters (their state is carried between chunks, so the result is the same as
+filtering the whole recording at once with sosfilt). Zero-phase filtering needs a backward pass over the whole recording: use the
+notch_filter / bandpass_filter methods of the readers for that.
+
+Ex:
+    reader = micromap_utils.MicroMAPReader(folder, preload = False)
+    lfp = reader.pipeline().notch(60, harmonics = 3).bandpass(1, 300).resample(1000).to_array()
+"""
+import os
+import numpy
+import micromap_filters
+import micromap_format
+
+def reader_chunks(reader, seconds = 10, channels = None, dtype = numpy.float64):
+    """Iterates over the (offset, block) chunks of a reader for processing: gap filled with the fill method of the reader, except 'nan'
+    (replaced by 'last', NaN would spread through the filters). MicroMAPReaderADS recordings have no gaps."""
+    fill_method = getattr(reader, 'fill_method', None)
+    if fill_method is None:                                                 # MicroMAPReaderADS (no gap filling)
+        return reader.iter_chunks(seconds, channels, dtype = dtype)
+    return reader.iter_chunks(seconds, channels, fill_method = 'last' if fill_method == 'nan' else fill_method, dtype = dtype)
+
+class Pipeline:
+    '''Pipeline
+
+    Records processing steps over a recording and runs them fused, chunk by chunk.
+
+    Args:
+        reader: MicroMAPReader or MicroMAPReaderADS (it does not need to be loaded).
+        seconds (number): Duration of the chunks read from the recording.
+        channels (number list): Channels to process (index from 1 to N). None processes all channels.
+        dtype: Data type of the processing (float64 or float32).
+
+    '''
+    def __init__(self, reader, seconds = 10, channels = None, dtype = numpy.float64):
+        self.reader = reader
+        self.seconds = seconds
+        self.channels = channels
+        self.dtype = dtype
+        self.steps = []                                                     # (name, arguments) in the order they were called
+
+    def notch(self, frequency, harmonics = 1, quality = 30):
+        """Adds a notch filter of frequency and its harmonics (see micromap_filters.NotchFilter)."""
+        self.steps.append(('notch', dict(frequency = frequency, harmonics = harmonics, quality = quality)))
+        return self
+
+    def bandpass(self, low, high, order = 4):
+        """Adds a Butterworth filter (low = None for a low pass, high = None for a high pass)."""
+        self.steps.append(('bandpass', dict(low = low, high = high, order = order)))
+        return self
+
+    def resample(self, new_rate):
+        """Adds a polyphase resampling to new_rate Hz (the next steps are designed for the new rate). Raises a ValueError if new_rate
+        cannot be reached exactly (see micromap_filters.rate_ratio)."""
+        micromap_filters.rate_ratio(new_rate, self.sampling_freq)
+        self.steps.append(('resample', dict(new_rate = new_rate)))
+        return self
+
+    @property
+    def sampling_freq(self):
+        """Sampling frequency of the output."""
+        rate = self.reader.sampling_freq
+        for name, arguments in self.steps:
+            if name == 'resample':
+                rate = arguments['new_rate']
+        return rate
+
+    def _stages(self):
+        """Creates the stateful filters and resamplers of the steps (new ones for each run)."""
+        stages = []
+        rate = self.reader.sampling_freq
+        for name, arguments in self.steps:
+            if name == 'notch':
+                stages.append(micromap_filters.NotchFilter(arguments['frequency'], rate, arguments['harmonics'], arguments['quality']))
+            elif name == 'bandpass':
+                stages.append(micromap_filters.BandpassFilter(arguments['low'], arguments['high'], rate, arguments['order']))
+            else:
+                up, down = micromap_filters.rate_ratio(arguments['new_rate'], rate)
+                stages.append(micromap_filters.StreamingResampler(up, down))
+                rate = arguments['new_rate']
+        return stages
+
+    def blocks(self):
+        """Runs the pipeline and yields the processed (channels, samples) blocks, in order."""
+        stages = self._stages()
+        for _, block in reader_chunks(self.reader, self.seconds, self.channels, self.dtype):
+            for stage in stages:
+                block = stage.process(block)
+            if block.shape[1] > 0:
+                yield block
+
+        # End of the recording: the resamplers return their last samples, which still go through the next stages
+        tail = None
+        for stage in stages:
+            if tail is not None:
+                tail = stage.process(tail)
+            if isinstance(stage, micromap_filters.StreamingResampler):
+                last = stage.flush()
+                if last is not None:
+                    tail = last if tail is None else numpy.concatenate((tail, last), axis = 1)
+        if tail is not None and tail.shape[1] > 0:
+            yield tail
+
+    def to_array(self):
+        """Runs the pipeline and returns the output (channels, samples) array."""
+        return numpy.concatenate(list(self.blocks()), axis = 1)
+
+    def to_file(self, output, name = None):
+        '''To file
+
+        Runs the pipeline and writes the output as a new recording ('f4' samples in µV, sequential packet counter), block by block.
+
+        Args:
+            output (string): Folder of the new recording (created if needed).
+            name (string): File name (default: name of the source file + "_processed").
+
+        Returns:
+            MicroMAPReader of the new recording (preload = False), as MicroMAPReader.resample with an output folder.
+
+        '''
+        rows = range(len(self.reader.channels)) if self.channels is None else numpy.asarray(self.channels) - 1
+        channels = [self.reader.channels[row] for row in rows]
+        header = micromap_format.RecordingHeader.from_metadata(self.reader.metadata, self.sampling_freq, channels,
+                                                               index_period = max(1, int(round(self.seconds * self.sampling_freq))))
+
+        os.makedirs(output, exist_ok = True)
+        if name is None:
+            name = os.path.splitext(os.path.basename(self.reader.bin_file))[0] + "_processed"
+        path = os.path.join(output, name + ".mmap")
+        with micromap_format.RecordingWriter(path, header) as writer:
+            for block in self.blocks():
+                writer.write_samples(block)
+        import micromap_utils                                               # Imported here: micromap_utils imports this module
+        return micromap_utils.MicroMAPReader(path, preload = False)
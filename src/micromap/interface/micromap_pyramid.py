@@ -0,0 +1,190 @@
+"""Min/max decimation pyramid of a MicroMAP recording, for browsing long recordings.
+
+Level 0 keeps the minimum and the maximum of every `base` samples of each channel, and every next level keeps the minimum and the maximum
+of `step` bins of the level below. The pyramid is built in one streaming pass over the recording (iter_chunks) and stored in a sidecar
+file next to the recording (<recording>.mmap.pyramid):
+
+    [header]    fixed size (HEADER_SIZE bytes): size and modification time of the recording, number of samples and channels, base,
+                step and number of bins of each level
+    [levels]    float32 (bins, channels, 2) arrays of (minimum, maximum) in µV, from level 0 to the top level
+
+The size and the modification time of the recording are checked when the sidecar is opened, and the pyramid is rebuilt if the recording
+changed. A query (envelope) reads at most about `step` bins per pixel from the memory-mapped level whose bins are just smaller than a
+pixel, so its cost only depends on the number of pixels. Zoomed in below `base` samples per pixel, the samples are read directly.
+"""
+import os
+import struct
+import tempfile
+import shutil
+import numpy
+import micromap_pipeline
+
+MAGIC = b'MMAPPYRM'
+FORMAT_VERSION = 1
+HEADER_SIZE = 512
+MAX_LEVELS = 32
+SUFFIX = '.pyramid'
+
+# magic, version, source size, source modification time (ns), number of samples, number of channels, sampling frequency, base, step,
+# number of levels, bins of each level
+_HEADER_STRUCT = struct.Struct(f'<8sHQqQHdIIH{MAX_LEVELS}Q')
+
+def sidecar_path(bin_file):
+    """Returns the path of the pyramid of a recording file."""
+    return bin_file + SUFFIX
+
+def _source_stamp(bin_file):
+    stat = os.stat(bin_file)
+    return stat.st_size, stat.st_mtime_ns
+
+def _reduce(minimum, maximum, factor, final):
+    """Minimum and maximum of groups of factor columns. The columns after the last complete group are returned as the remainder, or
+    reduced as a partial group if final."""
+    used = minimum.shape[1] if final else (minimum.shape[1] // factor) * factor
+    starts = numpy.arange(0, used, factor)
+    if starts.size == 0:
+        empty = numpy.empty((minimum.shape[0], 0), dtype = minimum.dtype)
+        return empty, empty, minimum[:, used:], maximum[:, used:]
+    return (numpy.fmin.reduceat(minimum[:, :used], starts, axis = 1), numpy.fmax.reduceat(maximum[:, :used], starts, axis = 1),
+            minimum[:, used:], maximum[:, used:])
+
+class Pyramid:
+    '''Pyramid
+
+    Opens the min/max pyramid of a recording, building it (or rebuilding it, if the recording changed) when needed.
+
+    Args:
+        reader: MicroMAPReader or MicroMAPReaderADS (it does not need to be loaded).
+        base (int): Samples per bin of level 0.
+        step (int): Bins of a level reduced to one bin of the next level.
+        min_bins (int): The top level is the first one with less bins than this.
+        seconds (number): Duration of the chunks read while building.
+        rebuild (bool): Builds the pyramid even if the sidecar is valid.
+
+    '''
+    def __init__(self, reader, base = 16, step = 4, min_bins = 2048, seconds = 10, rebuild = False):
+        self.reader = reader
+        self.path = sidecar_path(reader.bin_file)
+        self.base = base
+        self.step = step
+        self.min_bins = min_bins
+        self.seconds = seconds
+
+        if rebuild or not self.is_valid():
+            self.build()
+        self._open()
+
+    def is_valid(self):
+        """Returns True if the sidecar exists and was built from the current version of the recording."""
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < HEADER_SIZE:
+            return False
+        with open(self.path, 'rb') as f:
+            fields = _HEADER_STRUCT.unpack(f.read(_HEADER_STRUCT.size))
+        magic, version, source_size, source_mtime = fields[:4]
+        return magic == MAGIC and version == FORMAT_VERSION and (source_size, source_mtime) == _source_stamp(self.reader.bin_file)
+
+    def build(self):
+        '''Build
+
+        Builds the pyramid in one pass over the recording. The bins of each level are written to a temporary file as they are
+        completed and the levels are joined in the sidecar at the end (the number of samples after gap filling is only known then).
+        '''
+        source_size, source_mtime = _source_stamp(self.reader.bin_file)
+        num_levels = 1                                                      # Estimated from the received frames (before gap filling)
+        while num_levels < MAX_LEVELS and self.reader.num_frames / (self.base * self.step**(num_levels - 1)) >= self.min_bins:
+            num_levels += 1
+
+        directory = tempfile.mkdtemp(dir = os.path.dirname(self.path) or None)
+        try:
+            files = [open(os.path.join(directory, f"level{level}"), 'wb') for level in range(num_levels)]
+            bins = [0] * num_levels
+            remainder = [None] * num_levels                                 # Columns of each level waiting for a complete group
+
+            def push(level, minimum, maximum, final):
+                if remainder[level] is not None:
+                    minimum = numpy.concatenate((remainder[level][0], minimum), axis = 1)
+                    maximum = numpy.concatenate((remainder[level][1], maximum), axis = 1)
+                factor = self.base if level == 0 else self.step
+                minimum, maximum, rest_min, rest_max = _reduce(minimum, maximum, factor, final)
+                remainder[level] = (rest_min, rest_max)
+                if minimum.shape[1] > 0:
+                    numpy.stack((minimum.T, maximum.T), axis = -1).astype(numpy.float32).tofile(files[level])
+                    bins[level] += minimum.shape[1]
+                if level + 1 < num_levels and (minimum.shape[1] > 0 or final):
+                    push(level + 1, minimum, maximum, final)
+
+            num_samples = 0
+            for _, block in micromap_pipeline.reader_chunks(self.reader, self.seconds, dtype = numpy.float32):
+                num_samples += block.shape[1]
+                push(0, block, block, False)
+            empty = numpy.empty((self.reader.num_channels, 0), dtype = numpy.float32)
+            push(0, empty, empty, True)
+            for f in files:
+                f.close()
+
+            header = _HEADER_STRUCT.pack(MAGIC, FORMAT_VERSION, source_size, source_mtime, num_samples, self.reader.num_channels,
+                                         float(self.reader.sampling_freq), self.base, self.step, num_levels,
+                                         *(bins + [0] * (MAX_LEVELS - num_levels)))
+            temporary = os.path.join(directory, "pyramid")
+            with open(temporary, 'wb') as output:
+                output.write(header + bytes(HEADER_SIZE - len(header)))
+                for level in range(num_levels):
+                    with open(os.path.join(directory, f"level{level}"), 'rb') as f:
+                        shutil.copyfileobj(f, output)
+            os.replace(temporary, self.path)                                # The sidecar is never left half written
+        finally:
+            shutil.rmtree(directory, ignore_errors = True)
+
+    def _open(self):
+        with open(self.path, 'rb') as f:
+            fields = _HEADER_STRUCT.unpack(f.read(_HEADER_STRUCT.size))
+        (_, _, _, _, self.num_samples, self.num_channels, self.sampling_freq, self.base, self.step, num_levels) = fields[:10]
+        level_bins = fields[10:10 + num_levels]
+
+        self.levels = []                                                    # (bins, channels, 2) memmaps, finest first
+        offset = HEADER_SIZE
+        for bins in level_bins:
+            if bins > 0:
+                self.levels.append(numpy.memmap(self.path, dtype = numpy.float32, mode = 'r', offset = offset, shape = (bins, self.num_channels, 2)))
+            offset += bins * self.num_channels * 2 * 4
+
+    def envelope(self, t0, t1, pixels, channels = None):
+        '''Envelope
+
+        Returns the minimum and the maximum of each pixel column between t0 and t1 seconds.
+
+        Args:
+            t0, t1 (number): Time range in seconds (clipped to the recording).
+            pixels (int): Number of pixel columns (less if the range has less samples).
+            channels (number list): Channels (index from 1 to N). None returns all channels.
+
+        Returns:
+            times (start time of each pixel, in seconds), minimum and maximum ((channels, pixels) arrays in µV).
+        '''
+        rows = slice(None) if channels is None else numpy.asarray(channels) - 1
+        first = min(max(int(round(t0 * self.sampling_freq)), 0), self.num_samples)
+        last = min(max(int(round(t1 * self.sampling_freq)), first), self.num_samples)
+        pixels = max(1, min(int(pixels), last - first))
+        edges = first + (numpy.arange(pixels + 1) * (last - first)) // pixels          # Sample edges of the pixels
+        times = edges[:-1] / self.sampling_freq
+        if last == first:
+            empty = numpy.empty((self.num_channels, 0), dtype = numpy.float32)[rows]
+            return times[:0], empty, empty
+
+        samples_per_pixel = (last - first) / pixels
+        level, factor = -1, 1                                               # Finest level with bins not wider than a pixel
+        while level + 1 < len(self.levels) and self.base * self.step**(level + 1) <= samples_per_pixel:
+            level += 1
+            factor = self.base * self.step**level
+
+        if level < 0:                                                       # Zoomed in: reads the samples (less than base per pixel)
+            data = self.reader.get_segment(first / self.sampling_freq, last / self.sampling_freq, channels, dtype = numpy.float32)
+            data = data[:, :last - first]
+            starts = edges[:-1] - first
+            return times, numpy.fmin.reduceat(data, starts, axis = 1), numpy.fmax.reduceat(data, starts, axis = 1)
+
+        bins = self.levels[level][first // factor:-(-last // factor)]       # Bins that overlap the range
+        starts = numpy.minimum(edges[:-1] // factor - first // factor, bins.shape[0] - 1)
+        minimum = numpy.fmin.reduceat(bins[:, rows, 0], starts, axis = 0).T
+        maximum = numpy.fmax.reduceat(bins[:, rows, 1], starts, axis = 0).T
+        return times, minimum, maximum
@@ -0,0 +1,169 @@
+"""Streaming spectral estimation (Welch PSD and spectrogram) for the MicroMAP readers.
+
+The recording is read once with iter_chunks. Every chunk is cut in segments of nperseg samples (the last noverlap samples of a chunk
+are carried to the next one, so the segments are the same as for the whole recording) and the periodograms of all the channels and
+segments of the chunk are computed at once with a single rfft. The Welch PSD keeps only the running sum of the periodograms and the
+spectrogram only the averaged columns, so the memory is bounded by the chunk size and does not depend on the duration of the recording.
+
+The results are the same as scipy.signal.welch and scipy.signal.spectrogram (mode = 'psd') of the whole recording with the same window,
+nperseg and noverlap (constant detrend, density scaling, one-sided spectrum).
+
+Ex:
+    reader = micromap_utils.MicroMAPReader(folder, preload = False)
+    freqs, psd = micromap_spectral.welch(reader, nperseg = 20000, dtype = numpy.float32, workers = 4)
+"""
+import functools
+import numpy
+from scipy.signal import get_window
+import micromap_parallel
+import micromap_pipeline
+
+def periodograms(segments, window, scale):
+    """One-sided periodograms of (channels, segments, nperseg) segments (constant detrend). Returns a (channels, segments, freqs) array
+    in the precision of the segments (float32 segments give float32 periodograms)."""
+    segments = segments - segments.mean(axis = -1, keepdims = True)
+    spectrum = numpy.fft.rfft(segments * window, axis = -1)
+    power = spectrum.real**2 + spectrum.imag**2
+    power *= scale
+    nperseg = window.shape[0]
+    power[..., 1:nperseg // 2 + (nperseg % 2)] *= 2                        # One-sided: DC (and Nyquist, for even nperseg) not doubled
+    return power
+
+class SegmentPeriodogram:
+    '''Segment periodogram
+
+    Cuts the chunks of a recording in overlapping segments and returns their periodograms. The samples that do not complete a segment
+    are kept for the next chunk.
+
+    Args:
+        sampling_freq (number): Sampling frequency in Hz.
+        nperseg (int): Samples per segment (frequency resolution of sampling_freq / nperseg).
+        noverlap (int): Samples shared by consecutive segments (default: nperseg // 2).
+        window (string, tuple or array): Window (see scipy.signal.get_window).
+        executor (ChannelExecutor): Computes groups of channels in parallel. None computes in the calling thread.
+
+    '''
+    def __init__(self, sampling_freq, nperseg, noverlap = None, window = 'hann', executor = None):
+        self.sampling_freq = sampling_freq
+        self.nperseg = int(nperseg)
+        self.noverlap = self.nperseg // 2 if noverlap is None else int(noverlap)
+        if self.nperseg < 1 or not 0 <= self.noverlap < self.nperseg:
+            raise ValueError("nperseg must be positive and noverlap smaller than nperseg.")
+        self.step = self.nperseg - self.noverlap
+
+        self.window = get_window(window, self.nperseg) if isinstance(window, (str, tuple)) else numpy.asarray(window, dtype = numpy.float64)
+        if self.window.shape != (self.nperseg,):
+            raise ValueError("The window must have nperseg samples.")
+        self.scale = 1.0 / (sampling_freq * (self.window**2).sum())
+        self.freqs = numpy.fft.rfftfreq(self.nperseg, 1.0 / sampling_freq)
+        self.executor = executor
+        self.reset()
+
+    def reset(self):
+        self.pending = None                                                 # Samples not used by a complete segment yet
+        self.segments = 0                                                   # Segments returned since the start
+
+    def process(self, chunk):
+        '''Process
+
+        Returns the periodograms of the segments completed by the chunk.
+
+        Args:
+            chunk: (channels, samples) next samples of the recording.
+
+        Returns:
+            (channels, segments, freqs) array. The first segment starts at sample self.segments * self.step of the recording (read before
+            the call).
+        '''
+        data = chunk if self.pending is None else numpy.concatenate((self.pending, chunk.astype(self.pending.dtype, copy = False)), axis = 1)
+        count = 0 if data.shape[1] < self.nperseg else (data.shape[1] - self.nperseg) // self.step + 1
+        self.pending = data[:, count * self.step:].copy()
+        if count == 0:
+            return numpy.empty((data.shape[0], 0, self.freqs.size), dtype = data.dtype)
+
+        window = self.window.astype(data.dtype, copy = False)
+        segments = numpy.lib.stride_tricks.sliding_window_view(data, self.nperseg, axis = 1)[:, :(count - 1) * self.step + 1:self.step]
+        self.segments += count
+        if self.executor is None:
+            return periodograms(segments, window, self.scale)
+        return self.executor.map(functools.partial(periodograms, window = window, scale = self.scale), segments)
+
+def welch(reader, nperseg = None, noverlap = None, window = 'hann', channels = None, seconds = 10, dtype = numpy.float64,
+          workers = 1, backend = 'thread'):
+    '''Welch
+
+    Power spectral density of the channels of a recording (Welch's method, mean of the periodograms), in one pass over the recording.
+
+    Args:
+        reader: MicroMAPReader or MicroMAPReaderADS (it does not need to be loaded).
+        nperseg (int): Samples per segment (default: one second, 1 Hz resolution).
+        noverlap (int): Samples shared by consecutive segments (default: nperseg // 2).
+        window (string, tuple or array): Window (see scipy.signal.get_window).
+        channels (number list): Channels (index from 1 to N). None uses all channels.
+        seconds (number): Duration of the chunks read from the recording.
+        dtype: Precision of the segments and FFTs (float64 or float32). The periodograms are always summed in float64.
+        workers (int): Workers computing groups of channels in parallel (see micromap_parallel.ChannelExecutor).
+        backend (string): 'thread' or 'process'.
+
+    Returns:
+        freqs (Hz) and psd ((channels, freqs) array in µV²/Hz).
+    '''
+    nperseg = int(round(reader.sampling_freq)) if nperseg is None else nperseg
+    with micromap_parallel.ChannelExecutor(workers, backend) as executor:
+        estimator = SegmentPeriodogram(reader.sampling_freq, nperseg, noverlap, window, executor if executor.workers > 1 else None)
+        total = None
+        for _, block in micromap_pipeline.reader_chunks(reader, seconds, channels, dtype):
+            power = estimator.process(block).sum(axis = 1, dtype = numpy.float64)
+            total = power if total is None else total + power
+
+    if estimator.segments == 0:
+        raise ValueError("The recording is shorter than nperseg.")
+    return estimator.freqs, total / estimator.segments
+
+def spectrogram(reader, nperseg = None, noverlap = None, window = 'hann', column_seconds = None, channels = None, seconds = 10,
+                dtype = numpy.float64, workers = 1, backend = 'thread'):
+    '''Spectrogram
+
+    Spectrogram of the channels of a recording, in one pass over the recording. Each column is the mean of the periodograms of the
+    segments that start in its time bin, so long recordings can be summarized with a fixed memory per column.
+
+    Args:
+        reader: MicroMAPReader or MicroMAPReaderADS (it does not need to be loaded).
+        nperseg, noverlap, window: Segments (see welch).
+        column_seconds (number): Duration of each column. None gives one column per segment (as scipy.signal.spectrogram).
+        channels (number list): Channels (index from 1 to N). None uses all channels.
+        seconds (number): Duration of the chunks read from the recording.
+        dtype: Precision of the segments and FFTs (float64 or float32), also used for the output.
+        workers (int): Workers computing groups of channels in parallel (see micromap_parallel.ChannelExecutor).
+        backend (string): 'thread' or 'process'.
+
+    Returns:
+        freqs (Hz), times (center of each column, in seconds) and sxx ((channels, freqs, columns) array in µV²/Hz).
+    '''
+    nperseg = int(round(reader.sampling_freq)) if nperseg is None else nperseg
+    columns, times = [], []
+    with micromap_parallel.ChannelExecutor(workers, backend) as executor:
+        estimator = SegmentPeriodogram(reader.sampling_freq, nperseg, noverlap, window, executor if executor.workers > 1 else None)
+        per_column = 1 if column_seconds is None else max(1, int(round(column_seconds * reader.sampling_freq / estimator.step)))
+        partial, first_segment = None, 0                                   # Periodograms of the column being filled
+
+        def close_column(power, first):
+            columns.append(power.mean(axis = 1, dtype = numpy.float64).astype(dtype))
+            last = first + power.shape[1] - 1                               # Center between the first and the last segment
+            times.append(((first + last) * estimator.step + estimator.nperseg) / 2 / reader.sampling_freq)
+
+        for _, block in micromap_pipeline.reader_chunks(reader, seconds, channels, dtype):
+            power = estimator.process(block)
+            if partial is not None:
+                power = numpy.concatenate((partial, power), axis = 1)
+            complete = (power.shape[1] // per_column) * per_column
+            for start in range(0, complete, per_column):
+                close_column(power[:, start:start + per_column], first_segment + start)
+            partial = power[:, complete:] if complete < power.shape[1] else None
+            first_segment += complete
+        if partial is not None:
+            close_column(partial, first_segment)
+
+    if not columns:
+        raise ValueError("The recording is shorter than nperseg.")
+    return estimator.freqs, numpy.asarray(times), numpy.stack(columns, axis = -1)
@@ -0,0 +1,223 @@
+"""Streaming spike detection for the MicroMAP recordings.
+
+The detector is a chain of vectorized steps over (channels, samples) chunks, with its state carried between chunks, so it gives the
+same spikes whether the recording is processed at once, offline with iter_chunks or live in blocks of a few milliseconds:
+
+    band pass   -> causal Butterworth (micromap_filters.BandpassFilter, 300-6000 Hz by default)
+    noise       -> MAD estimate of each channel (median(|x|) / 0.6745), updated with a time constant (or fixed)
+    threshold   -> crossings of threshold x noise (negative, positive or both polarities)
+    alignment   -> spike time at the extremum within `align` seconds after the crossing
+    refractory  -> crossings closer than `refractory` seconds to the last spike of the channel are ignored
+    snippets    -> waveform from `pre` seconds before to `post` seconds after the spike (optional)
+
+A spike is only reported when its waveform is complete, so the latency is bounded by align + post (plus the chunk itself).
+The spikes are returned as a compact structured array (SPIKE_DTYPE) of sample index, channel and amplitude.
+
+Ex:
+    reader = micromap_utils.MicroMAPReader(folder, preload = False)
+    spikes, snippets = micromap_spikes.detect_spikes(reader, threshold = 5, snippets = True)
+"""
+import numpy
+import micromap_filters
+import micromap_pipeline
+
+SPIKE_DTYPE = numpy.dtype([('sample', '<i8'), ('channel', '<u2'), ('amplitude', '<f4')])
+POLARITIES = ('negative', 'positive', 'both')
+MAD_SCALE = 0.6745                                                          # median(|x|) / MAD_SCALE = standard deviation of Gaussian noise
+
+class SpikeDetector:
+    '''Spike detector
+
+    Detects spikes in consecutive chunks of a recording.
+
+    Args:
+        sampling_freq (number): Sampling frequency in Hz.
+        low, high (number): Band pass cutoff frequencies in Hz (None disables the filter, for data that is already filtered).
+        threshold (number): Detection threshold in multiples of the noise.
+        polarity (string): 'negative', 'positive' or 'both'.
+        refractory (number): Minimum time between two spikes of a channel, in seconds.
+        align (number): Time after the crossing where the extremum is searched, in seconds.
+        pre, post (number): Snippet duration before and after the spike, in seconds (snippets = False does not extract them).
+        snippets (bool): Returns the waveform of each spike.
+        noise_seconds (number): Time constant of the noise estimate, in seconds.
+        noise (array): Fixed noise of each channel (same units as the data). None estimates it from the data.
+
+    '''
+    def __init__(self, sampling_freq, low = 300, high = 6000, order = 4, threshold = 5.0, polarity = 'negative', refractory = 1e-3,
+                 align = 0.5e-3, pre = 0.5e-3, post = 1e-3, snippets = False, noise_seconds = 10, noise = None):
+        if polarity not in POLARITIES:
+            raise ValueError("Invalid polarity. Use 'negative', 'positive' or 'both'.")
+        self.sampling_freq = sampling_freq
+        self.threshold = threshold
+        self.polarity = polarity
+        self.refractory = max(1, int(round(refractory * sampling_freq)))
+        self.align = max(1, int(round(align * sampling_freq)))
+        self.pre = int(round(pre * sampling_freq))
+        self.post = int(round(post * sampling_freq))
+        self.snippets = snippets
+        self.noise_seconds = noise_seconds
+        self.fixed_noise = None if noise is None else numpy.asarray(noise, dtype = numpy.float64)
+        self.lookahead = self.align + self.post if snippets else self.align   # Samples after a crossing needed to report its spike
+
+        self.filter = None
+        if low is not None or high is not None:
+            self.filter = micromap_filters.BandpassFilter(low, high, sampling_freq, order, steady_start = True)
+        self.reset()
+
+    def reset(self):
+        if self.filter is not None:
+            self.filter.reset()
+        self.noise = self.fixed_noise
+        self.buffer = None                                                  # Filtered samples kept for the crossings, alignment and snippets
+        self.start = 0                                                      # Sample index of the first column of the buffer
+        self.scanned = 0                                                    # Samples already searched for crossings
+        self.last_spike = None                                              # Sample index of the last spike of each channel
+
+    def _update_noise(self, filtered):
+        if self.fixed_noise is not None or filtered.shape[1] == 0:
+            return
+        noise = numpy.median(numpy.abs(filtered), axis = 1) / MAD_SCALE
+        if self.noise is None:
+            self.noise = noise
+        else:
+            weight = 1.0 - numpy.exp(-filtered.shape[1] / (self.noise_seconds * self.sampling_freq))
+            self.noise = self.noise + weight * (noise - self.noise)
+
+    def _beyond(self, data, threshold):
+        if self.polarity == 'negative':
+            return data < -threshold
+        if self.polarity == 'positive':
+            return data > threshold
+        return numpy.abs(data) > threshold
+
+    def _peaks(self, windows):
+        if self.polarity == 'negative':
+            return windows.argmin(axis = 1)
+        if self.polarity == 'positive':
+            return windows.argmax(axis = 1)
+        return numpy.abs(windows).argmax(axis = 1)
+
+    def _refractory(self, channels, samples):
+        """Keeps the spikes (sorted by channel and sample) that are at least refractory samples after the last kept spike of the channel."""
+        keep = samples - self.last_spike[channels] >= self.refractory
+        same = numpy.zeros(samples.size, dtype = bool)
+        same[1:] = channels[1:] == channels[:-1]
+        close = numpy.flatnonzero(same[1:] & (numpy.diff(samples) < self.refractory)) + 1
+        for i in close:                                                     # Only for spikes closer than refractory to the previous one
+            j = i - 1
+            while same[j + 1] and j >= 0 and not keep[j]:
+                j -= 1
+            if j >= 0 and channels[j] == channels[i] and keep[j] and samples[i] - samples[j] < self.refractory:
+                keep[i] = False
+        return keep
+
+    def _detect(self, limit):
+        """Searches the crossings between self.scanned and limit (absolute sample indexes)."""
+        num_channels = self.buffer.shape[0]
+        empty = (numpy.empty(0, dtype = SPIKE_DTYPE), numpy.empty((0, self.pre + self.post), dtype = numpy.float32) if self.snippets else None)
+        if limit <= self.scanned or self.noise is None:
+            return empty
+
+        first = self.scanned - self.start
+        region = self.buffer[:, max(first - 1, 0):limit - self.start]
+        beyond = self._beyond(region, self.threshold * self.noise[:, None])
+        if first == 0:                                                      # Start of the recording: no previous sample
+            beyond = numpy.concatenate((numpy.zeros((num_channels, 1), dtype = bool), beyond), axis = 1)
+        channels, onsets = numpy.nonzero(beyond[:, 1:] & ~beyond[:, :-1])
+        self.scanned = limit
+        if channels.size == 0:
+            return empty
+
+        onsets = onsets + first
+        windows = self.buffer[channels[:, None], onsets[:, None] + numpy.arange(self.align)]
+        columns = onsets + self._peaks(windows)
+        samples = columns + self.start
+        order = numpy.lexsort((samples, channels))
+        channels, columns, samples = channels[order], columns[order], samples[order]
+        keep = self._refractory(channels, samples)
+        channels, columns, samples = channels[keep], columns[keep], samples[keep]
+        if samples.size == 0:
+            return empty
+        numpy.maximum.at(self.last_spike, channels, samples)
+
+        spikes = numpy.empty(samples.size, dtype = SPIKE_DTYPE)
+        spikes['sample'] = samples
+        spikes['channel'] = channels + 1
+        spikes['amplitude'] = self.buffer[channels, columns]
+        order = numpy.argsort(samples, kind = 'stable')
+        spikes = spikes[order]
+        if not self.snippets:
+            return spikes, None
+
+        padded = numpy.pad(self.buffer, ((0, 0), (max(self.pre - columns.min(), 0), 0)))
+        shift = padded.shape[1] - self.buffer.shape[1]
+        snippets = padded[channels[:, None], columns[:, None] + shift + numpy.arange(-self.pre, self.post)]
+        return spikes, snippets[order].astype(numpy.float32)
+
+    def process(self, chunk):
+        '''Process
+
+        Filters the chunk and returns the spikes whose waveform is complete.
+
+        Args:
+            chunk: (channels, samples) next samples of the recording.
+
+        Returns:
+            spikes (SPIKE_DTYPE array: sample index from the start of the recording, channel from 1 to N and filtered amplitude) and
+            snippets ((spikes, samples) float32 array, or None if snippets is False).
+        '''
+        filtered = chunk if self.filter is None else self.filter.process(chunk)
+        filtered = numpy.asarray(filtered, dtype = numpy.float32)
+        self._update_noise(filtered)
+        if self.buffer is None:
+            self.buffer = filtered
+            self.last_spike = numpy.full(filtered.shape[0], -self.refractory, dtype = numpy.int64)
+        else:
+            self.buffer = numpy.concatenate((self.buffer, filtered), axis = 1)
+
+        result = self._detect(self.start + self.buffer.shape[1] - self.lookahead)
+        keep_from = max(self.scanned - max(self.pre, 1), self.start)        # Samples still needed by the next crossings and snippets
+        self.buffer = self.buffer[:, keep_from - self.start:]
+        self.start = keep_from
+        return result
+
+    def flush(self):
+        """Searches the last samples of the recording (the snippets of the last spikes are completed with zeros) and resets the detector."""
+        if self.buffer is None:
+            return None
+        end = self.start + self.buffer.shape[1]
+        self.buffer = numpy.pad(self.buffer, ((0, 0), (0, self.lookahead)))
+        result = self._detect(end)
+        self.reset()
+        return result
+
+def detect_spikes(reader, low = 300, high = 6000, threshold = 5.0, polarity = 'negative', refractory = 1e-3, snippets = False,
+                  channels = None, seconds = 10, **options):
+    '''Detect spikes
+
+    Detects the spikes of a recording in one pass over its chunks (see SpikeDetector for the options).
+
+    Args:
+        reader: MicroMAPReader or MicroMAPReaderADS (it does not need to be loaded).
+        channels (number list): Channels (index from 1 to N). None uses all channels.
+        seconds (number): Duration of the chunks read from the recording.
+
+    Returns:
+        spikes (SPIKE_DTYPE array, with the channel numbers of the recording) and snippets ((spikes, samples) array or None).
+    '''
+    detector = SpikeDetector(reader.sampling_freq, low, high, threshold = threshold, polarity = polarity, refractory = refractory,
+                             snippets = snippets, **options)
+    spikes, waveforms = [], []
+    for _, block in micromap_pipeline.reader_chunks(reader, seconds, channels, numpy.float32):
+        found, snippet = detector.process(block)
+        spikes.append(found)
+        waveforms.append(snippet)
+    if detector.buffer is not None:
+        found, snippet = detector.flush()
+        spikes.append(found)
+        waveforms.append(snippet)
+
+    spikes = numpy.concatenate(spikes)
+    if channels is not None:
+        spikes['channel'] = numpy.asarray(channels)[spikes['channel'] - 1]
+    return spikes, numpy.concatenate(waveforms) if snippets else None
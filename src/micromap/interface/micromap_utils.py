@@ -1,28 +1,69 @@
 import os
+import functools
 import pickle
-import struct
 import numpy as np
 import matplotlib.pyplot as plt
 import numpy
-import mne
 from scipy.signal import resample
-from scipy.stats import pearsonr
+import micromap_frames
+import micromap_format
+import micromap_filters
+import micromap_parallel
+import micromap_pipeline
+import micromap_spectral
+import micromap_checks
 
 class MicroMAPReader:
-    def __init__(self, folder_path, counter_type = 'n'):
+    def __init__(self, folder_path, counter_type = 'n', preload = True, fill_method = 'last'):
+        """Opens a MicroMAP recording folder (or a .mmap file, when the folder holds several recordings). The binary file is always memory-mapped (see _map_binary_data), so with preload = False the reader
+        opens in milliseconds whatever the file size, and the data is only loaded on the first call to get_data / get_channel_data / data.
+
+        The samples are kept as the raw int16 ADC codes (raw_data) and the Intan scaling (0.195 µV per bit) is applied on access, with the
+        output dtype chosen by the caller (see get_data).
+
+        Recordings in the container format (see micromap_format) are described by their own header (the counter type is taken from it);
+        the old headerless .mmap files are described by the _metadata.pkl file next to them.
+        """
+        if counter_type not in ('n', 'us'):
+            raise ValueError("Invalid counter type. Use 'us' for unsigned or 'n' for normal.")
+
         self.folder_path = folder_path
+        self.counter_type = counter_type
+        self.fill_method = fill_method
+        self.raw_data = None                                                                                        # Raw codes (channels, samples)
+        self._data = None                                                                                           # Scaled (or processed) data
+        self._seek_index = None                                                                                     # (frame, unfolded counter) pairs used by get_segment
         self._load_metadata()
-        
-        if counter_type == 'us':
+        self._map_binary_data()
+
+        if preload:
+            self._load()
+
+    def _load(self):
+        if self.counter_type == 'us':
             self._load_binary_data_us()
             # self._fill_missing_data()
-        elif counter_type == 'n':
-            self._load_binary_data()
-            self._fill_missing_data()
         else:
-            raise ValueError("Invalid counter type. Use 'us' for unsigned or 'n' for normal.")
+            self._load_binary_data()
+            self._fill_missing_data(self.fill_method)
 
     def _load_metadata(self):
+        self.bin_file = self._find_binary_file()
+        if micromap_format.is_recording_file(self.bin_file):
+            self.recording = micromap_format.RecordingFile(self.bin_file)
+            header = self.recording.header
+            if header.counter_type is None:
+                raise ValueError("The recording has no packet counter (ADS1298 recording?). Use MicroMAPReaderADS.")
+
+            self.metadata = header.to_dict()
+            self.counter_type = header.counter_type
+            self.num_channels = header.num_channels
+            self.channels = header.channels
+            self.sampling_freq = header.sampling_freq
+            self.scale = header.scale                                                                               # µV per bit
+            return
+
+        self.recording = None
         for file in os.listdir(self.folder_path):
             if file.endswith("_metadata.pkl"):
                 metadata_file = os.path.join(self.folder_path, file)
@@ -36,324 +77,610 @@ class MicroMAPReader:
         self.num_channels = self.metadata["Number of Channels"]
         self.channels = self.metadata["Channels"]
         self.sampling_freq = self.metadata["Sampling Frequency"]
+        self.scale = micromap_frames.INTAN_SCALE                                                                    # µV per bit
 
-    def _load_binary_data_us(self):
-        # Find the .mmap file
+    def _find_binary_file(self):
+        if os.path.isfile(self.folder_path):                                                                        # Path of the .mmap file itself
+            bin_file = self.folder_path
+            self.folder_path = os.path.dirname(bin_file)
+            return bin_file
         for file in os.listdir(self.folder_path):
             if file.endswith(".mmap"):
-                bin_file = os.path.join(self.folder_path, file)
-                break
-        else:
-            raise FileNotFoundError("Binary (.mmap) file not found.")
+                return os.path.join(self.folder_path, file)
+        raise FileNotFoundError("Binary (.mmap) file not found.")
 
-        with open(bin_file, "rb") as f:
-            raw = f.read()
-
-        block_size = 4 + 2 * self.num_channels  # 4 bytes for timestamp + 2*num_channels for data
-        data = bytearray()
-        timestamps = []
+    def _map_binary_data(self):
+        """Maps the .mmap file with numpy.memmap instead of reading it. Each frame is a structured record (counter + one int16 per channel), so
+        the counters and the samples are exposed as views of the file and nothing is read from disk until it is used. An incomplete last frame
+        is ignored.
+        """
+        if self.recording is not None:
+            self.frame_dtype = self.recording.header.frame_dtype()
+            self.num_frames = self.recording.num_frames
+            data_offset = self.recording.data_offset
+        else:
+            self.frame_dtype = micromap_frames.rhd_frame_dtype(self.num_channels, self.counter_type)
+            self.num_frames = os.path.getsize(self.bin_file) // self.frame_dtype.itemsize
+            data_offset = 0
 
-        for i in range(0, len(raw), block_size):
-            block = raw[i:i+block_size]
-            if len(block) == block_size:
-                # Read timestamp (4 bytes, big endian)
-                timestamp_high = int.from_bytes(block[0:2], byteorder = 'little')
-                timestamp_low = int.from_bytes(block[2:4], byteorder = 'little')
-                timestamp = (timestamp_high << 16) | timestamp_low
-                timestamps.append(timestamp)
-                data.extend(block[4:])  # Data starts after 4 bytes
+        if self.num_frames == 0:
+            raise ValueError("Binary (.mmap) file does not contain a complete frame.")
 
-        self.timestamps = np.array(timestamps, dtype=np.uint64)  # Save timestamps as array
-        self.packet_counters = self._get_unfold_counter(self.timestamps, max_value = int(2**32 - 1)) # For compatibility (optional)
+        self.frames = np.memmap(self.bin_file, dtype = self.frame_dtype, mode = 'r', offset = data_offset, shape = (self.num_frames,))
+        self.raw_counters = micromap_frames.rhd_frame_counters(self.frames, self.counter_type)                      # View for 'n', combined timestamps for 'us'
+        self.raw_samples = self.frames['samples'].T                                                                 # (channels, samples) int16 view of the file
 
-        # Unpack to int16 (signed)
-        unpacked = struct.unpack('<' + str(len(data) // 2) + 'h', data)
-        array = np.array(unpacked, dtype=np.int64).reshape(-1, self.num_channels)
+    def _load_binary_data_us(self):
+        self.timestamps = np.asarray(self.raw_counters, dtype = np.uint64)                                          # Save timestamps as array
+        self.packet_counters = self._get_unfold_counter(self.timestamps, max_value = int(2**32 - 1))                # For compatibility (optional)
+        self.gaps = np.empty((0, 2), dtype = np.int64)
 
-        # Apply Intan scaling: 0.195 µV per bit
-        self.data = array.T * 0.195                                 # Output in µV
-        self.num_samples = array.shape[1]
+        self.raw_data = self.raw_samples                                                                            # int16 codes, scaled on access
+        self.num_samples = self.raw_data.shape[1]
 
-        if self.data.shape[0] != self.num_channels:
-            raise ValueError(f"Data shape mismatch: expected {self.num_channels} channels, got {self.data.shape[0]} channels.")
+        if self.raw_data.shape[0] != self.num_channels:
+            raise ValueError(f"Data shape mismatch: expected {self.num_channels} channels, got {self.raw_data.shape[0]} channels.")
 
     def _load_binary_data(self):
-        # Find the .bin file
-        for file in os.listdir(self.folder_path):
-            if file.endswith(".mmap"):
-                bin_file = os.path.join(self.folder_path, file)
-                break
-        else:
-            raise FileNotFoundError("Binary (.mmap) file not found.")
-
-        with open(bin_file, "rb") as f:
-            raw = f.read()
-
-        block_size = 2 * self.num_channels + 2  # 2 bytes to counter + 2*num_channels 
-        data = bytearray()
-        folded_packet_counters = []
-
-        for i in range(0, len(raw), block_size):
-            block = raw[i:i + block_size]
-            if len(block) == block_size:
-                count = int.from_bytes(block[0:2], byteorder = 'big')
-                folded_packet_counters.append(count)
-                data.extend(block[2:])
-
-        folded_packet_counters = np.array(folded_packet_counters)        
-        self.packet_counters = self._get_unfold_counter(folded_packet_counters, max_value = int(2**16 - 1))                                                 # Unfold the counter values (counter resets to 0 after reaching 2^16 - 1 - 16bits counter)
-
-        # Unpack to int16 (signed)
-        unpacked = struct.unpack('<' + str(len(data) // 2) + 'h', data)
-        array = np.array(unpacked, dtype = np.int64).reshape(-1, self.num_channels)
+        folded_packet_counters = np.asarray(self.raw_counters, dtype = np.int64)
+        self.packet_counters = self._get_unfold_counter(folded_packet_counters, max_value = int(2**16 - 1))            # Unfold the counter values (counter resets to 0 after reaching 2^16 - 1 - 16bits counter)
 
-        # Apply Intan scaling: 0.195 µV per bit
-        self.data = array.T * 0.195  # Output in µV
-        self.num_samples = array.shape[1]
+        self.raw_data = self.raw_samples                                                                            # int16 codes, scaled on access
+        self.num_samples = self.raw_data.shape[1]
 
-        if self.data.shape[0] != self.num_channels:
-            raise ValueError(f"Data shape mismatch: expected {self.num_channels} channels, got {self.data.shape[0]} channels.")
+        if self.raw_data.shape[0] != self.num_channels:
+            raise ValueError(f"Data shape mismatch: expected {self.num_channels} channels, got {self.raw_data.shape[0]} channels.")
 
     def _get_unfold_counter(self, counter_series, max_value = 255):
         """The counter values are folded, i.e., when the counter reaches the maximum value, it resets to 0. The last implementation the counter
         is a 16 bits counter, so the maximum value is 2^16 - 1. The function unfolds the counter values to get the real incremental values.
 
         Ex: (if the counter is 0-255) [0, 1, 2, ..., 254, 255, 0, 1, 2, ...] -> [0, 1, 2, ..., 254, 255, 256, 257, ...]
+
+        The unfolding is vectorized (see micromap_frames.CounterUnfolder, which also unfolds chunk by chunk for streaming).
         """
-        list_max = np.max(counter_series)
-        list_min = np.min(counter_series)
-        if list_max > max_value:
-            print(f"Counter values: {list_min} to {list_max}.")
-            raise ValueError(f"Counter values out of bounds (0 to {max_value}).")
-        
-        counter_series = np.asarray(counter_series)
-        unfolded = [counter_series[0]]
-        rollover = 0
-        
-        for i in range(1, len(counter_series)):
-            current = counter_series[i]
-            prev = counter_series[i-1]
-            
-            if current < prev:
-                rollover += 1
-            
-            unfolded.append((current + rollover * (max_value + 1)))
-        
-        # fig, ax = plt.subplots(2, 1, figsize=(10, 5))
-        # ax[0].scatter(range(len(unfolded)), unfolded, color = 'maroon', s = 4)
-        # ax[0].plot(unfolded, color = 'dimgrey', label = "Unfolded Packet Counter")
-
-        # for i in range(0, len(counter_series) + 1, self.sampling_freq*5):
-        #     ax[0].axvline(x = i, color = 'black', linestyle = '--', label = "Error")
-
-        # ax[1].plot(numpy.diff(unfolded), color = 'dimgrey', label = "Unfolded Packet Counter")
-        # # ax[1].axhline(y = (1/self.sampling_freq)*1000000, color = 'black', linestyle = '-')
-        # plt.show()
-
-        return np.array(unfolded)
-
-    def _fill_missing_data(self, fill_method = 'last', ax = None):
+        return micromap_frames.CounterUnfolder(max_value).unfold(counter_series)
+
+    def _fill_missing_data(self, fill_method = 'last'):
         """
         This function fills the missing data. If a packet is lost, the data lost the time synchronization (packets after the each packet lost are 
-        shifted in time). The function fills the missing data with the last value or with NaN. The function also counts the number of packets lost.
+        shifted in time). The function fills the missing data with the last value, with NaN or by linear interpolation. The function also counts
+        the number of packets lost.
 
         To perform the filling, the function checks the packet counter values. If the difference between two consecutive packet counters is greater 
-        than 1, it means that a packet was lost.     
+        than 1, it means that a packet was lost. The output is allocated once and filled in bulk (see micromap_frames.fill_gaps), and the gaps are
+        kept in self.gaps as a (start, length) table in samples.
 
         ps:  If the lost is bigger than 2^16 - 1, the function will not be able to fill the data correctly.  
         """
-        filled_counter = []
-        filled_data = []
-        packets_lost = 0
-
-        # if ax is None:
-        #     fig, ax = plt.subplots(1, 1, figsize=(10, 5))
-        
-        # ax.scatter(self.packet_counters, self.packet_counters, color = 'maroon', s = 4, label = "Samples")
-
-        for i in range(len(self.packet_counters) - 1):
-            curr_val = self.packet_counters[i]
-            next_val = self.packet_counters[i + 1]
-            
-            if curr_val == next_val:
-                print("WARNING: Packet counter values are equal. Check the data.")
-
-            curr_data = self.data[:, i]
-
-            filled_counter.append(curr_val)
-            filled_data.append(curr_data)
-
-            gap = next_val - curr_val - 1
-            if gap > 0:
-                print(f"Packet counter error between {curr_val} and {next_val}.")
-                for j in range(1, gap + 1):
-                    filled_counter.append(curr_val + j)                        
-                    if fill_method == 'last':
-                        filled_data.append(curr_data)                               # fill with the last value
-                    elif fill_method == 'nan':
-                        filled_data.append(np.full(self.num_channels, np.nan))    # fill with nans
-                    else:
-                        raise ValueError("Invalid fill method. Use 'last' or 'nan'.")
-                    packets_lost += 1
-
-                # ax.axvspan(xmin = i, xmax = i + gap, color = 'black', alpha = 0.2, label = "Lost Packets")
-
-        filled_counter.append(self.packet_counters[-1])
-        filled_data.append(self.data[:, -1])
-
-        self.data = np.array(filled_data).T
-        self.packet_counters = np.array(filled_counter)
-        self.packets_lost = packets_lost
-
-        # fig, ax = plt.subplots(2, 1, figsize=(10, 5))
-        # ax[0].scatter(range(len(self.packet_counters)), self.packet_counters, color = 'maroon', s = 4)
-        # ax[1].plot(range(len(self.data[0])), self.data[0], color = 'maroon')
-        # for i in range(0, len(self.packet_counters) + 1, self.sampling_freq*5):
-        #     ax[0].axvline(x = i, color = 'black', linestyle = '--', label = "Error")
-        #     ax[1].axvline(x = i, color = 'black', linestyle = '--', label = "Error")
-
-    def get_channel_data(self, index):
-        """Retorna os dados de um canal (index de 1 a N)."""
-        return self.data[index - 1, :]
-
-    def get_data(self):
-        """Retorna todos os dados (channels, samples)."""
-        return self.data
+        if np.any(np.diff(self.packet_counters) == 0):
+            print("WARNING: Packet counter values are equal. Check the data.")
+
+        if fill_method not in ('last', 'nan', 'linear'):
+            raise ValueError("Invalid fill method. Use 'last', 'nan' or 'linear'.")
+
+        # The raw codes are int16, so 'nan' gaps are filled with the last value here and set to NaN when the data is scaled
+        raw_method = 'last' if fill_method == 'nan' else fill_method
+        self.raw_data, self.packet_counters, self.gaps = micromap_frames.fill_gaps(self.raw_data, self.packet_counters, raw_method)
+        self.fill_method = fill_method
+        self.packets_lost = int(self.gaps[:, 1].sum())
+        self.num_samples = self.raw_data.shape[1]
+
+        if self.packets_lost > 0:
+            print(f"Packet counter errors: {len(self.gaps)} gaps, {self.packets_lost} packets lost (filled with '{fill_method}').")
+
+    def _scale(self, raw, dtype, start = 0):
+        """Converts raw codes (channels, samples) or (samples,) to µV with the given dtype. With the 'nan' fill method, the filled samples
+        (self.gaps, shifted by start) are set to NaN."""
+        scaled = np.multiply(raw, self.scale, dtype = dtype)
+        if self.fill_method == 'nan':
+            for gap_start, gap_length in self.gaps:
+                first = max(gap_start - start, 0)
+                last = min(gap_start + gap_length - start, scaled.shape[-1])
+                if first < last:
+                    scaled[..., first:last] = np.nan
+        return scaled
+
+    @property
+    def data(self):
+        """Scaled data (channels, samples) in µV. Kept for compatibility: the first access converts all raw codes to float64 and keeps them,
+        so prefer get_data / get_channel_data, which scale on access and let the caller choose the dtype."""
+        if self._data is None:
+            self._data = self.get_data(np.float64)
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self.num_samples = value.shape[1]
+
+    def get_channel_data(self, index, dtype = np.float64):
+        """Retorna os dados de um canal (index de 1 a N), em µV com o dtype escolhido (float32 ou float64)."""
+        if self._data is not None:
+            return self._data[index - 1, :].astype(dtype, copy = False)
+        if self.raw_data is None:
+            self._load()
+        return self._scale(self.raw_data[index - 1, :], dtype)
+
+    def get_data(self, dtype = np.float64):
+        """Retorna todos os dados (channels, samples), em µV com o dtype escolhido (float32 ou float64)."""
+        if self._data is not None:
+            return self._data.astype(dtype, copy = False)
+        if self.raw_data is None:
+            self._load()
+        return self._scale(self.raw_data, dtype)
 
     def get_time_vector(self):
         """Retorna vetor de tempo com base na frequência de amostragem."""
-        samples = self.data.shape[1]
-        return np.arange(samples) / self.sampling_freq
-    
-    def check_arduino_test(self):
-        """The Arduino test is a signal with the number of the channel varying from num_channel to -num_channel, making a sawtooth signal."""        
-        expected_value = {}
-        for i in range(32):
-            # Convert the integer to bytes
-            byte_array = i.to_bytes(2, byteorder='big', signed=True)
-            # Convert value
-            unpacked = struct.unpack('<' + str(1) + 'h', byte_array)[0]
-            scaled = unpacked * 0.195
-            expected_value[i] = scaled
-
-        # Check if the data is a sawtooth signal
-        stat = {}
-        for i in range(self.num_channels):
-            channel_data = self.get_channel_data(i + 1)
-            first_value = channel_data[0]
-            
-            expected_signal = np.ones(len(channel_data))*expected_value[i]       # Expected signal is a sawtooth signal with the number of the channel varying from num_channel to -num_channel
-            
-            if first_value > 0:
-                expected_signal[1::2] = -expected_signal[1::2]                   # Invert the signal for odd samples   
+        if self.raw_data is None and self._data is None:
+            self._load()
+        return np.arange(self.num_samples) / self.sampling_freq
+
+    def iter_chunks(self, seconds = 10, channels = None, overlap = 0, fill_method = 'last', dtype = np.float64):
+        """Iterates over the recording in blocks read straight from the memory-mapped file, so the peak memory of a pass over the recording
+        is bounded by the block size and not by the file size (it works with preload = False).
+
+        The counters are unfolded and the lost packets are filled chunk by chunk (the last frame of a block is carried to the next one), so the
+        concatenated blocks are the same as the data loaded by __init__.
+
+        Args:
+            seconds: number of seconds of new samples in each block.
+            channels: channels to read (index from 1 to N, as get_channel_data). None reads all channels.
+            overlap: seconds of the previous block repeated at the start of each block.
+            fill_method: 'last', 'nan' or 'linear' (see _fill_missing_data). Not used for the 'us' counter.
+            dtype: output dtype (scaled to µV).
+
+        Yields:
+            (offset, block): sample index of the first column of the block and the (channels, samples) scaled block.
+        """
+        chunk_frames = max(1, int(round(seconds * self.sampling_freq)))
+        overlap_samples = int(round(overlap * self.sampling_freq))
+        if overlap_samples < 0 or overlap_samples >= chunk_frames:
+            raise ValueError("overlap must be positive and smaller than the block duration.")
+
+        rows = slice(None) if channels is None else np.asarray(channels) - 1
+        max_value = int(2**16 - 1) if self.counter_type == 'n' else int(2**32 - 1)
+        unfolder = micromap_frames.CounterUnfolder(max_value)
+
+        last_counter = None                                                                                     # Last received frame of the previous block
+        last_samples = None
+        tail = None                                                                                             # Overlap kept from the previous block
+        offset = 0                                                                                              # Output index of the next new sample
+
+        for start in range(0, self.num_frames, chunk_frames):
+            frames = self.frames[start:start + chunk_frames]
+            counters = unfolder.unfold(micromap_frames.rhd_frame_counters(frames, self.counter_type))
+            raw = frames['samples'][:, rows].T                                                                  # int16 codes
+
+            if self.counter_type == 'n':
+                if last_counter is not None:
+                    counters = np.concatenate(([last_counter], counters))
+                    raw = np.concatenate((last_samples, raw), axis = 1)
+                last_counter = counters[-1]
+                last_samples = raw[:, -1:].copy()
+                if fill_method == 'nan':
+                    block = micromap_frames.fill_gaps(np.multiply(raw, self.scale, dtype = dtype), counters, 'nan')[0]
+                else:                                                                                           # Filled on the raw codes, as __init__ ('linear' is rounded to whole codes)
+                    block = np.multiply(micromap_frames.fill_gaps(raw, counters, fill_method)[0], self.scale, dtype = dtype)
+                if start > 0:
+                    block = block[:, 1:]                                                                        # Carried frame was already yielded
             else:
-                expected_signal[0::2] = -expected_signal[0::2]                   # Invert the signal for even samples        
+                block = np.multiply(raw, self.scale, dtype = dtype)
 
-            stat[i] = pearsonr(channel_data, expected_signal)[0]                 # Calculate the correlation coefficient
+            new_samples = block.shape[1]
+            if tail is not None and tail.shape[1] > 0:
+                block = np.concatenate((tail, block), axis = 1)
 
-        return stat
+            yield offset - (block.shape[1] - new_samples), block
 
-    def check_packet_counter(self, plot = False):
+            offset += new_samples
+            if overlap_samples > 0:
+                tail = block[:, block.shape[1] - min(overlap_samples, block.shape[1]):]
+    
+    seek_stride = 32768                                                                                             # Frames between seek points of the old files (no index)
+
+    def _build_seek_index(self):
+        """Returns the frame index and the unfolded counter of a set of seek points. Container recordings use their block index; the old
+        files are sampled every seek_stride frames (a coarse scan that is done once and kept). Between two seek points the counter advanced
+        at least one step per frame, which gives the number of rollovers in between.
         """
-        Function to check the packet counter. The function checks if the packet counter is incremented by 1 for each sample. If the difference between 
-        two consecutive packet counters is greater than 1, it means that a packet was lost. The function also plots the packet counter values.
+        if self._seek_index is not None:
+            return self._seek_index
+
+        if self.recording is not None and self.recording.index is not None and len(self.recording.index) > 0:
+            positions = self.recording.block_frames()
+            folded = self.recording.index['counter'].astype(np.int64)
+            valid = positions < self.num_frames
+            positions, folded = positions[valid], folded[valid]
+        else:
+            positions = np.arange(0, self.num_frames, self.seek_stride, dtype = np.int64)
+            folded = np.asarray(self.raw_counters[positions], dtype = np.int64)
+
+        if len(positions) == 0 or positions[0] != 0:
+            positions = np.concatenate(([0], positions))
+            folded = np.concatenate(([int(self.raw_counters[0])], folded))
+
+        period = int(2**16) if self.counter_type == 'n' else int(2**32)
+        steps = np.diff(folded) % period                                                                            # Counter advance modulo the period
+        frames = np.diff(positions)
+        steps += np.maximum(0, -((steps - frames) // period)) * period                                            # Adds the rollovers needed to cover the frames
+        unfolded = np.concatenate(([folded[0]], folded[0] + np.cumsum(steps)))
+
+        self._seek_index = (positions, unfolded)
+        return self._seek_index
+
+    def get_segment(self, start_s, stop_s, channels = None, dtype = np.float64):
+        """Returns the samples between start_s and stop_s seconds (channels, samples) in µV, reading only the needed frames from the file.
+
+        The times are mapped to the gap filled time line (the same as get_data): the seek points give the frames around the requested
+        counters, only those frames are read, unfolded and gap filled, and the result is cut at the exact samples. If the data is already in
+        memory (loaded or processed), it is sliced instead.
+
+        Args:
+            start_s, stop_s: segment limits in seconds (from the start of the recording).
+            channels: channels to read (index from 1 to N). None reads all channels.
+            dtype: output dtype.
+        """
+        rows = slice(None) if channels is None else np.asarray(channels) - 1
+        first = max(int(round(start_s * self.sampling_freq)), 0)
+        last = int(round(stop_s * self.sampling_freq))
+
+        if self._data is not None:
+            return self._data[rows, first:last].astype(dtype, copy = False)
+        if self.raw_data is not None:
+            return self._scale(self.raw_data[rows, first:last], dtype, start = first)
+
+        if self.counter_type == 'us':                                                                               # No gap filling: samples are frames
+            frames = self.frames[first:last]
+            return np.multiply(frames['samples'][:, rows].T, self.scale, dtype = dtype)
+
+        positions, unfolded = self._build_seek_index()
+        target_first = unfolded[0] + first                                                                          # Counter of the first requested sample
+        target_last = unfolded[0] + last
+        seek_first = max(np.searchsorted(unfolded, target_first, side = 'right') - 1, 0)
+        seek_last = np.searchsorted(unfolded, target_last, side = 'left')
+        frame_first = positions[seek_first]
+        frame_last = positions[seek_last] + 1 if seek_last < len(positions) else self.num_frames                   # One frame after the segment (for 'linear')
+
+        frames = self.frames[frame_first:frame_last]
+        unfolder = micromap_frames.CounterUnfolder(int(2**16 - 1))
+        unfolder.rollovers = int(unfolded[seek_first] - frames['counter'][0]) // int(2**16)
+        counters = unfolder.unfold(frames['counter'])
+        raw = frames['samples'][:, rows].T
+
+        raw_method = 'last' if self.fill_method == 'nan' else self.fill_method
+        raw, counters, gaps = micromap_frames.fill_gaps(raw, counters, raw_method)
+        selected = (counters >= target_first) & (counters < target_last)
+        offset = int(np.argmax(selected)) if selected.any() else 0
+        segment = np.multiply(raw[:, selected], self.scale, dtype = dtype)
+
+        if self.fill_method == 'nan':
+            for gap_start, gap_length in gaps:
+                gap_first = max(gap_start - offset, 0)
+                gap_last = min(gap_start + gap_length - offset, segment.shape[1])
+                if gap_first < gap_last:
+                    segment[:, gap_first:gap_last] = np.nan
+        return segment
+
+    def pipeline(self, seconds = 10, channels = None, dtype = np.float64):
+        """Returns a lazy processing pipeline over this recording (see micromap_pipeline.Pipeline): the steps are recorded and run in a
+        single chunked pass, to an array (to_array) or to a new recording (to_file)."""
+        return micromap_pipeline.Pipeline(self, seconds, channels, dtype)
+
+    def welch(self, nperseg = None, noverlap = None, channels = None, dtype = np.float64, workers = 1, backend = 'thread'):
+        """Returns the Welch PSD (freqs, (channels, freqs) psd) of the recording, computed in one chunked pass (see micromap_spectral.welch)."""
+        return micromap_spectral.welch(self, nperseg, noverlap, channels = channels, dtype = dtype, workers = workers, backend = backend)
+
+    def spectrogram(self, nperseg = None, noverlap = None, column_seconds = None, channels = None, dtype = np.float64, workers = 1, backend = 'thread'):
+        """Returns the spectrogram (freqs, times, (channels, freqs, columns) sxx) of the recording, computed in one chunked pass (see
+        micromap_spectral.spectrogram)."""
+        return micromap_spectral.spectrogram(self, nperseg, noverlap, column_seconds = column_seconds, channels = channels, dtype = dtype,
+                                             workers = workers, backend = backend)
+
+    def check_arduino_test(self, seconds = 10, codes = None, max_breaks = 100000):
+        """The Arduino test is a signal with the number of the channel varying from num_channel to -num_channel, making a sawtooth signal.
+        Checks the raw frames of the file in chunks of seconds against that pattern (any number of channels, whatever was loaded or
+        processed) and returns a micromap_checks.ArduinoTestReport (True if the test passed) with the frames where each channel breaks.
+
+        Args:
+            seconds: duration of the chunks of frames.
+            codes: expected code of each channel (default: micromap_checks.arduino_test_codes).
+            max_breaks: number of breaks whose frame index is kept.
         """
-        
+        codes = micromap_checks.arduino_test_codes(self.num_channels) if codes is None else codes
+        checker = micromap_checks.ArduinoTestChecker(codes, max_breaks)
+        chunk_frames = max(1, int(round(seconds * self.sampling_freq)))
+        for start in range(0, self.num_frames, chunk_frames):
+            checker.process(self.frames['samples'][start:start + chunk_frames])
+        return checker.report()
+
+    def check_packet_counter(self, plot = False, report_file = None, seconds = 60, max_events = 1000000):
+        """
+        Function to check the packet counter. The counter must be incremented by 1 for each sample (or by the sampling period, for the 'us'
+        timestamps): every discontinuity (lost packets, duplicated frames and backward jumps) is found in one pass over the raw counters of
+        the file, in chunks of seconds, so it works on files of any size without loading them.
+
+        Returns a micromap_checks.PacketCounterReport, which is True if the counter has no discontinuity. If report_file is given, the report
+        is also written there as JSON. The plot shows the packets lost in each minute.
+        """
+        if self.counter_type == 'us':
+            checker = micromap_checks.PacketCounterChecker(self.sampling_freq, 2**32 - 1, 1e6 / self.sampling_freq, max_events)
+        else:
+            checker = micromap_checks.PacketCounterChecker(self.sampling_freq, 2**16 - 1, 1, max_events)
+
+        chunk_frames = max(1, int(round(seconds * self.sampling_freq)))
+        for start in range(0, self.num_frames, chunk_frames):
+            checker.process(self.raw_counters[start:start + chunk_frames])
+        report = checker.report()
+
+        for event in report.events[:10]:
+            print(f"Packet counter {micromap_checks.EVENT_KINDS[event['kind']]} at frame {event['frame']} ({event['length']} packets).")
+        if report_file is not None:
+            report.to_json(report_file)
+
         if plot:
             _, ax = plt.subplots()
-            ax.plot(self.packet_counters, color = 'dimgrey', label = "Packet Counter")
-            ax.scatter(range(len(self.packet_counters)), self.packet_counters, color = 'maroon', s = 4, label = "Samples")
+            ax.bar(np.arange(report.loss_per_minute.size), report.loss_per_minute, color = 'maroon', label = "Lost packets")
             ax.set_title("Packet Counter")
-            ax.set_xlabel("Samples")
-            ax.set_ylabel("Counter Value")
-        
-        for i in range(len(self.packet_counters) - 1):
-            curr_val = self.packet_counters[i]
-            next_val = self.packet_counters[i + 1]
-
-            if next_val - curr_val != 1:
-                print(f"Packet counter error between {curr_val} and {next_val}.")
-
-                if plot:
-                    ax.axvline(x = i, color = 'black', linestyle = '--', label = "Error")
-                    ax.legend(loc = 'upper right')
-                    plt.show()
-
-                return False
-        
-        if plot:
+            ax.set_xlabel("Minute")
+            ax.set_ylabel("Lost packets")
             ax.legend(loc = 'upper right')
             plt.show()
-        
-        return True
-
-    def notch_filter(self, frequencies):
-        frequencies = numpy.array(frequencies)
-        for a in range(0, len(self.data)):
-            self.data[a] = mne.filter.notch_filter(self.data[a], self.sampling_freq, frequencies, verbose='WARNING')
-
-    def bandpass_filter(self, low, high):
-        for a in range(0, len(self.data)):
-            self.data[a] = mne.filter.filter_data(self.data[a], self.sampling_freq, low, high, method='iir', verbose='WARNING')
 
-    def resample(self, new_rate):
-        self.data = resample(self.data, int(len(self.data[0])/(self.sampling_freq/new_rate)), axis=1)
-        self.sampling_freq = new_rate
+        return report
+
+    def notch_filter(self, frequencies, quality = 30, zero_phase = True, workers = 1, backend = 'thread'):
+        """Removes the line noise (and harmonics) of all channels at once with a cascade of IIR notch filters (width frequency / quality).
+        The data is filtered in place, in chunks, with zero-phase (forward-backward) or causal filtering. workers > 1 splits the channels
+        in groups filtered in parallel (see micromap_parallel; None uses all the cores)."""
+        sos = micromap_filters.notch_sos(frequencies, self.sampling_freq, quality)
+        with micromap_parallel.ChannelExecutor(workers, backend) as executor:
+            executor.apply(micromap_filters.SosFilter(sos, zero_phase).apply, self.data)
+
+    def bandpass_filter(self, low, high, order = 4, zero_phase = True, workers = 1, backend = 'thread'):
+        """Butterworth band pass filter of all channels at once (low = None for a low pass, high = None for a high pass), in place."""
+        sos = micromap_filters.bandpass_sos(low, high, self.sampling_freq, order)
+        with micromap_parallel.ChannelExecutor(workers, backend) as executor:
+            executor.apply(micromap_filters.SosFilter(sos, zero_phase).apply, self.data)
+
+    def resample(self, new_rate, method = 'fft', output = None, seconds = 10, workers = 1, backend = 'thread'):
+        """Resamples all channels to new_rate Hz.
+
+        'fft' (the default) is scipy.signal.resample over the whole array in memory. 'poly' uses rational polyphase resampling (the same
+        output as scipy.signal.resample_poly), chunk by chunk with the filter history carried between chunks, so the input is never loaded
+        at once: if the data was not loaded (or processed) yet, it is read from the file with iter_chunks. The two methods do not give the
+        same samples ('poly' low pass filters before decimating instead of truncating the spectrum).
+
+        Args:
+            new_rate: new sampling frequency in Hz (the ratio to the current rate is approximated by a fraction, e.g. 30000 -> 1000 is 1/30).
+            method: 'fft' or 'poly' (needed for output, seconds, workers and backend). 'poly' raises a ValueError if new_rate cannot be
+                reached exactly with up and down factors up to 1000 (see micromap_filters.rate_ratio).
+            output: folder to write the resampled data as a new recording ('f4' samples in µV, sequential packet counter). The data of this
+                reader is not changed and a reader of the new recording is returned (preload = False). None replaces the data in memory.
+            seconds: duration of the input chunks ('poly').
+            workers, backend: channel groups resampled in parallel ('poly', see micromap_parallel). The resampler keeps its history between
+                chunks in the calling process, so the 'process' backend works on the data in memory (it is loaded if needed).
+        """
+        if method not in ('fft', 'poly'):
+            raise ValueError("Invalid method. Use 'fft' or 'poly'.")
+        if method == 'fft':
+            if output is not None or workers != 1 or backend != 'thread':
+                raise ValueError("The 'fft' method only works in memory on one core. Use method = 'poly' for output, workers or backend.")
+            self.data = resample(self.data, int(len(self.data[0])/(self.sampling_freq/new_rate)), axis=1)
+            self.sampling_freq = new_rate
+            return self
+
+        up, down = micromap_filters.rate_ratio(new_rate, self.sampling_freq)
+        chunk_samples = max(1, int(round(seconds * self.sampling_freq)))
+
+        with micromap_parallel.ChannelExecutor(workers, backend) as executor:
+            if backend == 'process' and executor.workers > 1:
+                # The worker processes do not keep state between calls: each one resamples its channels over the whole recording
+                task = functools.partial(micromap_filters.resample_array, up = up, down = down, chunk_size = chunk_samples)
+                blocks = [executor.map(task, self.data)]
+            else:
+                if self._data is not None:
+                    chunks = ((start, self._data[:, start:start + chunk_samples]) for start in range(0, self._data.shape[1], chunk_samples))
+                else:
+                    chunks = self.iter_chunks(seconds, fill_method = self.fill_method if self.fill_method != 'nan' else 'last')   # NaN would spread through the filter
+                resamplers = [micromap_filters.StreamingResampler(up, down) for _ in executor.groups(self.num_channels)]
+
+                def resampled_blocks():
+                    for _, block in chunks:
+                        yield executor.map([resampler.process for resampler in resamplers], block)
+                    yield np.concatenate([resampler.flush() for resampler in resamplers], axis = 0)
+                blocks = resampled_blocks()
+
+            if output is None:
+                self.data = np.concatenate(list(blocks), axis = 1)
+                self.sampling_freq = new_rate
+                return self
+
+            os.makedirs(output, exist_ok = True)
+            name = os.path.splitext(os.path.basename(self.bin_file))[0]
+            header = micromap_format.RecordingHeader.from_metadata(self.metadata, new_rate, self.channels,
+                                                                   index_period = max(1, int(round(seconds * new_rate))))
+            path = os.path.join(output, f"{name}_{new_rate}Hz.mmap")
+            with micromap_format.RecordingWriter(path, header) as writer:
+                for block in blocks:
+                    writer.write_samples(block)
+        return MicroMAPReader(path, preload = False)
 
 class MicroMAPReaderADS:
-    def __init__(self, folder_path):
+    def __init__(self, folder_path, preload = True):
+        """Opens a MicroMAP ADS1298 recording folder. The samples are kept as the raw 24 bits codes (raw_data, int32) and the LSB scaling is
+        applied on access (see get_data). With preload = False the data is only decoded on the first access."""
         self.folder_path = folder_path
+        self.raw_data = None                                            # Raw codes (channels, samples)
+        self._data = None                                               # Scaled (or processed) data
         self._load_metadata()
-        self._load_binary_data()
+        self._map_binary_data()
+        if preload:
+            self._load_binary_data()
 
     def _load_metadata(self):
-        self.num_channels = 8
-        self.channels = [1,2,3,4,5,6,7,8]
-        self.sampling_freq = 2000
-
-    def _load_binary_data(self):
         # Find the .mmap file
         for file in os.listdir(self.folder_path):
             if file.endswith(".mmap"):
-                bin_file = os.path.join(self.folder_path, file)
+                self.bin_file = os.path.join(self.folder_path, file)
                 break
         else:
             raise FileNotFoundError("Binary (.mmap) file not found.")
 
-        with open(bin_file, "rb") as f:
-            raw = f.read()
-
-        block_size = 3 + 3 * self.num_channels  # 3 bytes for header + 3*num_channels bytes for data
-
-        if len(raw) % block_size != 0:
-            raise ValueError(f"File size {len(raw)} is not a multiple of block size {block_size}")
-
-        # Remove header bytes (3 bytes per block)
-        flag_indexes_template = numpy.ones(block_size, dtype=bool)
-        flag_indexes_template[0:3] = False  # Ignore the 3-byte header
-        flag_indexes = numpy.tile(flag_indexes_template, len(raw) // block_size)
-        clean_bytes = numpy.frombuffer(raw, dtype=numpy.uint8)[flag_indexes].tobytes()
-
-        # Convert to signed 24-bit integers
-        values = []
-        for i in range(0, len(clean_bytes), 3):
-            b1, b2, b3 = clean_bytes[i:i + 3]
-            val = b1 << 16 | b2 << 8 | b3
-            if val & 0x800000:
-                val -= 0x1000000  # Apply 2's complement
-            values.append(val)
-
-        values = numpy.array(values, dtype=numpy.float32)
-
-        # Set LSB size (same as in your .txt reader)
-        Vref = 4
-        pga_gain = 12
-        lsb_size = (Vref) / (pga_gain*((2 ** 23) - 1))
-        values *= lsb_size * 1e6  # Convert to microvolts
-        
-        # Organize by channels
-        self.data = numpy.array([values[i::self.num_channels] for i in range(self.num_channels)])
-        self.num_samples = self.data.shape[1]
-
-        if self.data.shape[0] != self.num_channels:
-            raise ValueError(f"Data shape mismatch: expected {self.num_channels} channels, got {self.data.shape[0]} channels.")
\ No newline at end of file
+        if micromap_format.is_recording_file(self.bin_file):
+            self.recording = micromap_format.RecordingFile(self.bin_file)
+            header = self.recording.header
+            if header.sample_format != 'i3':
+                raise ValueError("The recording does not have 24 bits samples. Use MicroMAPReader.")
+
+            self.metadata = header.to_dict()
+            self.num_channels = header.num_channels
+            self.channels = header.channels
+            self.sampling_freq = header.sampling_freq
+            self.scale = header.scale                                   # µV per bit
+            self.header_bytes = header.counter_bytes + header.status_bytes
+            return
+
+        self.recording = None
+        self.num_channels = 8
+        self.channels = [1,2,3,4,5,6,7,8]
+        self.sampling_freq = 2000
+        self.metadata = {"Chip": "ADS1298", "Sampling Frequency": self.sampling_freq, "Number of Channels": self.num_channels,
+                         "Channels": self.channels}
+        self.scale = micromap_frames.ADS_SCALE                         # µV per bit (Vref = 4 V, PGA gain = 12)
+        self.header_bytes = micromap_frames.ADS_HEADER_BYTES
+
+    def _map_binary_data(self):
+        block_size = micromap_frames.ads_frame_size(self.num_channels, self.header_bytes)  # 3 bytes for header + 3*num_channels bytes for data
+
+        if self.recording is not None:
+            self.num_frames = self.recording.num_frames
+            data_offset = self.recording.data_offset
+        else:
+            file_size = os.path.getsize(self.bin_file)
+            if file_size % block_size != 0:
+                raise ValueError(f"File size {file_size} is not a multiple of block size {block_size}")
+            self.num_frames = file_size // block_size
+            data_offset = 0
+
+        if self.num_frames == 0:
+            raise ValueError("Binary (.mmap) file does not contain a complete frame.")
+
+        self.frames = numpy.memmap(self.bin_file, dtype = numpy.uint8, mode = 'r', offset = data_offset,
+                                   shape = (self.num_frames, block_size))                  # (frames, bytes) view of the file
+
+    def _load_binary_data(self):
+        # Convert to signed 24-bit integers (the 3-byte header of each block is skipped by the decoder)
+        values = micromap_frames.decode_int24(self.frames, self.num_channels, self.header_bytes)
+
+        # Organize by channels (raw codes, scaled to microvolts on access)
+        self.raw_data = values.T
+        self.num_samples = self.raw_data.shape[1]
+
+        if self.raw_data.shape[0] != self.num_channels:
+            raise ValueError(f"Data shape mismatch: expected {self.num_channels} channels, got {self.raw_data.shape[0]} channels.")
+
+    @property
+    def data(self):
+        """Scaled data (channels, samples) in µV (float32, kept after the first access). Prefer get_data / get_channel_data."""
+        if self._data is None:
+            self._data = self.get_data(numpy.float32)
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self.num_samples = value.shape[1]
+
+    def get_channel_data(self, index, dtype = numpy.float32):
+        """Returns the data of one channel (index from 1 to N) in µV with the chosen dtype."""
+        if self._data is not None:
+            return self._data[index - 1, :].astype(dtype, copy = False)
+        if self.raw_data is None:
+            self._load_binary_data()
+        return numpy.multiply(self.raw_data[index - 1, :], self.scale, dtype = dtype)
+
+    def get_data(self, dtype = numpy.float32):
+        """Returns all the data (channels, samples) in µV with the chosen dtype."""
+        if self._data is not None:
+            return self._data.astype(dtype, copy = False)
+        if self.raw_data is None:
+            self._load_binary_data()
+        return numpy.multiply(self.raw_data, self.scale, dtype = dtype)
+
+    def get_segment(self, start_s, stop_s, channels = None, dtype = numpy.float32):
+        """Returns the samples between start_s and stop_s seconds (channels, samples) in µV. The ADS frames have no counter and a fixed size,
+        so only the bytes of the requested frames are read and decoded (or the data in memory is sliced, if it was already loaded)."""
+        rows = slice(None) if channels is None else numpy.asarray(channels) - 1
+        first = max(int(round(start_s * self.sampling_freq)), 0)
+        last = int(round(stop_s * self.sampling_freq))
+
+        if self._data is not None:
+            return self._data[rows, first:last].astype(dtype, copy = False)
+        if self.raw_data is not None:
+            return numpy.multiply(self.raw_data[rows, first:last], self.scale, dtype = dtype)
+
+        values = micromap_frames.decode_int24(self.frames[first:last], self.num_channels, self.header_bytes)
+        return numpy.multiply(values[:, rows].T, self.scale, dtype = dtype)
+
+    def pipeline(self, seconds = 10, channels = None, dtype = numpy.float32):
+        """Returns a lazy processing pipeline over this recording (see micromap_pipeline.Pipeline)."""
+        return micromap_pipeline.Pipeline(self, seconds, channels, dtype)
+
+    def welch(self, nperseg = None, noverlap = None, channels = None, dtype = numpy.float32, workers = 1, backend = 'thread'):
+        """Returns the Welch PSD of the recording (see micromap_spectral.welch)."""
+        return micromap_spectral.welch(self, nperseg, noverlap, channels = channels, dtype = dtype, workers = workers, backend = backend)
+
+    def spectrogram(self, nperseg = None, noverlap = None, column_seconds = None, channels = None, dtype = numpy.float32, workers = 1, backend = 'thread'):
+        """Returns the spectrogram of the recording (see micromap_spectral.spectrogram)."""
+        return micromap_spectral.spectrogram(self, nperseg, noverlap, column_seconds = column_seconds, channels = channels, dtype = dtype,
+                                             workers = workers, backend = backend)
+
+    def check_arduino_test(self, seconds = 10, codes = None, max_breaks = 100000):
+        """Checks the raw frames of the file against the Arduino test pattern (see MicroMAPReader.check_arduino_test). The 24 bits codes are
+        decoded chunk by chunk."""
+        codes = micromap_checks.arduino_test_codes(self.num_channels, 'i3') if codes is None else codes
+        checker = micromap_checks.ArduinoTestChecker(codes, max_breaks)
+        chunk_frames = max(1, int(round(seconds * self.sampling_freq)))
+        for start in range(0, self.num_frames, chunk_frames):
+            checker.process(micromap_frames.decode_int24(self.frames[start:start + chunk_frames], self.num_channels, self.header_bytes))
+        return checker.report()
+
+    def iter_chunks(self, seconds = 10, channels = None, overlap = 0, dtype = numpy.float32):
+        """Iterates over the recording in blocks decoded straight from the memory-mapped file (see MicroMAPReader.iter_chunks). The ADS frames
+        have no packet counter, so the blocks are not gap filled.
+
+        Yields:
+            (offset, block): sample index of the first column of the block and the (channels, samples) scaled block.
+        """
+        chunk_frames = max(1, int(round(seconds * self.sampling_freq)))
+        overlap_samples = int(round(overlap * self.sampling_freq))
+        if overlap_samples < 0 or overlap_samples >= chunk_frames:
+            raise ValueError("overlap must be positive and smaller than the block duration.")
+
+        rows = slice(None) if channels is None else numpy.asarray(channels) - 1
+
+        for start in range(0, self.num_frames, chunk_frames):
+            first = max(0, start - overlap_samples)
+            values = micromap_frames.decode_int24(self.frames[first:start + chunk_frames], self.num_channels, self.header_bytes)
+            yield first, numpy.multiply(values[:, rows].T, self.scale, dtype = dtype)
+
+def open_recording(folder_path, preload = False):
+    """Returns the reader of a recording folder: MicroMAPReaderADS for 24 bits samples (ADS1298) and MicroMAPReader otherwise. The recording
+    containers say it in the header; the old recordings have a _metadata.pkl file only when they come from an RHD chip."""
+    for file in os.listdir(folder_path):
+        if file.endswith(".mmap"):
+            bin_file = os.path.join(folder_path, file)
+            break
+    else:
+        raise FileNotFoundError("Binary (.mmap) file not found.")
+
+    if micromap_format.is_recording_file(bin_file):
+        header = micromap_format.RecordingFile(bin_file).header
+        is_ads = header.sample_format == 'i3'
+    else:
+        is_ads = not any(file.endswith("_metadata.pkl") for file in os.listdir(folder_path))
+
+    if is_ads:
+        return MicroMAPReaderADS(folder_path, preload = preload)
+    return MicroMAPReader(folder_path, preload = preload)
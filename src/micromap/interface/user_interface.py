@@ -26,9 +26,12 @@ import time
 import struct
 import queue
 import interface_functions as interface_functions      
+import micromap_frames as micromap_frames
+import micromap_buffers as micromap_buffers
+import micromap_checks as micromap_checks
+import micromap_format as micromap_format
 import os
 import platform
-import pickle
 from datetime import datetime, timedelta
 from PyQt5 import QtWidgets, uic    
 from PyQt5.QtCore import QThread, pyqtSignal, QCoreApplication, QTimer
@@ -38,10 +41,11 @@ from pyqtgraph.Qt import QtGui
 import pyqtgraph
 
 class DataReceiverThreadRHD(QThread):
-    raw_data_ready = pyqtSignal(bytearray)
+    raw_data_ready = pyqtSignal(object)                                         # micromap_buffers.PooledBuffer of one packet (released by the plotter)
     message = pyqtSignal(str)
+    read_timeout = 0.005                                                        # Longest wait of a serial read in seconds (latency of the data and of stop)
 
-    def __init__(self, usb_port, num_channels, samples_to_read, is_recording_mode, plot_online, save_queue = None):
+    def __init__(self, usb_port, num_channels, samples_to_read, is_recording_mode, plot_online, save_queue = None, sampling_freq = None):
         super().__init__()
         self.usb = interface_functions.usb_singleton(usb_port, 50000000)
         self.num_channels = num_channels
@@ -50,11 +54,11 @@ class DataReceiverThreadRHD(QThread):
         self.running = False
         self.is_recording_mode = is_recording_mode
         self.save_queue = save_queue
-        self.expected_counter = None
-        self.buffer = bytearray()
+        self.counter_checker = micromap_checks.PacketCounterChecker(sampling_freq or 1)                    # Checks the counter of every frame (event times in frames without sampling_freq)
+        self.buffer = micromap_buffers.ByteRingBuffer(self.bytes_to_read)                                   # Received bytes, cut in packets of bytes_to_read
+        self.pool = micromap_buffers.BufferPool(self.bytes_to_read)                                         # Packets shared by the save and plot threads
         self.read_number = 0
         self.plot_online = plot_online
-        self.packets_lost = []
 
     def run(self):
         self.running = True
@@ -63,32 +67,20 @@ class DataReceiverThreadRHD(QThread):
         self.usb.request_acquisition()
 
         while self.running:
-            if self.usb.port.in_waiting > 0:
+            partial_data = self.buffer.writable()
+            received = self.usb.read_stream_into(partial_data, self.bytes_to_read, self.read_timeout)          # Reads straight into the ring (sleeps until data arrives, at most read_timeout)
+            if received > 0:
                 try:
-                    partial_data = self.usb.port.read(self.usb.port.in_waiting)
-                    self.buffer += partial_data
-
-                    if self.plot_online:
-                        self.raw_data_ready.emit(bytearray(partial_data))
-
-                    while len(self.buffer) >= self.bytes_to_read:                      
-                        full_packet = self.buffer[:self.bytes_to_read]
-                        self.buffer = self.buffer[self.bytes_to_read:]
-
-                        if self.expected_counter is None:
-                            self.expected_counter = int.from_bytes( full_packet[0:2], byteorder='big')  # Convert to integer
+                    self.buffer.commit(received)
 
-                        packet_counter = int.from_bytes(full_packet[0:2], byteorder='big')  # Convert to integer
-                        
-                        if packet_counter != self.expected_counter:
-                            self.message.emit(f"[ERROR] Packet counter mismatch: expected {self.expected_counter}, got {packet_counter}")
-                            self.packets_lost.append(numpy.abs(packet_counter - self.expected_counter))  # Store the difference in packet counters
-                            self.expected_counter = packet_counter                                       # Update the expected counter to the received one
+                    for full_packet in self.buffer.packets():                                                   # Whole packets as views of the ring (no copy of the backlog)
+                        counters = numpy.frombuffer(full_packet, dtype = '>u2')[::self.num_channels + 1]       # Counter of every frame (strided view of the packet)
+                        events = self.counter_checker.process(counters)
+                        if events.size > 0:
+                            lost = int(events['length'][events['kind'] == micromap_checks.GAP].sum())
+                            self.message.emit(f"[ERROR] Packet counter: {events.size} discontinuities from frame {events['frame'][0]} ({lost} packets lost)")
 
-                        self.expected_counter = (self.expected_counter + self.samples_to_read) % 65536  # Increment the expected counter
-
-                        if self.is_recording_mode and self.save_queue:
-                            self.save_queue.put(full_packet)  
+                        self.hand_over(full_packet)
 
                         self.message.emit(f'[RECEIVE] {self.read_number}')
                         self.read_number += 1
@@ -98,17 +90,28 @@ class DataReceiverThreadRHD(QThread):
 
         if len(self.buffer) > 0:
             if self.is_recording_mode and self.save_queue:
-                self.save_queue.put(self.buffer)
+                self.save_queue.put(self.pool.acquire(self.buffer.remainder()))
                 self.message.emit(f'[RECEIVE] {self.read_number}')
                 self.read_number += 1
 
-        if self.packets_lost != []:
-            self.message.emit(f"[INFO] Stopping data acquisition... ({numpy.sum(self.packets_lost)} packets lost)")
+        counter_report = self.counter_checker.report()
+        if not counter_report.passed:
+            self.message.emit(f"[INFO] Stopping data acquisition... ({counter_report})")
         else:
             self.message.emit(f"[INFO] Stopping data acquisition... (No packets lost)")
         self.usb.stop_acquisition()
         self.usb.disconnect()
 
+    def hand_over(self, full_packet):
+        saving = self.is_recording_mode and self.save_queue is not None
+        plotting = self.plot_online
+        if saving or plotting:
+            packet = self.pool.acquire(full_packet, saving + plotting)                                  # One copy of the packet, shared by the consumers
+            if saving:
+                self.save_queue.put(packet)
+            if plotting:
+                self.raw_data_ready.emit(packet)
+
     def stop(self):
         self.running = False
 
@@ -116,8 +119,9 @@ class DataReceiverThreadRHD(QThread):
         self.plot_online = state
 
 class DataReceiverThreadADS(QThread):
-    raw_data_ready = pyqtSignal(bytearray)
+    raw_data_ready = pyqtSignal(object)                                         # micromap_buffers.PooledBuffer of one packet (released by the plotter)
     message = pyqtSignal(str)
+    read_timeout = 0.005                                                        # Longest wait of a serial read in seconds (latency of the data and of stop)
 
     def __init__(self, usb_port, num_channels, samples_to_read, is_recording_mode, plot_online, save_queue = None):
         super().__init__()
@@ -128,11 +132,11 @@ class DataReceiverThreadADS(QThread):
         self.running = False
         self.is_recording_mode = is_recording_mode
         self.save_queue = save_queue
-        self.expected_counter = None
-        self.buffer = bytearray()
+        self.frame_validator = micromap_frames.AdsFrameValidator(self.num_channels)                         # Checks the status word of every frame and resynchronizes the stream
+        self.buffer = micromap_buffers.ByteRingBuffer(self.bytes_to_read)                                   # Received bytes, cut in packets of bytes_to_read
+        self.pool = micromap_buffers.BufferPool(self.bytes_to_read + self.frame_validator.max_pending)      # Packets shared by the save and plot threads
         self.read_number = 0
         self.plot_online = plot_online
-        self.packets_lost = []
 
     def run(self):
         self.running = True
@@ -141,20 +145,19 @@ class DataReceiverThreadADS(QThread):
         self.usb.request_acquisition()
 
         while self.running:
-            if self.usb.port.in_waiting > 0:
+            partial_data = self.buffer.writable()
+            received = self.usb.read_stream_into(partial_data, self.bytes_to_read, self.read_timeout)          # Reads straight into the ring (sleeps until data arrives, at most read_timeout)
+            if received > 0:
                 try:
-                    partial_data = self.usb.port.read(self.usb.port.in_waiting)
-                    self.buffer += partial_data
-
-                    if self.plot_online:
-                        self.raw_data_ready.emit(bytearray(partial_data))
-
-                    while len(self.buffer) >= self.bytes_to_read:                      
-                        full_packet = self.buffer[:self.bytes_to_read]
-                        self.buffer = self.buffer[self.bytes_to_read:]
+                    self.buffer.commit(received)
 
-                        if self.is_recording_mode and self.save_queue:
-                            self.save_queue.put(full_packet)  
+                    for full_packet in self.buffer.packets():                                                   # Whole packets as views of the ring (no copy of the backlog)
+                        dropped = self.frame_validator.dropped
+                        frames = self.frame_validator.process(full_packet)                                      # Valid frames only (the packet itself when nothing is wrong)
+                        if self.frame_validator.dropped > dropped:
+                            self.message.emit(f"[ERROR] ADS stream misaligned: {self.frame_validator.dropped - dropped} frames dropped, resynchronized at frame {self.frame_validator.frames}")
+                        if len(frames) > 0:
+                            self.hand_over(frames)
 
                         self.message.emit(f'[RECEIVE] {self.read_number}')
                         self.read_number += 1
@@ -163,18 +166,29 @@ class DataReceiverThreadADS(QThread):
                     self.message.emit(f"[ERROR]: {e}")
 
         if len(self.buffer) > 0:
-            if self.is_recording_mode and self.save_queue:
-                self.save_queue.put(self.buffer)
+            frames = self.frame_validator.process(self.buffer.remainder())                                      # The bytes of an incomplete frame are discarded
+            if self.is_recording_mode and self.save_queue and len(frames) > 0:
+                self.save_queue.put(self.pool.acquire(frames))
                 self.message.emit(f'[RECEIVE] {self.read_number}')
                 self.read_number += 1
 
-        if self.packets_lost != []:
-            self.message.emit(f"[INFO] Stopping data acquisition... ({numpy.sum(self.packets_lost)} packets lost)")
+        if self.frame_validator.dropped > 0:
+            self.message.emit(f"[INFO] Stopping data acquisition... ({self.frame_validator.dropped} frames dropped in {self.frame_validator.misalignments} misalignments)")
         else:
             self.message.emit(f"[INFO] Stopping data acquisition... (No packets lost)")
         self.usb.stop_acquisition()
         self.usb.disconnect()
 
+    def hand_over(self, full_packet):
+        saving = self.is_recording_mode and self.save_queue is not None
+        plotting = self.plot_online
+        if saving or plotting:
+            packet = self.pool.acquire(full_packet, saving + plotting)                                  # One copy of the packet, shared by the consumers
+            if saving:
+                self.save_queue.put(packet)
+            if plotting:
+                self.raw_data_ready.emit(packet)
+
     def stop(self):
         self.running = False
 
@@ -183,9 +197,10 @@ class DataReceiverThreadADS(QThread):
 
 class PlotThreadRHD(QThread):
     channel_data_ready = pyqtSignal(numpy.ndarray)
+    spikes_ready = pyqtSignal(numpy.ndarray)
     message = pyqtSignal(str)
 
-    def __init__(self, num_channels, plot_data_window, update_samples = 1000, parent=None):
+    def __init__(self, num_channels, plot_data_window, update_samples = 1000, display_filter = None, spike_detector = None, parent=None):
         super().__init__(parent)    
         if plot_data_window < update_samples:
             raise ValueError("plot_data_window must be greater than update_samples")
@@ -194,6 +209,8 @@ class PlotThreadRHD(QThread):
         self.num_channels = num_channels
         self.update_bytes = update_samples*(2*(self.num_channels + 1))
         self.intan_scale = 1000 * 0.195e-6
+        self.display_filter = display_filter                                    # Streaming filter applied to the plotted data (keeps its state between updates)
+        self.spike_detector = spike_detector                                    # Streaming spike detector (micromap_spikes.SpikeDetector) run on the raw data
         self.running = True
         self.update_buffer = numpy.zeros((self.num_channels, plot_data_window), dtype = numpy.float32)
         self.update_index = 0
@@ -215,8 +232,9 @@ class PlotThreadRHD(QThread):
         while self.running:
             try:
                 byte_data = self.queue.get(timeout=0.1)
-                byte_block.extend(byte_data)
+                byte_block.extend(byte_data.view)
                 accumulated_bytes += len(byte_data)
+                byte_data.release()                                                                         # Returns the packet to the receiver pool
 
                 if accumulated_bytes >= self.update_bytes:
                     repeats = len(byte_block) // self.block_size
@@ -228,6 +246,12 @@ class PlotThreadRHD(QThread):
                     values = struct.unpack(unpack_format, clean_bytes)
                     channel_data = numpy.array([values[i::self.num_channels] for i in range(self.num_channels)], dtype=numpy.float32)
                     channel_data = channel_data * self.intan_scale
+                    if self.spike_detector is not None:
+                        spikes, _ = self.spike_detector.process(channel_data)
+                        if spikes.size > 0:
+                            self.spikes_ready.emit(spikes)
+                    if self.display_filter is not None:
+                        channel_data = self.display_filter.process(channel_data)
 
                     # Atualiza buffer
                     update_length = channel_data.shape[1]
@@ -258,7 +282,7 @@ class PlotThreadADS(QThread):
     channel_data_ready = pyqtSignal(numpy.ndarray)
     message = pyqtSignal(str)
 
-    def __init__(self, num_channels, plot_data_window, update_samples=1000, parent=None):
+    def __init__(self, num_channels, plot_data_window, update_samples=1000, display_filter=None, parent=None):
         super().__init__(parent)
         if plot_data_window < update_samples:
             raise ValueError("plot_data_window must be greater than update_samples")
@@ -267,6 +291,7 @@ class PlotThreadADS(QThread):
         self.num_channels = num_channels
         self.update_bytes = update_samples * (3 * (self.num_channels + 1))  # 3 bytes por canal + 3 de header
         self.ads_scale = 0.488e-6 * 1000  # microvolts para milivolts
+        self.display_filter = display_filter  # Filtro (com estado) aplicado aos dados plotados
         self.running = True
         self.update_buffer = numpy.zeros((self.num_channels, plot_data_window), dtype=numpy.float32)
         self.update_index = 0
@@ -274,9 +299,8 @@ class PlotThreadADS(QThread):
 
         print(f"[INFO] Buffer size: {self.buffer_size}")
 
-        self.block_size = 3 * (self.num_channels + 1)  # 3 bytes de header + 3 bytes por canal
-        self.flag_indexes_template = numpy.ones(self.block_size, dtype=bool)
-        self.flag_indexes_template[0:3] = False  # Ignora os 3 bytes do status word
+        self.block_size = micromap_frames.ads_frame_size(self.num_channels)  # 3 bytes de header + 3 bytes por canal
+        self.decoder = micromap_frames.Int24StreamDecoder(self.num_channels)  # Ignora os 3 bytes do status word e guarda frames incompletos
 
     def push_data(self, byte_data):
         self.queue.put(byte_data)
@@ -288,29 +312,16 @@ class PlotThreadADS(QThread):
         while self.running:
             try:
                 byte_data = self.queue.get(timeout=0.1)
-                byte_block.extend(byte_data)
+                byte_block.extend(byte_data.view)
                 accumulated_bytes += len(byte_data)
+                byte_data.release()                                                                         # Returns the packet to the receiver pool
 
                 if accumulated_bytes >= self.update_bytes:
-                    repeats = len(byte_block) // self.block_size
-                    flag_indexes = numpy.tile(self.flag_indexes_template, repeats)
-
-                    # Remove status word
-                    clean_bytes = numpy.frombuffer(byte_block, dtype=numpy.uint8)[flag_indexes].tobytes()
-
-                    # Reconstrói os valores de 24 bits -> 32 bits assinados
-                    values = []
-                    for i in range(0, len(clean_bytes), 3):
-                        b1, b2, b3 = clean_bytes[i:i+3]
-                        val = b1 << 16 | b2 << 8 | b3
-                        if val & 0x800000:
-                            val -= 0x1000000  # Sign extension para 2's complement
-                        values.append(val)
-
-                    values = numpy.array(values, dtype=numpy.float32)
-                    values *= self.ads_scale * 0.01
-
-                    channel_data = numpy.array([values[i::self.num_channels] for i in range(self.num_channels)])
+                    # Reconstrói os valores de 24 bits -> 32 bits assinados (vetorizado)
+                    values = self.decoder.decode(byte_block)
+                    channel_data = numpy.multiply(values.T, numpy.float32(self.ads_scale * 0.01), dtype=numpy.float32)
+                    if self.display_filter is not None:
+                        channel_data = self.display_filter.process(channel_data)
 
                     update_length = channel_data.shape[1]
                     end_index = (self.update_index + update_length) % self.buffer_size
@@ -338,20 +349,36 @@ class PlotThreadADS(QThread):
 class SaveThread(QThread):
     message = pyqtSignal(str)
     
-    def __init__(self, filename, save_queue):
+    def __init__(self, filename, save_queue, header = None):
         super().__init__()
         self.save_queue = save_queue
         self.filename = filename
+        self.header = header                                                                                # Recording header (None writes the old headerless file)
         self.running = True
         self.save_number = 0
 
     def run(self):
-        with open(self.filename, 'wb') as f:
+        if self.header is None:
+            with open(self.filename, 'wb') as f:
+                while self.running or not self.save_queue.empty():
+                    try:
+                        data = self.save_queue.get(timeout=0.1)
+                        f.write(data.view)
+                        data.release()                                                                      # Returns the packet to the receiver pool
+                        f.flush()
+                        self.message.emit(f'[SAVE] {self.save_number}')
+                        self.save_number += 1
+                    except queue.Empty:
+                        continue
+            return
+
+        with micromap_format.RecordingWriter(self.filename, self.header) as writer:                         # Writes the header, the blocks and (when closed) the seek index
             while self.running or not self.save_queue.empty():
                 try:
                     data = self.save_queue.get(timeout=0.1)
-                    f.write(data)
-                    f.flush()
+                    writer.write_block(data.view)
+                    data.release()                                                                          # Returns the packet to the receiver pool
+                    writer.flush()
                     self.message.emit(f'[SAVE] {self.save_number}')
                     self.save_number += 1
                 except queue.Empty:
@@ -362,6 +389,24 @@ class SaveThread(QThread):
 
 # INTERFACE CLASS
 
+class PyramidThread(QThread):
+    pyramid_ready = pyqtSignal(object)
+    message = pyqtSignal(str)
+
+    def __init__(self, folder_path):
+        super().__init__()
+        self.folder_path = folder_path
+
+    def run(self):
+        try:
+            import micromap_utils as micromap_utils                                                 # The analysis modules are only loaded to browse a recording
+            import micromap_pyramid as micromap_pyramid
+            reader = micromap_utils.open_recording(self.folder_path, preload = False)                # Memory-mapped, nothing is loaded
+            self.message.emit("[INFO] Preparing the recording to be browsed (min/max pyramid)...")
+            self.pyramid_ready.emit(micromap_pyramid.Pyramid(reader))                                 # Built once, reused while the file does not change
+        except Exception as e:
+            self.message.emit(f"[ERROR] Could not open the recording: {e}")
+
 class interface_visual_gui(QMainWindow):
     '''Interface visual gui
     
@@ -404,6 +449,10 @@ class interface_visual_gui(QMainWindow):
 
         self.timeout = None                                                                                         # Variable to check if the timeout is active or not
         self.plot_online = True                                                                                     # Variable to check if the plot is online or offline
+        self.plot_filter = False                                                                                    # Filters the plotted data with the high pass and low pass settings
+        self.plot_notch = 0.0                                                                                       # Line frequency removed from the plotted data (0 = no notch filter)
+        self.plot_spikes = 0.0                                                                                      # Marks the detected spikes on the plot (threshold in multiples of the noise, 0 = no detection)
+        self.spike_markers = None
         
         if self.is_raspberry:
             self.plot_window_sec = 5                                                                                # Number of seconds to be plotted (X axis limit)
@@ -428,6 +477,11 @@ class interface_visual_gui(QMainWindow):
         self.timeout_timer = QTimer()
         self.timeout_timer.timeout.connect(self.stop_function)
 
+        self.browser = None                                                                                     # Pyramid of the recording opened in the plot (offline mode)
+        self.browser_timer = QTimer()                                                                           # Redraws the recording when the scroll/zoom stops
+        self.browser_timer.setSingleShot(True)
+        self.browser_timer.timeout.connect(self.update_browser_function)
+
         # INTERFACE INTERACTIONS
         # Record configuration interactions
         self.chip_combobox.currentIndexChanged.connect(self.chip_function)                                          # Called when chip combobox is changed
@@ -449,6 +503,7 @@ class interface_visual_gui(QMainWindow):
         self.record_button.clicked.connect(self.start_view_mode_function)                                           # Called when the clear button is clicked 
         self.show_plot_checkbox.stateChanged.connect(self.show_plot_function)                                       # Called when the "show plot" checkbox is clicked
         self.set_timeout_button.clicked.connect(self.timeout_function)                                              # Called when the timeout button is clicked
+        self.open_recording_button.clicked.connect(self.open_recording_function)                                    # Called when the open button is clicked
 
     # INTERFACE SELECTIONS FUNCTIONS ------------------------------------------------------------
             
@@ -785,6 +840,7 @@ class interface_visual_gui(QMainWindow):
             self.warning_message_function("The chip selected was not found. Please, check the USB port or if the chip connected is correct")
             return
 
+        self.close_recording_function()                                                                         # Leaves the offline mode (if a recording was opened)
         self.get_channels_configuration_function()                                                              # Calls the function to define the channels that will be sampled 
 
         if self.is_raspberry and self.options.sampling_frequency >= 1000 and self.plot_online == True:          # If the sampling frequency is greater than 1KHz and the plot is online
@@ -858,17 +914,48 @@ class interface_visual_gui(QMainWindow):
             
             self.curves.append(curve)
 
+        display_filters = []                                                                                        # Only the plot is filtered, the recording keeps the raw data
+        if self.plot_notch > 0 or self.plot_filter:
+            import micromap_filters as micromap_filters                                                             # Loaded only when needed (scipy is slow to import on the Pi)
+        if self.plot_notch > 0:
+            if micromap_filters.NotchFilter.applies(self.plot_notch, self.options.sampling_frequency):
+                display_filters.append(micromap_filters.NotchFilter(self.plot_notch, self.options.sampling_frequency, harmonics = 3))
+            else:
+                self.logging.appendPlainText(f"[INFO] Notch filter skipped ({self.plot_notch} Hz is above the Nyquist frequency)")
+        if self.plot_filter:
+            if micromap_filters.BandpassFilter.applies(self.options.highpass, self.options.lowpass, self.options.sampling_frequency):
+                display_filters.append(micromap_filters.BandpassFilter.from_settings(self.options))
+            else:
+                self.logging.appendPlainText("[INFO] Plot filter skipped (cutoffs above the Nyquist frequency)")
+        display_filter = micromap_filters.StreamingFilter.cascade(*display_filters, steady_start = True) if display_filters else None
+
+        if self.spike_markers is not None:
+            self.plot_viewer.removeItem(self.spike_markers)
+            self.spike_markers = None
+        spike_detector = None
+        if self.plot_spikes > 0 and self.options.chip != "ADS1298":
+            import micromap_spikes as micromap_spikes                                                               # Loaded only when needed (scipy is slow to import on the Pi)
+            spike_detector = micromap_spikes.SpikeDetector(self.options.sampling_frequency, threshold = self.plot_spikes)
+            self.spike_markers = pyqtgraph.ScatterPlotItem(size = 6, pen = None, brush = 'r', symbol = 't')
+            self.plot_viewer.addItem(self.spike_markers)
+            self.spike_samples = numpy.empty(0, dtype = numpy.int64)
+            self.spike_channels = numpy.empty(0, dtype = numpy.uint16)
+
         if self.options.chip != "ADS1298":
             self.plot_thread = PlotThreadRHD(
                 num_channels = self.options.num_channels,
                 plot_data_window = self.plot_window,
                 update_samples = math.ceil(self.update_samples*self.options.sampling_frequency), 
+                display_filter = display_filter,
+                spike_detector = spike_detector,
             )
+            self.plot_thread.spikes_ready.connect(self.update_spikes_function)
         else:
             self.plot_thread = PlotThreadADS(
                 num_channels = self.options.num_channels,
                 plot_data_window = self.plot_window,
                 update_samples = math.ceil(self.update_samples*self.options.sampling_frequency), 
+                display_filter = display_filter,
             )
         self.plot_thread.message.connect(self.logging.appendPlainText)
         self.plot_thread.channel_data_ready.connect(self.update_buffers)
@@ -882,7 +969,8 @@ class interface_visual_gui(QMainWindow):
                 samples_to_read=self.samples_to_read,
                 is_recording_mode=self.options.is_recording_mode,
                 plot_online=self.plot_online,
-                save_queue=self.save_queue
+                save_queue=self.save_queue,
+                sampling_freq=self.options.sampling_frequency
             )
         else:
             self.data_receiver_thread = DataReceiverThreadADS(
@@ -904,7 +992,8 @@ class interface_visual_gui(QMainWindow):
         self.timer_updater_timer.start(10000)
 
         if self.options.is_recording_mode:
-            self.save_thread = SaveThread(self.options.save_directory, self.save_queue)
+            header = self.options.recording_header(index_period = self.samples_to_read)                        # Self-describing header of the recording file
+            self.save_thread = SaveThread(self.options.save_directory, self.save_queue, header)
             self.save_thread.message.connect(self.logging.appendPlainText)
             
             if self.timeout is not None:            
@@ -954,6 +1043,15 @@ class interface_visual_gui(QMainWindow):
             data = numpy.add(i + 1, channel_data[i])  # Add the new data to the existing data
             self.curves[i].setData(x = self.x_values, y = data, copy = False)
 
+    def update_spikes_function(self, spikes):
+        if self.spike_markers is None:
+            return
+        self.spike_samples = numpy.concatenate((self.spike_samples, spikes['sample']))
+        self.spike_channels = numpy.concatenate((self.spike_channels, spikes['channel']))
+        recent = self.spike_samples > self.spike_samples[-1] - self.plot_window                               # Only the spikes of the plotted window
+        self.spike_samples, self.spike_channels = self.spike_samples[recent], self.spike_channels[recent]
+        self.spike_markers.setData(x = self.spike_samples % self.plot_window, y = self.spike_channels.astype(float))
+
     def show_plot_function(self):
         self.plot_online = self.show_plot_checkbox.isChecked()
         self.plot_online_emit.emit(self.plot_online)
@@ -1162,12 +1260,6 @@ class interface_visual_gui(QMainWindow):
                    'Duration: {}\n'.format(timedelta(seconds = round(record_time))))                            # Text to be showed in warning message
         self.warning_message_function(text)                                                                     # Shows a warning message
         
-        if self.options.is_recording_mode:                                                                    # If the recording mode is active
-            options_resume = self.options.resume_options()                                                          # Gets the data resume
-            options_resume_file = self.options.save_directory[:-5] + '_metadata.pkl'                                # Creates the file name to write the resume
-            with open(options_resume_file, 'wb') as file:                                                           # Opens the file to write the resume
-                pickle.dump(options_resume, file)                                                                   # Writes the resume in the file
-
         self.options.is_recording_mode = False                                                                  # Changes the recording mode flag to 'false'
 
         self.options.save_directory = "None"                                                                    # Change the save directory on main variables dictionary
@@ -1220,6 +1312,85 @@ class interface_visual_gui(QMainWindow):
         super().closeEvent(event)
         QCoreApplication.instance().quit                                                                        # Quits of the window                
 
+    # OFFLINE BROWSER FUNCTIONS -----------------------------------------------------------------
+
+    def open_recording_function(self):
+        '''Open recording function
+
+        This public function is called when the open button is clicked. The recording is memory-mapped
+        (nothing is loaded) and its min/max pyramid is built, or reused, in a thread. Then the plot shows
+        the min/max envelope of the visible time range, so scrolling and zooming only read about one bin
+        per pixel.
+        '''
+        if getattr(self, 'data_receiver_thread', None) is not None:
+            self.warning_message_function("Stop the acquisition before opening a recording.")
+            return
+
+        file_path, _ = QFileDialog.getOpenFileName(self, "Open recording", "", "MicroMAP recordings (*.mmap)")
+        if not file_path:
+            return
+
+        if getattr(self, 'pyramid_thread', None) is not None and self.pyramid_thread.isRunning():
+            self.warning_message_function("Wait until the previous recording is opened.")
+            return
+
+        self.close_recording_function()
+        self.pyramid_thread = PyramidThread(os.path.dirname(file_path))
+        self.pyramid_thread.message.connect(self.logging.appendPlainText)
+        self.pyramid_thread.pyramid_ready.connect(self.show_recording_function)
+        self.pyramid_thread.finished.connect(self.pyramid_thread.deleteLater)
+        self.pyramid_thread.finished.connect(self.pyramid_finished_function)
+        self.pyramid_thread.start()
+
+    def pyramid_finished_function(self):
+        if self.sender() is self.pyramid_thread:
+            self.pyramid_thread = None                                                                          # Deleted by Qt (deleteLater)
+
+    def show_recording_function(self, pyramid):
+        self.browser = pyramid
+        num_channels = pyramid.num_channels
+        duration = pyramid.num_samples / pyramid.sampling_freq
+
+        self.plot_viewer_function(num_channels)                                                                 # Same axes and style of the live plot
+        self.plot_viewer.getViewBox().setLimits(xMin = 0, xMax = duration)                                      # X axis in seconds
+        self.plot_viewer.setXRange(0, min(self.plot_window_sec, duration), padding = 0)
+
+        self.curves = []
+        for i in range(num_channels):
+            curve = self.plot_viewer.plot(pen = pyqtgraph.mkPen('white', width = 1))
+            curve.setSkipFiniteCheck(True)
+            self.curves.append(curve)
+
+        self.plot_viewer.getViewBox().sigXRangeChanged.connect(self.browser_range_function)
+        self.update_browser_function()
+        self.logging.appendPlainText(f"[INFO] Recording opened: {num_channels} channels, {duration:.1f} seconds")
+
+    def browser_range_function(self, *args):
+        self.browser_timer.start(30)                                                                            # Redraws once, when the scroll/zoom pauses
+
+    def update_browser_function(self):
+        if self.browser is None:
+            return
+
+        start, stop = self.plot_viewer.getViewBox().viewRange()[0]
+        pixels = max(1, int(self.plot_viewer.width()))
+        times, minimum, maximum = self.browser.envelope(start, stop, pixels)
+
+        x_values = numpy.repeat(times, 2)                                                                       # Vertical segment from the minimum to the maximum of each pixel
+        y_values = numpy.stack((minimum, maximum), axis = 2).reshape(minimum.shape[0], -1) / 1000              # µV -> mV (as the live plot)
+        for i, curve in enumerate(self.curves):
+            curve.setData(x = x_values, y = y_values[i] + i + 1, copy = False)
+
+    def close_recording_function(self):
+        if self.browser is None:
+            return
+        try:
+            self.plot_viewer.getViewBox().sigXRangeChanged.disconnect(self.browser_range_function)
+        except TypeError:
+            pass
+        self.browser_timer.stop()
+        self.browser = None
+
     def plot_viewer_function(self, num_channels = 16):
         self.plot_viewer.clear()
 
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The interface modules import each other as top level modules (as when the interface is run from its folder)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'micromap', 'interface'))
@@ -0,0 +1,15 @@
+import numpy
+import micromap_alignment
+
+def test_noisy_refinement_keeps_coarse_fit():
+    # Same bursts on independent noise: the envelopes match but the full resolution samples do not correlate
+    rng = numpy.random.default_rng(0)
+    sampling_freq, samples, lag = 1000, 60000, 0.5
+    modulation = numpy.repeat(rng.random(samples // 200), 200)**4          # Bursts of 0.2 s
+    a = modulation * rng.standard_normal(samples)
+    b = numpy.concatenate((numpy.zeros(int(lag * sampling_freq)), modulation * rng.standard_normal(samples)))
+
+    alignment = micromap_alignment.align(a[None], b[None], sampling_freq, sampling_freq, rate = 100, refine_seconds = 2)
+    assert alignment.correlation > 0.3
+    assert abs(alignment.offset - lag) < 0.02
+    assert abs(alignment.ratio - 1) < 1e-3
@@ -0,0 +1,20 @@
+import numpy
+import pytest
+import micromap_filters
+
+def test_notch_without_harmonics_below_nyquist():
+    assert not micromap_filters.NotchFilter.applies(60, 100)
+    with pytest.raises(ValueError, match = "Nyquist"):
+        micromap_filters.NotchFilter(60, 100, harmonics = 3)
+
+def test_notch_skips_harmonics_above_nyquist():
+    notch = micromap_filters.NotchFilter(60, 300, harmonics = 3)
+    assert notch.frequencies.tolist() == [60, 120]
+    assert notch.process(numpy.ones((2, 100))).shape == (2, 100)
+
+def test_bandpass_cutoffs_above_nyquist():
+    assert not micromap_filters.BandpassFilter.applies(300, 6000, 500)
+    with pytest.raises(ValueError, match = "Nyquist"):
+        micromap_filters.BandpassFilter(300, 6000, 500)
+    assert micromap_filters.BandpassFilter.applies(1, 6000, 500)
+    micromap_filters.BandpassFilter(1, 6000, 500)                           # Low pass above Nyquist: high pass only
@@ -0,0 +1,14 @@
+import numpy
+import micromap_utils
+from test_reader import write_recording
+
+def test_outputs_are_readers(tmp_path):
+    reader = micromap_utils.MicroMAPReader(str(write_recording(tmp_path)), preload = False)
+    expected = reader.pipeline().resample(250).to_array()
+
+    processed = reader.pipeline().resample(250).to_file(str(tmp_path))     # Next to the source recording
+    resampled = reader.resample(250, method = 'poly', output = str(tmp_path))
+    for written in (processed, resampled):
+        assert isinstance(written, micromap_utils.MicroMAPReader)
+        assert written.sampling_freq == 250
+        numpy.testing.assert_allclose(written.data, expected, rtol = 1e-6, atol = 1e-3)
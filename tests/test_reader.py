@@ -0,0 +1,64 @@
+import pickle
+import numpy
+import pytest
+import micromap_frames
+import micromap_utils
+
+def write_recording(folder, num_channels = 4, num_frames = 5000, sampling_freq = 1000, lost = ((700, 3), (2000, 1), (4321, 7)), amplitude = 3000):
+    """Writes an old style recording (headerless .mmap + _metadata.pkl) with packets lost at (frame, length) and random codes within
+    +- amplitude."""
+    rng = numpy.random.default_rng(0)
+    counters = numpy.arange(num_frames + sum(length for _, length in lost))
+    keep = numpy.ones(counters.size, dtype = bool)
+    for frame, length in lost:
+        keep[frame:frame + length] = False
+    frames = numpy.zeros(int(keep.sum()), dtype = micromap_frames.rhd_frame_dtype(num_channels))
+    frames['counter'] = counters[keep] % 2**16
+    frames['samples'] = rng.integers(-amplitude, amplitude, (frames.size, num_channels), endpoint = True)
+    frames.tofile(str(folder / "recording.mmap"))
+    with open(folder / "recording_metadata.pkl", 'wb') as f:
+        pickle.dump({"Number of Channels": num_channels, "Channels": list(range(num_channels)), "Sampling Frequency": sampling_freq}, f)
+    return folder
+
+@pytest.mark.parametrize('fill_method', ['last', 'nan', 'linear'])
+def test_chunks_equal_loaded_data(tmp_path, fill_method):
+    folder = write_recording(tmp_path)
+    loaded = micromap_utils.MicroMAPReader(str(folder), fill_method = fill_method).data
+    reader = micromap_utils.MicroMAPReader(str(folder), preload = False)
+    chunks = numpy.concatenate([block for _, block in reader.iter_chunks(seconds = 0.7, fill_method = fill_method)], axis = 1)
+    assert chunks.shape == loaded.shape
+    numpy.testing.assert_array_equal(chunks, loaded)
+
+def test_linear_fill_does_not_overflow(tmp_path):
+    filled, _, _ = micromap_frames.fill_gaps(numpy.array([[-30000, 30000], [32767, -32768]], numpy.int16), numpy.array([0, 2]), 'linear')
+    assert filled.tolist() == [[-30000, 0, 30000], [32767, 0, -32768]]
+
+    folder = write_recording(tmp_path, amplitude = 32767)                  # Codes over the full int16 range
+    raw = numpy.fromfile(str(folder / "recording.mmap"), dtype = micromap_frames.rhd_frame_dtype(4))['samples'].T.astype(numpy.float64)
+    reader = micromap_utils.MicroMAPReader(str(folder), fill_method = 'linear')
+    expected = numpy.rint(raw[:, 699, None] + (raw[:, 700, None] - raw[:, 699, None]) * numpy.arange(1, 4) / 4)   # Frames 700 to 702 are lost
+    numpy.testing.assert_allclose(reader.data[:, 700:703], expected * reader.scale)
+    chunks = numpy.concatenate([block for _, block in reader.iter_chunks(seconds = 0.7, fill_method = 'linear')], axis = 1)
+    numpy.testing.assert_array_equal(chunks, reader.data)
+
+def test_resample_defaults_to_fft(tmp_path):
+    from scipy.signal import resample, resample_poly
+    folder = write_recording(tmp_path)
+    data = micromap_utils.MicroMAPReader(str(folder)).data
+    fft = micromap_utils.MicroMAPReader(str(folder)).resample(250)
+    numpy.testing.assert_allclose(fft.data, resample(data, data.shape[1] // 4, axis = 1))
+    poly = micromap_utils.MicroMAPReader(str(folder)).resample(250, method = 'poly')
+    numpy.testing.assert_allclose(poly.data, resample_poly(data, 1, 4, axis = 1), atol = 1e-9)
+    assert fft.sampling_freq == poly.sampling_freq == 250
+
+def test_resample_checks_arguments(tmp_path):
+    reader = micromap_utils.MicroMAPReader(str(write_recording(tmp_path)))
+    for arguments in (dict(output = str(tmp_path / "out")), dict(workers = 2), dict(backend = 'process')):
+        with pytest.raises(ValueError, match = "'fft'"):
+            reader.resample(250, **arguments)
+    with pytest.raises(ValueError, match = "exactly"):
+        reader.resample(333.7, method = 'poly')
+    with pytest.raises(ValueError, match = "exactly"):
+        reader.pipeline().resample(333.7)
+    assert reader.sampling_freq == 1000
+    assert reader.resample(1000 / 3, method = 'poly').data.shape[1] == int(numpy.ceil(reader.raw_data.shape[1] / 3))